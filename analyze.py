@@ -1,13 +1,12 @@
-import matplotlib
-matplotlib.use('Qt4Agg')
-import matplotlib.pyplot as plt
+# plots through pfu.pyplot(), set MPLBACKEND (e.g. MPLBACKEND=Qt5Agg) for the recon windows
 import numpy as np
 import peakfinder_utils as pfu
+import peakfinder_io as pfio
 
-pulses = pfu.read_pulses( "results/PARALLELTESTcrate1.amc1_chA_lvlthr130_totthr3.csv") 
+pulses, waveforms, metadata = pfio.read_results( "results/PARALLELTESTcrate1.amc1_chA_lvlthr130_totthr3.h5") 
 
 for pulse in pulses:
-  print pulse.bx
+  print(pulse.bx)
 
 
 pfu.recon( "/home/bril_firmware/Documents/firmware/ubcm/fw/fpga/src/user/modules/peakfinder/tests/raw_data/stable_1000orbits_bcm1f.crate1.amc1_chA.bin", pulses )
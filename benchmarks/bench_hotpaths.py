@@ -0,0 +1,152 @@
+################################################
+# Benchmarks of the analysis and model hot paths on synthetic orbit data
+# at the real geometry (3564 bx x 30 samples), no simulator needed:
+#   python benchmarks/bench_hotpaths.py [--orbits 1 10 100 1000] [--baseline results/old.json]
+# Every benchmark reports the min/median wall time and the peak memory (tracemalloc).
+# Results are stored as JSON and can be compared against a baseline run.
+################################################
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert( 0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+import peakfinder_utils as pfu
+import peakfinder_models as pfm
+import peakfinder_io as pfio
+import peakfinder_gen as pfg
+
+NSAMP = 30
+ORB_SIZE = 3564
+ORB_EXCESS = 3672
+RAW_ORB_SIZE = ORB_SIZE * NSAMP + ORB_EXCESS
+
+def make_dataset( directory, n_orbits, occupancy=0.02, seed=0, chunk=16 ):
+  """
+  Synthetic raw data file (uBCM .bin layout, see pfg.OrbitGenerator) of n_orbits with noise on a 128 baseline
+  and pulses in <occupancy> of the bx, plus the true pulses written as csv and .h5 results files.
+  Returns the file names.
+  """
+  generator = pfg.OrbitGenerator( occupancy=occupancy, amplitude=("uniform", 10, 120), noise=1.5, NSAMP=NSAMP, orb_size=ORB_SIZE, seed=seed )
+  raw_file = os.path.join( directory, "raw_%d.bin" % n_orbits )
+  pulses = pfu.PulseStore()
+  excess = None
+  with open( raw_file, "wb" ) as f:
+    for orbits, truth in generator.chunks( n_orbits, chunk ):
+      if excess is None or len(excess) != len(orbits):
+        excess = np.full( (len(orbits), ORB_EXCESS), 128, dtype=np.uint8 )
+      f.write( np.hstack([orbits, excess]).tobytes() )
+      pulses.extend( pfg.truth_pulses(truth) )
+  pulse_file = os.path.join( directory, "pulses_%d" % n_orbits )
+  pfu.write_pulses( pulse_file, pulses )
+  h5_file = pfio.write_results( pulse_file, pulses )
+  return raw_file, pulse_file + ".csv", h5_file
+
+def measure( fn, repeat=3 ):
+  """
+  Wall times of <repeat> calls and the peak traced memory of one more call.
+  """
+  times = []
+  for i in range( repeat ):
+    t_start = time.perf_counter()
+    fn()
+    times.append( time.perf_counter() - t_start )
+  tracemalloc.start()
+  fn()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return { "min": min(times), "median": float(np.median(times)), "peak_mem": peak, "repeat": repeat }
+
+def cold( fn ):
+  """
+  fn with the parsed pulse cache cleared, i.e. the first read of a file (see pfu.load_pulses).
+  Every path that takes a pulse file is timed cold, a warm call only measures the cache lookup.
+  """
+  def run():
+    pfu._pulse_cache.clear()
+    return fn()
+  return run
+
+def benchmarks( raw_file, pulse_csv, pulse_h5, n_orbits, workdir ):
+  """
+  name -> function of the benchmarked paths on one dataset.
+  """
+  raw = pfio.RawOrbitFile( raw_file, RAW_ORB_SIZE, ORB_EXCESS )
+  orbit = np.array( raw[0] )
+  batch = np.array( raw[:min(n_orbits, 16)] )
+  parallel = pfm.ParallelAnalyzerModel()
+  derivative = pfm.DerivativePeakfinderModel()
+  derivative.write( "val_thr", 40 )
+  return [
+    ( "raw_scan", lambda: [ int(data.max()) for data in pfio.RawOrbitFile(raw_file, RAW_ORB_SIZE, ORB_EXCESS) ] ),
+    ( "orbit_source_prefetch", lambda: sum( 1 for data in pfio.PrefetchOrbitSource(pfio.UbcmOrbitSource(raw_file, RAW_ORB_SIZE, ORB_EXCESS)) ) ),
+    ( "snrd_orbit", lambda: pfu.snrd(orbit, 7, fixed_point=True) ),
+    ( "snrd_all_orbits", lambda: [ pfu.snrd(raw[first:first + 64], 7, fixed_point=True) for first in range(0, n_orbits, 64) ] ),
+    ( "read_pulses_csv", cold(lambda: pfu.read_pulses(pulse_csv)) ),
+    ( "read_pulses_h5", cold(lambda: pfu.read_pulses(pulse_h5)) ),
+    ( "histograms", cold(lambda: pfu.histograms(pulse_csv)) ),
+    ( "occ_amp_pos_hist", cold(lambda: (pfu.occ_hist(pulse_csv), pfu.amp_hist(pulse_csv, 8), pfu.pos_hist(pulse_csv))) ),
+    ( "bx_amp_hist", cold(lambda: pfu.bx_amp_hist(pulse_csv, nbit=8)) ),
+    ( "recon_batch", cold(lambda: pfu.recon(raw_file, pfu.load_pulses(pulse_csv), RAW_ORB_SIZE, orbits=range(1, min(n_orbits, 4) + 1), out_dir=os.path.join(workdir, "recon"), processes=1)) ),
+    ( "parallel_model", lambda: parallel.process(batch) ),
+    ( "derivative_model", lambda: derivative.process(batch) ),
+  ]
+
+def compare( results, baseline, tolerance ):
+  """
+  Print the median time ratios to the baseline, returns the benchmarks slower than <tolerance> x baseline.
+  """
+  regressions = []
+  print( "\n%-40s %12s %12s %8s" % ("benchmark", "baseline [s]", "now [s]", "ratio") )
+  for name, result in results.items():
+    if name not in baseline:
+      continue
+    ratio = result["median"] / max( baseline[name]["median"], 1e-12 )
+    flag = ""
+    if ratio > tolerance:
+      regressions.append( name )
+      flag = pfu.string_color( " REGRESSION", "red" )
+    print( "%-40s %12.4f %12.4f %8.2f%s" % (name, baseline[name]["median"], result["median"], ratio, flag) )
+  return regressions
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser( description="Benchmarks of the analysis and model hot paths on synthetic orbit data." )
+  parser.add_argument( "--orbits", type=int, nargs="+", default=[1, 10, 100], help="dataset sizes (orbits)" )
+  parser.add_argument( "--repeat", type=int, default=3 )
+  parser.add_argument( "--only", nargs="+", default=None, help="benchmark names to run" )
+  parser.add_argument( "--out", default=None, help="results JSON (benchmarks/results/<date>.json by default)" )
+  parser.add_argument( "--baseline", default=None, help="results JSON of an earlier run to compare with" )
+  parser.add_argument( "--tolerance", type=float, default=1.25, help="slowdown ratio reported as regression" )
+  args = parser.parse_args()
+  workdir = tempfile.mkdtemp( prefix="pf_bench_" )
+  results = {}
+  try:
+    for n_orbits in args.orbits:
+      t_start = time.perf_counter()
+      files = make_dataset( workdir, n_orbits )
+      print( "Dataset of %d orbits generated in %.1f s" % (n_orbits, time.perf_counter() - t_start) )
+      for name, fn in benchmarks( *(files + (n_orbits, workdir)) ):
+        if args.only is not None and name not in args.only:
+          continue
+        key = "%s[%d]" % (name, n_orbits)
+        results[key] = measure( fn, args.repeat )
+        print( "%-40s %10.4f s (min %.4f s) %10.1f MB peak" % (key, results[key]["median"], results[key]["min"], results[key]["peak_mem"] / 1e6) )
+  finally:
+    shutil.rmtree( workdir, ignore_errors=True )
+  out = args.out or os.path.join( os.path.dirname(os.path.abspath(__file__)), "results", time.strftime("%Y%m%d_%H%M%S") + ".json" )
+  if not os.path.isdir( os.path.dirname(os.path.abspath(out)) ):
+    os.makedirs( os.path.dirname(os.path.abspath(out)) )
+  machine = { "platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count(), "python": platform.python_version(), "numpy": np.__version__ }
+  with open( out, "w" ) as f:
+    json.dump( {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "machine": machine, "results": results}, f, indent=2 )
+  print( "Results saved to " + out )
+  if args.baseline is not None:
+    with open( args.baseline ) as f:
+      regressions = compare( results, json.load(f)["results"], args.tolerance )
+    sys.exit( 1 if regressions else 0 )
@@ -0,0 +1,59 @@
+################################################
+# Cold-start import time of the testbench and the analysis tooling.
+# Every measurement runs in a fresh interpreter:
+#   python benchmarks/bench_imports.py [--repeat N]
+################################################
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+TB_DIR = os.path.dirname( os.path.dirname(os.path.abspath(__file__)) )
+
+# name -> statements timed in a fresh interpreter
+SCENARIOS = [
+  ( "simulator", "import peakfinder_test" ),
+  ( "models", "import peakfinder_models" ),
+  ( "sweep", "import peakfinder_sweep" ),
+  ( "results (HDF5)", "import peakfinder_io as pfio; import tables" ),
+  ( "analysis (plotting)", "import peakfinder_utils as pfu; pfu.pyplot()" ),
+]
+
+# modules reported as loaded (or not) after each scenario
+HEAVY_MODULES = [ "matplotlib", "matplotlib.pyplot", "tables", "cocotb" ]
+
+PROBE = """
+import json, sys, time
+t_start = time.time()
+exec(%r)
+t = time.time() - t_start
+print(json.dumps({"time": t, "loaded": [name for name in %r if name in sys.modules]}))
+"""
+
+def measure( statements, repeat=5 ):
+  """
+  Import time of <statements> in <repeat> fresh interpreters: returns the median time and the heavy modules loaded.
+  """
+  env = dict( os.environ )
+  env["PYTHONPATH"] = TB_DIR + os.pathsep + env.get( "PYTHONPATH", "" )
+  times = []
+  loaded = []
+  for i in range( repeat ):
+    out = subprocess.check_output( [sys.executable, "-c", PROBE % (statements, HEAVY_MODULES)], cwd=TB_DIR, env=env )
+    result = json.loads( out.decode().strip().splitlines()[-1] )
+    times.append( result["time"] )
+    loaded = result["loaded"]
+  return sorted( times )[len(times) // 2], loaded
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser( description="Cold-start import time of the testbench and the analysis tooling." )
+  parser.add_argument( "--repeat", type=int, default=5 )
+  args = parser.parse_args()
+  print( "%-22s %10s   %s" % ("scenario", "time [ms]", "heavy modules loaded") )
+  for name, statements in SCENARIOS:
+    try:
+      t, loaded = measure( statements, args.repeat )
+      print( "%-22s %10.1f   %s" % (name, 1000 * t, ", ".join(loaded) or "-") )
+    except subprocess.CalledProcessError:
+      print( "%-22s %10s   %s" % (name, "failed", statements) )
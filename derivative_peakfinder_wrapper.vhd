@@ -12,13 +12,18 @@ entity derivative_peakfinder_wrapper is
   generic(
     NSAMPLES : natural := 30;
     NPEAKSMAX : natural := 3;
-    NBINS : natural := 6
+    NBINS : natural := 6;
+    SAMPLE_WIDTH : natural := 8
   );
   port(
     clk : in std_logic; -- bunch clk
     clk80 : in std_logic;
     rst : in std_logic;
     samples : in sample_array_t( 0 to NSAMPLES - 1 );
+    -- flattened samples, sample i in bits (i+1)*SAMPLE_WIDTH-1 downto i*SAMPLE_WIDTH,
+    -- used instead of samples when samples_flat_en = '1' (one testbench write per bx)
+    samples_flat : in std_logic_vector( NSAMPLES * SAMPLE_WIDTH - 1 downto 0 ) := (others => '0');
+    samples_flat_en : in std_logic := '0';
     peaks : out std_logic_vector( 0 to NPEAKSMAX - 1 );
     peaks_val : out uint12_array_t( 0 to NPEAKSMAX - 1 );
     peaks_pos : out uint16_array_t( 0 to NPEAKSMAX - 1 );
@@ -34,6 +39,7 @@ end derivative_peakfinder_wrapper;
 architecture rtl of derivative_peakfinder_wrapper is
 
     signal ipb_mosi_buf         : ipb_wbus;
+    signal samples_int          : sample_array_t( 0 to NSAMPLES - 1 );
     
 begin
 
@@ -48,7 +54,7 @@ begin
         clk             => clk,
         clk80   => clk80,
         rst     => rst,
-        samples => samples,
+        samples => samples_int,
         peaks   => peaks,
         peaks_val   => peaks_val,
         peaks_pos   => peaks_pos,
@@ -60,6 +66,11 @@ begin
         ipb_miso_o  => ipb_miso_o
     );
 
+   -- stimulus select: per sample array or flattened vector
+   samples_gen : for i in 0 to NSAMPLES - 1 generate
+       samples_int(i) <= samples_flat( (i + 1) * SAMPLE_WIDTH - 1 downto i * SAMPLE_WIDTH ) when samples_flat_en = '1' else samples(i);
+   end generate;
+
    -- needed for the riviera - it does not like records
    ipb_mosi_buf <= ipb_mosi_i when rising_edge(ipb_clk);
 
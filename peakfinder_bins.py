@@ -0,0 +1,133 @@
+################################################
+# Sub-bx bins of the derivative peak finder: bin LUT registers and bx x bin occupancy.
+################################################
+import numpy as np
+import peakfinder_utils as pfu
+
+# Bin LUT registers: 10 entries of 3 bits per 32-bit register
+LUT_ENTRY_BITS = 3
+LUT_ENTRIES_PER_REG = 10
+LUT_REGS = ( "bin_LUT_0", "bin_LUT_1", "bin_LUT_2" )
+
+def bin_lut( NSAMP=30, NBINS=6 ):
+  """
+  Default sample position -> sub-bx bin mapping (equally sized bins).
+  """
+  if not 0 < NBINS <= 2**LUT_ENTRY_BITS:
+    raise ValueError("NBINS has to be 1 ... " + str(2**LUT_ENTRY_BITS))
+  return ( np.arange(NSAMP) * NBINS ) // NSAMP
+
+def encode_bin_lut( lut ):
+  """
+  Pack a position -> bin list into the bin_LUT_* register values.
+  """
+  lut = np.asarray( lut, dtype=np.int64 )
+  if lut.min() < 0 or lut.max() >= 2**LUT_ENTRY_BITS:
+    raise ValueError("LUT entries have to be 0 ... " + str(2**LUT_ENTRY_BITS - 1))
+  n_regs = -(-len(lut) // LUT_ENTRIES_PER_REG)
+  entries = np.zeros( n_regs * LUT_ENTRIES_PER_REG, dtype=np.int64 )
+  entries[:len(lut)] = lut
+  shifts = LUT_ENTRY_BITS * np.arange( LUT_ENTRIES_PER_REG )
+  return [ int(reg) for reg in (entries.reshape(n_regs, LUT_ENTRIES_PER_REG) << shifts).sum(axis=1) ]
+
+def decode_bin_lut( regs, NSAMP=30 ):
+  """
+  Unpack the bin_LUT_* register values into a position -> bin array.
+  """
+  regs = np.asarray( regs, dtype=np.int64 )
+  positions = np.arange( NSAMP )
+  return ( regs[positions // LUT_ENTRIES_PER_REG] >> LUT_ENTRY_BITS * (positions % LUT_ENTRIES_PER_REG) ) & ((1 << LUT_ENTRY_BITS) - 1)
+
+def position_bins( position, lut ):
+  """
+  Bins of an array of peak positions (peaks_pos).
+  """
+  return np.asarray( lut )[ np.asarray(position) ]
+
+def decode_bins_word( words, NBINS=6 ):
+  """
+  peaks_bins output words (bit b set = a peak in bin b) as a bool matrix (words x NBINS).
+  """
+  return ( (np.asarray(words, dtype=np.int64)[:, None] >> np.arange(NBINS)) & 1 ).astype( bool )
+
+class BinOccupancy( pfu.Accumulator ):
+  """
+  Occupancy per bx and sub-bx bin (orb_size x NBINS counts), accumulated over orbits.
+  As in the peaks_bins output, a bin counts once per bx however many peaks of that bx fall into it.
+  Occupancies of separate channels or runs are merged by addition (o1 + o2, o1 += o2, merge).
+  lut: position -> bin mapping of the bin_LUT_* registers, equally sized bins by default
+  orbits: number of orbits accumulated so far
+  """
+  def __init__( self, NBINS=6, orb_size=3564, lut=None, NSAMP=30 ):
+    self.NBINS = NBINS
+    self.orb_size = orb_size
+    self.lut = np.asarray( lut if lut is not None else bin_lut(NSAMP, NBINS) )
+    self.counts = np.zeros( (orb_size, NBINS), dtype=np.int64 )
+    self.orbits = 0
+
+  def fill_bins( self, orbit, bx, bins ):
+    """
+    Add peaks given as orbit, bx and bin arrays, repeated bins of an (orbit, bx) count once.
+    Raises ValueError for bx or bins out of range.
+    """
+    bx = np.asarray( bx, dtype=np.int64 )
+    bins = np.asarray( bins, dtype=np.int64 )
+    if len(bx) > 0 and (bx.min() < 0 or bx.max() >= self.orb_size or bins.min() < 0 or bins.max() >= self.NBINS):
+      raise ValueError("Peaks out of range: bx " + str(bx.min()) + " ... " + str(bx.max()) + ", bins " + str(bins.min()) + " ... " + str(bins.max()))
+    key = ( np.asarray(orbit, dtype=np.int64) * self.orb_size + bx ) * self.NBINS + bins
+    key = np.unique( key )
+    np.add.at( self.counts, ((key // self.NBINS) % self.orb_size, key % self.NBINS), 1 )
+
+  def fill_pulses( self, pulses ):
+    """
+    Add a PulseStore or PULSE_DTYPE array of derivative_peakfinder pulses (position = peaks_pos).
+    """
+    data = pulses.array if isinstance( pulses, pfu.PulseStore ) else pulses
+    self.fill_bins( data["orbit"], data["bx"], position_bins(data["position"], self.lut) )
+
+  def fill_peaks( self, peaks ):
+    """
+    Add the peaks of DerivativePeakfinderModel.process (bin column).
+    """
+    self.fill_bins( peaks["orbit"], peaks["bx"], peaks["bin"] )
+
+  def fill_words( self, bx, words ):
+    """
+    Add peaks_bins output words of the DUT, one per (orbit, bx) with peaks.
+    """
+    hits = decode_bins_word( words, self.NBINS )
+    for b in range( self.NBINS ):
+      self.counts[:, b] += np.bincount( np.asarray(bx)[hits[:, b]], minlength=self.orb_size )[:self.orb_size]
+
+  def per_bin( self ):
+    """
+    Occupancy summed over all bx, per bin.
+    """
+    return self.counts.sum( axis=0 )
+
+  def rate( self ):
+    """
+    Mean occupancy per orbit (orb_size x NBINS).
+    """
+    return self.counts / float( max(self.orbits, 1) )
+
+  def __iadd__( self, other ):
+    if self.counts.shape != other.counts.shape or not np.array_equal( self.lut, other.lut ):
+      raise ValueError("Bin occupancies with different bx, bins or LUT")
+    self.counts += other.counts
+    self.orbits += other.orbits
+    return self
+
+  def empty( self ):
+    return BinOccupancy( self.NBINS, self.orb_size, self.lut )
+
+  def arrays( self ):
+    return { "counts": self.counts, "lut": self.lut }
+
+  @classmethod
+  def load( cls, filename ):
+    data = np.load( filename )
+    occupancy = cls( data["counts"].shape[1], data["counts"].shape[0], data["lut"] )
+    occupancy.counts[:] = data["counts"]
+    occupancy.orbits = int( data["orbits"] )
+    return occupancy
@@ -0,0 +1,187 @@
+################################################
+# Synthetic orbits with known pulses (ground truth) for peak finder studies.
+################################################
+import numpy as np
+import peakfinder_utils as pfu
+import peakfinder_io as pfio
+
+# Ground truth of generated pulses:
+#   orbit, bx and position (sample within the bx) of the pulse maximum,
+#   amplitude above the baseline, start (first sample within the orbit),
+#   pileup (second pulse of a pile-up pair)
+TRUTH_DTYPE = np.dtype( [("orbit", np.int64), ("bx", np.int32), ("position", np.int32), ("amplitude", np.int32), ("start", np.int64), ("pileup", bool)] )
+
+class PulseShape( object ):
+  """
+  Pulse template relative to the baseline, maximum normalized to 1:
+    - linear rise over <rise_width> samples (the sample after the last rise sample is the maximum - 1 step)
+    - linear fall over fall_rise_ratio * rise_width samples,
+      or with tail_tau an exponential tail exp(-t/tail_tau), cut after <tail_length> samples
+  With amplitude = rise_step * rise_width the default shape is the classic testbench sweep pulse
+  (rise by rise_step per sample, fall by rise_step / fall_rise_ratio per sample).
+  """
+  def __init__( self, rise_width=8, fall_rise_ratio=4, tail_tau=None, tail_length=None ):
+    self.rise_width = rise_width
+    self.fall_rise_ratio = fall_rise_ratio
+    self.tail_tau = tail_tau
+    self.tail_length = tail_length
+
+  @property
+  def peak( self ):
+    """
+    Sample of the maximum within the template.
+    """
+    return self.rise_width - 1
+
+  def template( self ):
+    rise = np.arange( 1, self.rise_width + 1 ) / float( self.rise_width )
+    if self.tail_tau is None:
+      fall_width = self.fall_rise_ratio * self.rise_width
+      fall = 1. - np.arange( 1, fall_width + 1 ) / float( fall_width )
+    else:
+      tail_length = self.tail_length if self.tail_length is not None else int( np.ceil(5 * self.tail_tau) )
+      fall = np.exp( -np.arange(1, tail_length + 1) / float(self.tail_tau) )
+    return np.concatenate( [rise, fall] )
+
+class OrbitGenerator( object ):
+  """
+  Batches of synthetic orbits (orb_size * NSAMP samples) with pulses on a noisy baseline,
+  together with their ground truth (TRUTH_DTYPE table).
+    occupancy: probability of a pulse per bx (ignored if bx is given)
+    bx: fixed list of bx with a pulse in every orbit
+    amplitude: pulse height above the baseline, a constant, ("uniform", lo, hi), ("gauss", mean, sigma),
+      ("exp", scale) or a function (rng, n) -> amplitudes
+    position: first sample of the pulse relative to the start of its bx, None (uniform over the bx),
+      a constant or a function (rng, orbit, n) -> offsets
+    pileup: probability of a second pulse <pileup_delay> (lo, hi) samples after a pulse
+    noise: sigma of the gaussian baseline noise
+  Orbit <n> is always generated from the same random stream (seed, n), independent of the batching,
+  so runs can be split or resumed at any orbit. Samples are rounded and clipped to nbits.
+  Pulses starting near the end of an orbit are cut there; if their maximum falls past the orbit end
+  they are not part of the truth (it is not in the generated samples).
+  """
+  def __init__( self, shape=None, occupancy=0.01, bx=None, amplitude=32, position=None, pileup=0., pileup_delay=(5, 30),
+                noise=0., baseline=128, NSAMP=30, orb_size=3564, nbits=8, seed=0 ):
+    self.shape = shape if shape is not None else PulseShape()
+    self.occupancy = occupancy
+    self.bx = bx
+    self.amplitude = amplitude
+    self.position = position
+    self.pileup = pileup
+    self.pileup_delay = pileup_delay
+    self.noise = noise
+    self.baseline = baseline
+    self.NSAMP = NSAMP
+    self.orb_size = orb_size
+    self.nbits = nbits
+    self.seed = seed
+    self.dtype = np.uint8 if nbits <= 8 else np.uint16
+
+  def _amplitudes( self, rng, n ):
+    if callable( self.amplitude ):
+      return np.asarray( self.amplitude(rng, n), dtype=np.float64 )
+    if not isinstance( self.amplitude, tuple ):
+      return np.full( n, float(self.amplitude) )
+    kind = self.amplitude[0]
+    if kind == "uniform":
+      return rng.uniform( self.amplitude[1], self.amplitude[2], n )
+    if kind == "gauss":
+      return rng.normal( self.amplitude[1], self.amplitude[2], n )
+    if kind == "exp":
+      return rng.exponential( self.amplitude[1], n )
+    raise ValueError( "Unknown amplitude distribution: " + str(kind) )
+
+  def _offsets( self, rng, orbit, n ):
+    if self.position is None:
+      return rng.randint( 0, self.NSAMP, n )
+    if callable( self.position ):
+      return np.asarray( self.position(rng, orbit, n), dtype=np.int64 )
+    return np.full( n, int(self.position), dtype=np.int64 )
+
+  def orbit_pulses( self, orbit ):
+    """
+    Ground truth (TRUTH_DTYPE) of one orbit, the pulse placement only.
+    """
+    rng = np.random.RandomState( [self.seed, orbit] )
+    if self.bx is not None:
+      bx = np.asarray( self.bx, dtype=np.int64 )
+    else:
+      bx = np.nonzero( rng.random_sample(self.orb_size) < self.occupancy )[0]
+    start = bx * self.NSAMP + self._offsets( rng, orbit, len(bx) )
+    amplitude = self._amplitudes( rng, len(bx) )
+    pileup = np.zeros( len(bx), dtype=bool )
+    if self.pileup > 0 and len(bx) > 0:
+      second = np.nonzero( rng.random_sample(len(bx)) < self.pileup )[0]
+      start = np.concatenate( [start, start[second] + rng.randint(self.pileup_delay[0], self.pileup_delay[1] + 1, len(second))] )
+      amplitude = np.concatenate( [amplitude, self._amplitudes(rng, len(second))] )
+      pileup = np.concatenate( [pileup, np.ones(len(second), dtype=bool)] )
+    order = np.argsort( start, kind="mergesort" )
+    peak = start[order] + self.shape.peak
+    truth = np.zeros( len(order), dtype=TRUTH_DTYPE )
+    truth["orbit"] = orbit
+    truth["bx"] = peak // self.NSAMP
+    truth["position"] = peak % self.NSAMP
+    truth["amplitude"] = np.round( np.maximum(amplitude[order], 0) )
+    truth["start"] = start[order]
+    truth["pileup"] = pileup[order]
+    return truth, rng
+
+  def generate( self, n_orbits, first_orbit=1 ):
+    """
+    Orbits first_orbit ... first_orbit + n_orbits - 1 as a 2-D array (orbits x samples) and their truth.
+    """
+    orbit_len = self.orb_size * self.NSAMP
+    template = self.shape.template()
+    data = np.empty( (n_orbits, orbit_len), dtype=np.float64 )
+    truths = []
+    for row in range( n_orbits ):
+      truth, rng = self.orbit_pulses( first_orbit + row )
+      data[row] = self.baseline
+      if self.noise > 0:
+        data[row] += rng.normal( 0., self.noise, orbit_len )
+      truths.append( truth )
+    truth = np.concatenate( truths ) if len(truths) > 0 else np.zeros( 0, dtype=TRUTH_DTYPE )
+    # all pulses of the batch at once, overlapping pulses add up, tails are cut at the end of the orbit
+    idx = truth["start"][:, None] + np.arange( len(template) )
+    inside = (idx >= 0) & (idx < orbit_len)
+    rows = np.broadcast_to( (truth["orbit"] - first_orbit)[:, None], idx.shape )
+    values = truth["amplitude"][:, None] * template
+    data += np.bincount( (rows * orbit_len + idx)[inside], weights=values[inside], minlength=data.size ).reshape( data.shape )
+    truth = truth[ truth["bx"] < self.orb_size ]
+    return np.clip( np.round(data), 0, 2**self.nbits - 1 ).astype( self.dtype ), truth
+
+  def chunks( self, n_orbits, chunk=16, first_orbit=1 ):
+    """
+    generate() in batches of <chunk> orbits, memory is bounded by one batch.
+    """
+    for first in range( first_orbit, first_orbit + n_orbits, chunk ):
+      yield self.generate( min(chunk, first_orbit + n_orbits - first), first )
+
+  def source( self, n_orbits, start=0, chunk=16, truth=None ):
+    return GeneratorOrbitSource( self, n_orbits, start, chunk, truth )
+
+def truth_pulses( truth, baseline=128 ):
+  """
+  pfu.PulseStore of the ground truth, amplitudes as sample values (baseline + height) like the parallel_analyzer reports them.
+  """
+  return pfu.PulseStore.from_columns( orbit=truth["orbit"], bx=truth["bx"], amplitude=truth["amplitude"] + baseline, position=truth["position"] )
+
+class GeneratorOrbitSource( pfio.OrbitSource ):
+  """
+  Orbit source of an OrbitGenerator: orbit indices start ... n_orbits - 1 (orbit numbers start + 1 ...),
+  generated in batches of <chunk> orbits. The truth of the generated orbits is appended
+  to <truth> (a pfu.ChunkedStore of TRUTH_DTYPE) if given.
+  """
+  def __init__( self, generator, n_orbits, start=0, chunk=16, truth=None ):
+    self.generator = generator
+    self.n_orbits = n_orbits
+    self.start = start
+    self.chunk = chunk
+    self.truth = truth
+
+  def __iter__( self ):
+    for orbits, truth in self.generator.chunks( self.n_orbits - self.start, self.chunk, self.start + 1 ):
+      if self.truth is not None:
+        self.truth.extend( truth )
+      for data in orbits:
+        yield data
@@ -0,0 +1,675 @@
+################################################
+# Input/output of raw orbit data for peak finder testbenches.
+################################################
+import os
+import time
+import hashlib
+import itertools
+import threading
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+import numpy as np
+import peakfinder_utils as pfu
+
+# uBCM raw data directory and file of a channel (e.g. "crate1.amc1_chA")
+UBCM_RAW_DATA_PATH = "/home/bril_firmware/Documents/peakfindertb/raw_data/"
+UBCM_RAW_FILE = "stable_1000orbits_bcm1f.%s.bin"
+
+# DAQ HDF5 raw data table and the algorithm id of raw orbit dumps
+DAQ_RAW_NODE = "/bcm1futcarawdata"
+DAQ_RAW_ALGOID = 100
+
+# Compression of binary result files (tables.Filters arguments)
+# PyTables is imported on first use only, simulations reading raw .bin files never load it.
+RESULTS_FILTERS = dict( complevel=5, complib="zlib", shuffle=True )
+
+class RawOrbitFile( object ):
+  """
+  Orbit-indexed reader of uBCM raw data (.bin) files, built on np.memmap.
+  Every raw orbit is raw_orb_size bytes long, the last orb_excess samples of each orbit are trimmed.
+  raw[i] returns orbit i (0-based, i.e. orb_cnt - 1) and raw[i:j] a range of orbits,
+  both as zero-copy uint8 views; data is only read from disk when accessed.
+  An incomplete orbit at the end of the file is ignored.
+  """
+  def __init__( self, filename, raw_orb_size=(3564*30)+3672, orb_excess=3672 ):
+    self.filename = filename
+    self.raw_orb_size = raw_orb_size
+    self.orb_excess = orb_excess
+    self.n_orbits = os.path.getsize( filename ) // raw_orb_size
+    if self.n_orbits > 0:
+      self._raw = np.memmap( filename, dtype=np.uint8, mode="r", shape=(self.n_orbits, raw_orb_size) )
+    else:
+      self._raw = np.zeros( (0, raw_orb_size), dtype=np.uint8 )
+    self._orbits = self._raw[:, :raw_orb_size - orb_excess]
+
+  def __len__( self ):
+    return self.n_orbits
+
+  def __getitem__( self, key ):
+    return self._orbits[key]
+
+  def __iter__( self ):
+    for i in range( self.n_orbits ):
+      yield self._orbits[i]
+
+def read_daq_input( filename="daq_input.dat" ):
+  """
+  Parse a DAQ request file: first line is the data directory,
+  every other (non-comment) line is <file>,<runnum>,<lsnum>,<nbnum>,<channelid>.
+  Returns the directory and a list of (file, runnum, lsnum, nbnum, channelid).
+  """
+  with open( filename, "r" ) as f:
+    lines = f.readlines()
+  daq_filepath = lines[0][:-2]
+  requests = []
+  for line in lines[1:]:
+    if line[0] == "#" or len(line.strip()) == 0:
+      continue
+    line_split = line.split(",")
+    requests.append( (line_split[0], int(line_split[1]), int(line_split[2]), int(line_split[3]), int(line_split[4])) )
+  return daq_filepath, requests
+
+class DaqOrbitCache( object ):
+  """
+  On-disk cache of orbits extracted from DAQ HDF5 files (in <daq_filepath>),
+  one .npy file per (file, runnum, lsnum, nbnum, channelid).
+  Entries are keyed on the absolute path of the DAQ file and are stale once the file is newer than the entry.
+  """
+  def __init__( self, cache_dir, daq_filepath="" ):
+    self.cache_dir = cache_dir
+    self.daq_filepath = daq_filepath
+
+  def source( self, request ):
+    return os.path.abspath( os.path.join(self.daq_filepath, request[0]) )
+
+  def path( self, request ):
+    source = self.source( request )
+    digest = hashlib.sha1( source.encode("utf-8") ).hexdigest()[:12]
+    return os.path.join( self.cache_dir, "%s_%s_%d_%d_%d_%d.npy" % ((os.path.basename(source), digest) + tuple(request[1:])) )
+
+  def load( self, request ):
+    path = self.path( request )
+    if not os.path.exists( path ):
+      return None
+    source = self.source( request )
+    if os.path.exists( source ) and os.path.getmtime( source ) > os.path.getmtime( path ):
+      return None
+    return np.load( path, mmap_mode="r" )
+
+  def save( self, request, data ):
+    if not os.path.isdir( self.cache_dir ):
+      os.makedirs( self.cache_dir )
+    # write aside and rename, so an interrupted run never leaves a truncated entry;
+    # the temporary file is per process, jobs sharing the cache may extract the same request at once
+    path = self.path( request )
+    tmp = "%s.%d.tmp.npy" % ( path, os.getpid() )
+    np.save( tmp, data )
+    os.rename( tmp, path )
+
+def _daq_key( runnum, lsnum, nbnum, channelid ):
+  """
+  (runnum, lsnum, nbnum, channelid) packed into one int64 (24, 16, 12 and 10 bits), scalars or arrays.
+  """
+  return ( ((np.int64(runnum) << 16 | lsnum) << 12 | nbnum) << 10 ) | channelid
+
+def query_daq_file( filepath, requests, orbit_len ):
+  """
+  Extract the raw orbits of several requests from one DAQ HDF5 file.
+  The in-kernel query only selects the raw rows of the requested run range, the exact requests are matched
+  on the key columns of these rows, and only the data of the matched rows is read.
+  Returns a dict request -> orbit (first <orbit_len> samples), requests without data are missing.
+  """
+  import tables
+  orbits = {}
+  wanted = dict( (int(_daq_key(*request[1:])), request) for request in requests )
+  with tables.open_file( filepath, "r" ) as h5file:
+    if DAQ_RAW_NODE not in h5file:
+      return orbits
+    table = h5file.get_node( DAQ_RAW_NODE )
+    runs = [ request[1] for request in requests ]
+    coords = table.get_where_list( "(algoid == %d) & (runnum >= %d) & (runnum <= %d)" % (DAQ_RAW_ALGOID, min(runs), max(runs)) )
+    if len(coords) == 0:
+      return orbits
+    columns = [ table.read_coordinates(coords, field=name).astype(np.int64) for name in ("runnum", "lsnum", "nbnum", "channelid") ]
+    keys = _daq_key( *columns )
+    # first row of every request, packed keys are checked against the full request tuple
+    rows = {}
+    for row in np.nonzero( np.isin(keys, list(wanted.keys())) )[0].tolist():
+      request = wanted[int(keys[row])]
+      if request not in rows and tuple( int(column[row]) for column in columns ) == tuple( request[1:] ):
+        rows[request] = row
+    found = list( rows.keys() )
+    if len(found) > 0:
+      data = table.read_coordinates( coords[[ rows[request] for request in found ]], field="data" )
+      for request, orbit in zip( found, data ):
+        orbits[request] = orbit[:orbit_len]
+  return orbits
+
+def extract_daq_orbits( daq_filepath, requests, orbit_len, cache_dir=None, missing=False ):
+  """
+  Extract the raw orbits of all requests (see read_daq_input), keeping their order.
+  Requests are grouped per file, so every HDF5 file is opened and queried once.
+  With cache_dir, extracted orbits are stored on disk and later runs skip HDF5 entirely.
+  Requests without data in their file are skipped, or with <missing> returned as None.
+  """
+  cache = DaqOrbitCache( cache_dir, daq_filepath ) if cache_dir is not None else None
+  orbits = {}
+  pending = {}
+  for request in requests:
+    data = cache.load( request ) if cache is not None else None
+    if data is not None:
+      orbits[request] = data[:orbit_len]
+    else:
+      pending.setdefault( request[0], [] ).append( request )
+  for filename, file_requests in pending.items():
+    extracted = query_daq_file( os.path.join(daq_filepath, filename), file_requests, orbit_len )
+    for request, data in extracted.items():
+      if cache is not None:
+        cache.save( request, data )
+      orbits[request] = data
+  if missing:
+    return [ orbits.get(request) for request in requests ]
+  return [ orbits[request] for request in requests if request in orbits ]
+
+# Zero-suppressed raw data (write_zs, ZsOrbitFile): per orbit the baseline and the bx windows with samples outside the baseline band.
+# /orbits: baseline, first window and number of windows per orbit, /windows: bx range and offset into /samples per window
+ZS_ORBIT_DTYPE = np.dtype( [("baseline", np.int32), ("window", np.int64), ("n_windows", np.int32)] )
+ZS_WINDOW_DTYPE = np.dtype( [("start_bx", np.int32), ("stop_bx", np.int32), ("offset", np.int64)] )
+
+def zs_windows( data, NSAMP=30, baseline=None, low=3, high=3, pre=1, post=1 ):
+  """
+  Zero suppression of one orbit: returns the baseline (most frequent sample value by default)
+  and the bx windows with samples below baseline - low or above baseline + high,
+  extended by <pre>/<post> bx (see pfu.bx_windows).
+  """
+  rows = np.asarray( data ).reshape( -1, NSAMP )
+  if baseline is None:
+    baseline = int( np.bincount(rows.ravel()).argmax() )
+  active = ( (rows < np.int64(baseline - low)) | (rows > np.int64(baseline + high)) ).any( axis=1 )
+  return baseline, pfu.bx_windows( active, pre, post )
+
+def write_zs( filename, orbits, NSAMP=30, baseline=None, low=3, high=3, pre=1, post=1, metadata=None, chunk=64 ):
+  """
+  Convert raw orbits (RawOrbitFile, an orbit source or a 2-D array) into a zero-suppressed HDF5 file:
+  only the windows of zs_windows are stored, samples within the baseline band outside of them are dropped
+  (they read back as the baseline). Missing orbits (None, see DaqOrbitSource) are skipped. The models see the same pulses as in the raw data if <high> is below
+  level_threshold - baseline (parallel_analyzer) and <pre>/<post> cover the derivative window.
+  Orbits are converted as they are read, <chunk> orbits are buffered.
+  Returns the file name.
+  """
+  import tables
+  filters = tables.Filters( **RESULTS_FILTERS )
+  with tables.open_file( filename, "w" ) as h5file:
+    orbit_table = h5file.create_table( "/", "orbits", description=ZS_ORBIT_DTYPE, filters=filters )
+    window_table = h5file.create_table( "/", "windows", description=ZS_WINDOW_DTYPE, filters=filters )
+    samples = None
+    orbit_len = 0
+    n_windows = 0
+    n_samples = 0
+    orbit_rows, window_rows, sample_blocks = [], [], []
+    end = object()
+    for data in itertools.chain( orbits, [end] ):
+      if data is None:
+        continue
+      if data is not end:
+        data = np.asarray( data )
+        if samples is None:
+          orbit_len = len( data )
+          samples = h5file.create_earray( "/", "samples", atom=tables.Atom.from_dtype(data.dtype), shape=(0,), filters=filters )
+        orbit_baseline, windows = zs_windows( data, NSAMP, baseline, low, high, pre, post )
+        orbit_rows.append( (orbit_baseline, n_windows, len(windows)) )
+        for start, stop in windows:
+          window_rows.append( (start, stop, n_samples) )
+          sample_blocks.append( data[start * NSAMP:stop * NSAMP] )
+          n_samples += (stop - start) * NSAMP
+        n_windows += len( windows )
+      if len(orbit_rows) == chunk or (data is end and len(orbit_rows) > 0):
+        orbit_table.append( np.array(orbit_rows, dtype=ZS_ORBIT_DTYPE) )
+        if len(window_rows) > 0:
+          window_table.append( np.array(window_rows, dtype=ZS_WINDOW_DTYPE) )
+          samples.append( np.concatenate(sample_blocks) )
+        orbit_rows, window_rows, sample_blocks = [], [], []
+    if samples is None:
+      samples = h5file.create_earray( "/", "samples", atom=tables.UInt8Atom(), shape=(0,), filters=filters )
+    attrs = h5file.root._v_attrs
+    attrs["NSAMP"] = NSAMP
+    attrs["orb_size"] = orbit_len // NSAMP
+    attrs["low"] = low
+    attrs["high"] = high
+    attrs["pre"] = pre
+    attrs["post"] = post
+    for key, value in (metadata or {}).items():
+      attrs[key] = value
+  return filename
+
+class ZsOrbitFile( object ):
+  """
+  Orbit-indexed reader of zero-suppressed raw data (see write_zs), used like RawOrbitFile:
+  zs[i] is orbit i expanded to dense samples (the baseline outside the stored windows), zs[i:j] a 2-D range.
+  Only the samples of the requested orbits are read from disk. Without expansion, windows(i) gives
+  the stored windows of an orbit, active(i) the stored bx and segments(start, stop) the windows
+  of an orbit range for the software models (see pfm.process_segments).
+  The samples are read through an open file handle, released by close() or a with block.
+  """
+  def __init__( self, filename ):
+    import tables
+    self.filename = filename
+    with tables.open_file( filename, "r" ) as h5file:
+      self.orbits = h5file.root.orbits.read()
+      self.windows_table = h5file.root.windows.read()
+      self.dtype = h5file.root.samples.dtype
+      attrs = h5file.root._v_attrs
+      self.NSAMP = int( attrs["NSAMP"] )
+      self.orb_size = int( attrs["orb_size"] )
+      self.pre = int( attrs["pre"] )
+      self.post = int( attrs["post"] )
+    self.n_orbits = len( self.orbits )
+    # samples are opened on first access, per process (readers can be shared with forked workers)
+    self._h5file = None
+    self._pid = None
+
+  def _samples( self, start, stop ):
+    if self._pid != os.getpid():
+      import tables
+      self._h5file = tables.open_file( self.filename, "r" )
+      self._pid = os.getpid()
+    return self._h5file.root.samples.read( start, stop )
+
+  def __len__( self ):
+    return self.n_orbits
+
+  def window_rows( self, i ):
+    """
+    ZS_WINDOW_DTYPE rows of orbit i.
+    """
+    orbit = self.orbits[i]
+    return self.windows_table[ orbit["window"]:orbit["window"] + orbit["n_windows"] ]
+
+  def windows( self, i ):
+    """
+    Baseline and stored windows of orbit i: list of (start_bx, stop_bx, samples (bx x NSAMP)).
+    """
+    rows = self.window_rows( i )
+    windows = []
+    if len(rows) > 0:
+      first = rows["offset"][0]
+      data = self._samples( first, rows["offset"][-1] + (rows["stop_bx"][-1] - rows["start_bx"][-1]) * self.NSAMP )
+      for start, stop, offset in rows.tolist():
+        windows.append( (start, stop, data[offset - first:offset - first + (stop - start) * self.NSAMP].reshape(-1, self.NSAMP)) )
+    return int( self.orbits[i]["baseline"] ), windows
+
+  def active( self, i ):
+    """
+    Mask of the active bx of orbit i: the stored windows without their <pre>/<post> bx.
+    """
+    active = np.zeros( self.orb_size, dtype=bool )
+    for start, stop, offset in self.window_rows( i ).tolist():
+      active[start + self.pre if start > 0 else 0:stop - self.post if stop < self.orb_size else stop] = True
+    return active
+
+  def _expand( self, i ):
+    baseline, windows = self.windows( i )
+    data = np.full( self.orb_size * self.NSAMP, baseline, dtype=self.dtype )
+    for start, stop, samples in windows:
+      data[start * self.NSAMP:stop * self.NSAMP] = samples.ravel()
+    return data
+
+  def __getitem__( self, key ):
+    if isinstance( key, slice ):
+      indices = range( *key.indices(self.n_orbits) )
+      if len(indices) == 0:
+        return np.zeros( (0, self.orb_size * self.NSAMP), dtype=self.dtype )
+      return np.stack( [ self._expand(i) for i in indices ] )
+    if key < 0:
+      key += self.n_orbits
+    if not 0 <= key < self.n_orbits:
+      raise IndexError( "orbit index out of range" )
+    return self._expand( key )
+
+  def __iter__( self ):
+    for i in range( self.n_orbits ):
+      yield self._expand( i )
+
+  def segments( self, start=0, stop=None, pad=1 ):
+    """
+    Windows of orbits start ... stop - 1 as rows of equal length, padded with <pad> baseline bx
+    before and after every window (and up to the longest window).
+    Returns orbit index and first bx of every row and the 2-D sample array (rows x samples).
+    """
+    stop = self.n_orbits if stop is None else min( stop, self.n_orbits )
+    orbit_idx, start_bx, rows = [], [], []
+    for i in range( start, stop ):
+      baseline, windows = self.windows( i )
+      for first, last, samples in windows:
+        orbit_idx.append( i )
+        start_bx.append( first - pad )
+        rows.append( (baseline, samples) )
+    width = max( [ len(samples) for baseline, samples in rows ] + [0] ) + 2 * pad
+    data = np.empty( (len(rows), width * self.NSAMP), dtype=self.dtype )
+    for r, (baseline, samples) in enumerate( rows ):
+      data[r] = baseline
+      data[r, pad * self.NSAMP:(pad + len(samples)) * self.NSAMP] = samples.ravel()
+    return np.array( orbit_idx, dtype=np.int64 ), np.array( start_bx, dtype=np.int64 ), data
+
+  def close( self ):
+    if self._h5file is not None and self._pid == os.getpid():
+      self._h5file.close()
+    self._h5file = None
+    self._pid = None
+
+  def __enter__( self ):
+    return self
+
+  def __exit__( self, *exc ):
+    self.close()
+
+class OrbitSource( object ):
+  """
+  Base class of orbit sources. Iterating a source yields orbits (1-D sample arrays) lazily,
+  so only the orbits currently in use are resident. close() releases open files of the source.
+  """
+  def __iter__( self ):
+    raise NotImplementedError
+
+  def close( self ):
+    pass
+
+class UbcmOrbitSource( OrbitSource ):
+  """
+  Orbits of a uBCM raw data (.bin) file, from orbit index <start> up to <stop>.
+  """
+  def __init__( self, filename, raw_orb_size=(3564*30)+3672, orb_excess=3672, start=0, stop=None ):
+    self.raw = RawOrbitFile( filename, raw_orb_size, orb_excess )
+    self.start = start
+    self.stop = stop
+
+  def __iter__( self ):
+    for i in range( self.start, len(self.raw) if self.stop is None else min(self.stop, len(self.raw)) ):
+      # copy, so the page reads happen in the producing (prefetch) thread
+      yield np.array( self.raw[i] )
+
+class DaqOrbitSource( OrbitSource ):
+  """
+  Orbits of DAQ HDF5 requests (see read_daq_input) from request index <start>, extracted through the local cache
+  in blocks of <chunk> requests (one query per file and block), so memory is bounded by one block.
+  A request without data yields None, orbit i of the source is always request start + i.
+  """
+  def __init__( self, daq_filepath, requests, orbit_len, cache_dir=None, start=0, chunk=64 ):
+    self.daq_filepath = daq_filepath
+    self.requests = requests[start:]
+    self.orbit_len = orbit_len
+    self.cache_dir = cache_dir
+    self.chunk = chunk
+
+  def __iter__( self ):
+    for first in range( 0, len(self.requests), self.chunk ):
+      for data in extract_daq_orbits( self.daq_filepath, self.requests[first:first + self.chunk], self.orbit_len, self.cache_dir, missing=True ):
+        yield None if data is None else np.array( data )
+
+class SyntheticOrbitSource( OrbitSource ):
+  """
+  Orbits made by make_orbit(i) for i in range(start, n_orbits).
+  """
+  def __init__( self, make_orbit, n_orbits, start=0 ):
+    self.make_orbit = make_orbit
+    self.n_orbits = n_orbits
+    self.start = start
+
+  def __iter__( self ):
+    for i in range( self.start, self.n_orbits ):
+      yield self.make_orbit( i )
+
+class ZsOrbitSource( OrbitSource ):
+  """
+  Dense orbits of a zero-suppressed file (see ZsOrbitFile), from orbit index <start> up to <stop>.
+  The reader is kept in <zs>, e.g. for the stored windows of an orbit.
+  """
+  def __init__( self, filename, start=0, stop=None ):
+    self.zs = ZsOrbitFile( filename )
+    self.start = start
+    self.stop = stop
+
+  def __iter__( self ):
+    for i in range( self.start, len(self.zs) if self.stop is None else min(self.stop, len(self.zs)) ):
+      yield self.zs[i]
+
+  def close( self ):
+    self.zs.close()
+
+class PrefetchOrbitSource( OrbitSource ):
+  """
+  Wraps an orbit source and reads/decodes the next <depth> orbits in a background thread,
+  while the consumer works on the current one. Memory is bounded by depth + 1 orbits.
+  """
+  _END = object()
+
+  def __init__( self, source, depth=4 ):
+    self.source = source
+    self.depth = depth
+    self._stop = threading.Event()
+    self._thread = None
+
+  def _put( self, orbits, item ):
+    # False once stopped, the consumer may be gone
+    while not self._stop.is_set():
+      try:
+        orbits.put( item, timeout=0.1 )
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _fill( self, orbits ):
+    try:
+      for data in self.source:
+        if not self._put( orbits, data ):
+          return
+      self._put( orbits, self._END )
+    except Exception as e:
+      self._put( orbits, e )
+
+  def __iter__( self ):
+    self._stop.clear()
+    orbits = queue.Queue( maxsize=self.depth )
+    thread = self._thread = threading.Thread( target=self._fill, args=(orbits,) )
+    thread.daemon = True
+    thread.start()
+    try:
+      while True:
+        data = orbits.get()
+        if data is self._END:
+          break
+        if isinstance( data, Exception ):
+          raise data
+        yield data
+    finally:
+      self._stop.set()
+
+  def close( self ):
+    """
+    Stop prefetching, e.g. when fewer orbits than available are needed,
+    and close the wrapped source once the background thread has finished.
+    """
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    self.source.close()
+
+def write_results( filename, pulses, waveforms=None, metadata=None ):
+  """
+  Binary results file (HDF5, compressed and chunked):
+    /pulses: pulse table (pfu.PULSE_DTYPE columns)
+    /waveforms/<type>: orbit, bx and int16 waveform matrix per waveform type (sample, derivative)
+    root attributes: run metadata (thresholds, input file, NSAMP, NBINS, ...)
+  pulses/waveforms can be stores or lists of pulse()/waveform() objects.
+  Returns the file name (.h5 is appended if missing).
+  """
+  if not filename.endswith(".h5"):
+    filename += ".h5"
+  if not isinstance( pulses, pfu.PulseStore ):
+    pulses = pfu.PulseStore( pulses )
+  import tables
+  filters = tables.Filters( **RESULTS_FILTERS )
+  with tables.open_file( filename, "w" ) as h5file:
+    h5file.create_table( "/", "pulses", obj=pulses.array, filters=filters, expectedrows=max(len(pulses), 1) )
+    if waveforms is not None:
+      if not isinstance( waveforms, pfu.WaveformStore ):
+        store = pfu.WaveformStore( len(waveforms[0].waveform) if len(waveforms) > 0 else 30 )
+        store.extend( waveforms )
+        waveforms = store
+      group = h5file.create_group( "/", "waveforms" )
+      group._v_attrs["width"] = waveforms.width
+      for wf_type, store in waveforms.stores.items():
+        h5file.create_table( group, wf_type, obj=store.array, filters=filters, expectedrows=max(len(store), 1) )
+    for key, value in (metadata or {}).items():
+      h5file.root._v_attrs[key] = value
+  return filename
+
+def read_results( filename ):
+  """
+  Read a binary results file (see write_results).
+  Returns (pfu.PulseStore, pfu.WaveformStore or None, metadata dict).
+  """
+  import tables
+  with tables.open_file( filename, "r" ) as h5file:
+    pulses = pfu.PulseStore( h5file.root.pulses.read() )
+    waveforms = None
+    if "/waveforms" in h5file:
+      group = h5file.get_node( "/waveforms" )
+      waveforms = pfu.WaveformStore( int(group._v_attrs["width"]) )
+      for table in group:
+        waveforms.stores[table.name] = pfu.ChunkedStore( table.dtype, table.read() )
+    attrs = h5file.root._v_attrs
+    metadata = dict( (key, attrs[key].item() if hasattr(attrs[key], "item") else attrs[key]) for key in attrs._v_attrnamesuser )
+  return pulses, waveforms, metadata
+
+class ResultsWriter( object ):
+  """
+  Binary results file (layout of write_results) written incrementally during a long run.
+  Blocks of pulses and waveforms are appended with append(), checkpoint() records the last completed orbit,
+  the input position (index of the next orbit in the orbit source), the table sizes and the run state
+  (/checkpoint attributes) and flushes the file. A crash loses at most the orbits since the last checkpoint.
+  close() stores the metadata and removes the checkpoint, the file is then the same as one of write_results.
+  With resume=True an existing file is reopened: the tables are cut back to the last checkpoint,
+  which is available in <state> (None for a new file or a file without checkpoint, which are started from scratch).
+  Waveforms are only stored with waveform_width.
+  """
+  def __init__( self, filename, waveform_width=None, resume=False ):
+    if not filename.endswith(".h5"):
+      filename += ".h5"
+    import tables
+    self.filename = filename
+    self.waveform_width = waveform_width
+    self.filters = tables.Filters( **RESULTS_FILTERS )
+    self.state = None
+    # rows in the pulse table
+    self.n_pulses = 0
+    if resume and os.path.exists( filename ):
+      self.h5file = tables.open_file( filename, "a" )
+      if "/checkpoint" in self.h5file:
+        self.state = self._read_state()
+        self._rollback()
+      else:
+        self.h5file.close()
+    if self.state is None:
+      self.h5file = tables.open_file( filename, "w" )
+      self.h5file.create_table( "/", "pulses", description=pfu.PULSE_DTYPE, filters=self.filters, expectedrows=100000 )
+      if waveform_width is not None:
+        group = self.h5file.create_group( "/", "waveforms" )
+        group._v_attrs["width"] = waveform_width
+
+  def _read_state( self ):
+    attrs = self.h5file.get_node( "/checkpoint" )._v_attrs
+    return dict( (key, attrs[key].item() if hasattr(attrs[key], "item") else attrs[key]) for key in attrs._v_attrnamesuser )
+
+  def _rollback( self ):
+    """
+    Drop rows appended after the checkpoint.
+    """
+    self.h5file.root.pulses.truncate( self.state["n_pulses"] )
+    self.n_pulses = self.state["n_pulses"]
+    if "/waveforms" in self.h5file:
+      for table in self.h5file.get_node( "/waveforms" ):
+        table.truncate( self.state.get("n_waveforms_" + table.name, 0) )
+    self.h5file.flush()
+
+  def append( self, pulses, waveforms=None ):
+    """
+    Append a block of pulses (PulseStore or PULSE_DTYPE array) and waveforms (pfu.WaveformStore).
+    """
+    data = pulses.array if isinstance( pulses, pfu.ChunkedStore ) else pulses
+    if len(data) > 0:
+      self.h5file.root.pulses.append( data )
+      self.n_pulses += len(data)
+    if waveforms is None or self.waveform_width is None:
+      return
+    group = self.h5file.get_node( "/waveforms" )
+    for wf_type, store in waveforms.stores.items():
+      if wf_type not in group:
+        self.h5file.create_table( group, wf_type, description=store.dtype, filters=self.filters, expectedrows=100000 )
+      if len(store) > 0:
+        self.h5file.get_node( group, wf_type ).append( store.array )
+
+  def checkpoint( self, orbit, input_position, **state ):
+    """
+    Record the last completed orbit and the input position with the current table sizes, flush to disk.
+    """
+    if "/checkpoint" not in self.h5file:
+      self.h5file.create_group( "/", "checkpoint" )
+    attrs = self.h5file.get_node( "/checkpoint" )._v_attrs
+    state.update( orbit=orbit, input_position=input_position, n_pulses=self.n_pulses, time=time.time() )
+    if "/waveforms" in self.h5file:
+      for table in self.h5file.get_node( "/waveforms" ):
+        state["n_waveforms_" + table.name] = table.nrows
+    for key, value in state.items():
+      attrs[key] = value
+    self.h5file.flush()
+    self.state = state
+
+  def iter_pulses( self, chunk=1000000 ):
+    """
+    Stored pulses in blocks of <chunk> rows (PULSE_DTYPE arrays).
+    """
+    table = self.h5file.root.pulses
+    for start in range( 0, table.nrows, chunk ):
+      yield table.read( start, min(start + chunk, table.nrows) )
+
+  def close( self, metadata=None ):
+    """
+    Store the run metadata and finish the file (the checkpoint is removed).
+    """
+    for key, value in (metadata or {}).items():
+      self.h5file.root._v_attrs[key] = value
+    if "/checkpoint" in self.h5file:
+      self.h5file.remove_node( "/checkpoint" )
+    self.h5file.close()
+    return self.filename
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser( description="Convert uBCM raw data (.bin) files or DAQ requests into zero-suppressed HDF5 files." )
+  parser.add_argument( "files", nargs="*", help="raw data .bin files" )
+  parser.add_argument( "--daq-input", default=None, help="DAQ request file (see read_daq_input), converted into daq_data.zs.h5" )
+  parser.add_argument( "--daq-cache", default=None, help="cache directory of extracted DAQ orbits" )
+  parser.add_argument( "--out-dir", default=None, help="directory of the .zs.h5 files (next to the input by default)" )
+  parser.add_argument( "--baseline", type=int, default=None, help="fixed baseline (most frequent value per orbit by default)" )
+  parser.add_argument( "--low", type=int, default=3, help="band below the baseline" )
+  parser.add_argument( "--high", type=int, default=3, help="band above the baseline" )
+  parser.add_argument( "--pre", type=int, default=1, help="bx stored before every window" )
+  parser.add_argument( "--post", type=int, default=1, help="bx stored after every window" )
+  args = parser.parse_args()
+  for filename in args.files:
+    out = os.path.splitext( filename )[0] + ".zs.h5"
+    if args.out_dir is not None:
+      out = os.path.join( args.out_dir, os.path.basename(out) )
+    raw = RawOrbitFile( filename )
+    write_zs( out, raw, baseline=args.baseline, low=args.low, high=args.high, pre=args.pre, post=args.post, metadata=dict(source=os.path.basename(filename)) )
+    print( "%s: %d orbits, %.1f MB -> %.1f MB" % (out, len(raw), os.path.getsize(filename) / 1e6, os.path.getsize(out) / 1e6) )
+  if args.daq_input is not None:
+    out = os.path.join( args.out_dir or ".", "daq_data.zs.h5" )
+    daq_filepath, requests = read_daq_input( args.daq_input )
+    write_zs( out, DaqOrbitSource(daq_filepath, requests, 3564 * 30, args.daq_cache), baseline=args.baseline, low=args.low, high=args.high, pre=args.pre, post=args.post, metadata=dict(source=os.path.basename(args.daq_input)) )
+    print( "%s: %d requests, %.1f MB" % (out, len(requests), os.path.getsize(out) / 1e6) )
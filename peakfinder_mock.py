@@ -0,0 +1,141 @@
+################################################
+# Mock DUT to check testbench stimulus code without a simulator.
+################################################
+import argparse
+import logging
+import numpy as np
+import peakfinder_test
+
+class MockHandle( object ):
+  """
+  Signal handle, counts the writes to its value.
+  """
+  def __init__( self, value=0 ):
+    self._value = value
+    self.writes = 0
+
+  @property
+  def value( self ):
+    return self._value
+
+  @value.setter
+  def value( self, value ):
+    self._value = value
+    self.writes += 1
+
+  def __int__( self ):
+    return int( self._value )
+
+class MockDUT( object ):
+  """
+  Stand-in for derivative_peakfinder_wrapper: generics, samples array and samples_flat ports.
+  samples_int() returns what the wrapper feeds into the peak finder.
+  """
+  def __init__( self, NSAMPLES=30, NBINS=6, NPEAKSMAX=3, SAMPLE_WIDTH=8 ):
+    self.NSAMPLES = MockHandle( NSAMPLES )
+    self.NBINS = MockHandle( NBINS )
+    self.NPEAKSMAX = MockHandle( NPEAKSMAX )
+    self.SAMPLE_WIDTH = MockHandle( SAMPLE_WIDTH )
+    self.samples = [ MockHandle(0) for i in range(NSAMPLES) ]
+    self.samples_flat = MockHandle( 0 )
+    self.samples_flat_en = MockHandle( 0 )
+    self._log = logging.getLogger( "mock_dut" )
+
+  def samples_int( self ):
+    n_samp = int( self.NSAMPLES )
+    width = int( self.SAMPLE_WIDTH )
+    if int( self.samples_flat_en ) == 1:
+      word = int( self.samples_flat )
+      return [ (word >> (i * width)) & ((1 << width) - 1) for i in range(n_samp) ]
+    return [ int(handle) for handle in self.samples ]
+
+def run_coroutine( coro, edge ):
+  """
+  Run a testbench coroutine without a simulator: nested coroutines are run in place,
+  edge() is called for every other trigger it yields (one clock).
+  """
+  gen = coro._coro if hasattr( coro, "_coro" ) else coro
+  value = None
+  while True:
+    try:
+      trigger = gen.send( value )
+    except StopIteration as stop:
+      return stop.value
+    value = run_coroutine( trigger, edge ) if hasattr( trigger, "_coro" ) else edge()
+
+def check_drive_samples( data, NSAMP=30, SAMPLE_WIDTH=8, mode="flat" ):
+  """
+  Feed an orbit with PeakfinderTB.drive_samples (and pack_samples in flat mode) on a mock DUT
+  and compare what reaches the peak finder on every clock with the orbit data.
+  Returns the list of mismatching bx.
+  """
+  dut = MockDUT( NSAMP, SAMPLE_WIDTH=SAMPLE_WIDTH )
+  tb = peakfinder_test.PeakfinderTB( dut )
+  tb.set_drive_mode( mode )
+  fed = []
+  run_coroutine( tb.drive_samples(MockHandle(0), dut.samples, data), lambda: fed.append(dut.samples_int()) )
+  rows = np.asarray( data ).astype( int ).reshape( -1, NSAMP ).tolist()
+  return [ bx for bx in range(len(rows)) if bx >= len(fed) or fed[bx] != rows[bx] ]
+
+def check_drive_equivalence( data, NSAMP=30 ):
+  """
+  Drive an orbit bx by bx through the per-element and the flat stimulus path of PeakfinderTB
+  on a mock DUT and compare what reaches the peak finder.
+  Returns the list of mismatching bx and the number of writes per path.
+  """
+  dut = MockDUT( NSAMP )
+  tb = peakfinder_test.PeakfinderTB( dut )
+  rows = np.asarray( data ).astype( int ).reshape( -1, NSAMP ).tolist()
+  words = tb.pack_samples( data )
+  mismatches = []
+  for bx in range( len(rows) ):
+    tb.set_drive_mode( "element" )
+    tb._drive_bx_element( rows[bx] )
+    element = dut.samples_int()
+    tb.set_drive_mode( "flat" )
+    tb._drive_bx_flat( words[bx] )
+    if dut.samples_int() != element:
+      mismatches.append( bx )
+  writes = { "element": sum( handle.writes for handle in dut.samples ), "flat": dut.samples_flat.writes }
+  return mismatches, writes
+
+# software model runs of peakfinder_test, run on a mock DUT without simulator
+MODEL_RUNS = {
+  "derivative_model": peakfinder_test.run_derivative_model,
+  "parallel_model": peakfinder_test.run_parallel_model,
+}
+
+def run_model( testcase, iter_max=None ):
+  """
+  Run a software model testcase on a MockDUT, parameters come from the PFTB_* variables as in the simulator.
+  """
+  dut = MockDUT()
+  return MODEL_RUNS[testcase]( dut ) if iter_max is None else MODEL_RUNS[testcase]( dut, iter_max )
+
+def check_stimulus():
+  """
+  Compare both stimulus paths on random and constant orbits, and drive_samples for several sample widths.
+  """
+  rng = np.random.RandomState( 0 )
+  for name, data in [ ("random", rng.randint(0, 256, 3564 * 30)), ("baseline", np.ones(3564 * 30) * 128) ]:
+    mismatches, writes = check_drive_equivalence( data )
+    print( name + ": " + str(len(mismatches)) + " mismatching bx, writes " + str(writes) )
+  for width in [ 8, 10, 12, 16 ]:
+    data = rng.randint( 0, 2**width, 3564 * 30 )
+    print( "drive_samples " + str(width) + " bit: " + ", ".join(mode + " " + str(len(check_drive_samples(data, SAMPLE_WIDTH=width, mode=mode))) for mode in ["element", "flat"]) + " mismatching bx" )
+  try:
+    check_drive_samples( np.full(3564 * 30, 256), SAMPLE_WIDTH=8 )
+    print( "drive_samples 8 bit: out of range samples not rejected" )
+  except ValueError as error:
+    print( "drive_samples 8 bit: " + str(error) )
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser( description="Check the testbench stimulus code, or run a software model testcase (PFTB_* parameters), without a simulator." )
+  parser.add_argument( "testcase", nargs="?", choices=sorted(MODEL_RUNS), help="model testcase to run instead of the stimulus checks" )
+  args = parser.parse_args()
+  if args.testcase is None:
+    check_stimulus()
+  else:
+    logging.basicConfig( level=logging.INFO )
+    tb = run_model( args.testcase )
+    print( args.testcase + ": " + str(len(tb.pulses)) + " pulses in " + str(tb.orb_cnt - 1 - tb.orbit_start) + " orbits, results in " + tb.results_dir )
@@ -0,0 +1,336 @@
+################################################
+# Software models of the peak finder firmware.
+################################################
+import copy
+import numpy as np
+import peakfinder_utils as pfu
+from peakfinder_bins import LUT_REGS, bin_lut, encode_bin_lut, decode_bin_lut
+# the LUT register layout moved to peakfinder_bins, re-exported for code using pfm.LUT_ENTRY_BITS / pfm.LUT_ENTRIES_PER_REG
+from peakfinder_bins import LUT_ENTRY_BITS, LUT_ENTRIES_PER_REG
+
+# IPbus register map of derivative_peakfinder.vhd: name -> (address, mask)
+DERIVATIVE_REG_MAP = {
+  "deriv_thr": (0x0, 0x00000FFF),
+  "top": (0x1, 0x0000000F),
+  "val_thr": (0x2, 0x00000FFF),
+  "bin_LUT_0": (0x3, 0xFFFFFFFF),
+  "bin_LUT_1": (0x4, 0xFFFFFFFF),
+  "bin_LUT_2": (0x5, 0xFFFFFFFF),
+}
+
+def shift_to_mask( mask, data ):
+  shift_val = 0
+  while (mask >> shift_val) & 0x1 == 0:
+    shift_val += 1
+  return (data << shift_val) & mask
+
+def shift_from_mask( mask, data ):
+  shift_val = 0
+  while (mask >> shift_val) & 0x1 == 0:
+    shift_val += 1
+  return (data & mask) >> shift_val
+
+def stamp_bx( orbit, bx, latency, orb_size=3564 ):
+  """
+  Orbit and bx a testbench producer registers for a peak of (orbit, bx): it stamps the bx counter
+  at detection, <latency> bx later, so peaks in the last bx of an orbit are stamped in the next one.
+  """
+  clock = np.asarray( orbit ) * orb_size + np.asarray( bx ) + latency
+  return clock // orb_size, clock % orb_size
+
+class DerivativePeakfinderModel( object ):
+  """
+  Bit-level software model of derivative_peakfinder.vhd, processing whole orbits in batch.
+  Per orbit:
+    - deriv: smooth noise-robust derivative (diff_m7, pfu.snrd fixed point)
+    - a peak candidate is a derivative zero crossing, deriv[n-1] > 0 and deriv[n] <= 0
+    - the positive derivative run before the crossing must contain at least <top> samples with deriv > deriv_thr
+    - peaks_val is the integrated derivative over that run (integrator), saturated to 12 bits,
+      and has to exceed val_thr
+    - peaks_pos is the sample position of the crossing within its bx
+    - at most NPEAKSMAX peaks per bx are reported (first come, first served),
+      peaks_bins has bit bin_LUT[peaks_pos] set for every reported peak
+  Thresholds and LUTs are set through write() with the same register names and masks as the firmware.
+  process() reports peaks in the bx of their samples; pulses() and waveforms() stamp them <bx_latency> bx later
+  (see stamp_bx), as derivative_producer does, so they compare directly with derivative_test results.
+  """
+
+  VAL_MAX = 0xFFF
+  PEAK_DTYPE = np.dtype( [("orbit", np.int64), ("bx", np.int64), ("slot", np.int64), ("val", np.int64), ("pos", np.int64), ("bin", np.int64)] )
+
+  def __init__( self, NSAMP=30, NPEAKSMAX=3, NBINS=6, orb_size=3564, nbits=12, chunk=64 ):
+    self.NSAMP = NSAMP
+    self.NPEAKSMAX = NPEAKSMAX
+    self.NBINS = NBINS
+    self.orb_size = orb_size
+    # derivative width (diff_m7 output)
+    self.nbits = nbits
+    # number of orbits processed at once (bounds the memory of the intermediates)
+    self.chunk = chunk
+    # pipeline latency in bx between the samples of a peak and its detection (latency of the testbench waveform capture)
+    self.bx_latency = 12
+    self.reg_map = dict( DERIVATIVE_REG_MAP )
+    self._regs = dict( (addr, 0) for addr, mask in self.reg_map.values() )
+    for reg, value in zip( LUT_REGS, encode_bin_lut(bin_lut(NSAMP, NBINS)) ):
+      self.write( reg, value )
+
+  def write( self, reg_name, data ):
+    """
+    Register write with the firmware masks (read-modify-write of the other fields).
+    """
+    if not (reg_name in self.reg_map.keys()):
+      raise ValueError("Failed model write: unknown register")
+    addr, mask = self.reg_map[reg_name]
+    self._regs[addr] = (self._regs[addr] & ~mask) | shift_to_mask( mask, data )
+
+  def read( self, reg_name ):
+    if not (reg_name in self.reg_map.keys()):
+      raise ValueError("Failed model read: unknown register")
+    addr, mask = self.reg_map[reg_name]
+    return shift_from_mask( mask, self._regs[addr] )
+
+  @property
+  def lut( self ):
+    return decode_bin_lut( [ self.read(reg) for reg in LUT_REGS ], self.NSAMP )
+
+  def derivative( self, orbits ):
+    return pfu.snrd( orbits, 7, fixed_point=True, nbits=self.nbits )
+
+  def candidates( self, deriv ):
+    """
+    Threshold independent part of the peak finding in a 2-D derivative array:
+    row, sample index, start of the positive derivative run and peaks_val of every zero crossing.
+    """
+    n_rows, n_samp = deriv.shape
+    positive = deriv > 0
+    crossing = np.zeros( deriv.shape, dtype=bool )
+    crossing[:, 1:] = positive[:, :-1] & ~positive[:, 1:]
+    rows, idx = np.nonzero( crossing )
+    if len(rows) == 0:
+      return rows, idx, idx, idx
+    # start of the positive run preceding each crossing
+    last_nonpos = np.where( positive, -1, np.arange(n_samp) )
+    np.maximum.accumulate( last_nonpos, axis=1, out=last_nonpos )
+    start = last_nonpos[rows, idx - 1] + 1
+    # integral over the run, via cumulative sums
+    csum = np.zeros( (n_rows, n_samp + 1), dtype=np.int64 )
+    np.cumsum( np.where(positive, deriv, 0), axis=1, out=csum[:, 1:] )
+    val = np.minimum( csum[rows, idx] - csum[rows, start], self.VAL_MAX )
+    return rows, idx, start, val
+
+  def samples_over( self, deriv, rows, idx, start, deriv_thr ):
+    """
+    Number of samples over deriv_thr within the positive run of each candidate.
+    """
+    csum = np.zeros( (deriv.shape[0], deriv.shape[1] + 1), dtype=np.int64 )
+    np.cumsum( deriv > deriv_thr, axis=1, out=csum[:, 1:] )
+    return csum[rows, idx] - csum[rows, start]
+
+  def _find_peaks( self, deriv ):
+    """
+    Returns (row, sample index, peaks_val) of all qualifying peaks in a 2-D derivative array.
+    """
+    rows, idx, start, val = self.candidates( deriv )
+    n_over = self.samples_over( deriv, rows, idx, start, self.read("deriv_thr") )
+    keep = (n_over >= self.read("top")) & (val > self.read("val_thr"))
+    return rows[keep], idx[keep], val[keep]
+
+  def report( self, rows, idx, val, first_orbit=1 ):
+    """
+    Reported peaks (at most NPEAKSMAX per bx) out of qualifying peaks ordered by row and sample index,
+    as a structured array: orbit, bx, slot (index within NPEAKSMAX), val (peaks_val), pos (peaks_pos), bin (LUT bin).
+    """
+    bx = idx // self.NSAMP
+    # rank within (orbit, bx)
+    key = rows * (self.orb_size + 1) + bx
+    new_group = np.ones( len(key), dtype=bool )
+    new_group[1:] = key[1:] != key[:-1]
+    group_start = np.maximum.accumulate( np.where(new_group, np.arange(len(key)), 0) )
+    slot = np.arange( len(key) ) - group_start
+    keep = slot < self.NPEAKSMAX
+    res = np.zeros( np.count_nonzero(keep), dtype=self.PEAK_DTYPE )
+    res["orbit"] = rows[keep] + first_orbit
+    res["bx"] = bx[keep]
+    res["slot"] = slot[keep]
+    res["val"] = val[keep]
+    res["pos"] = idx[keep] % self.NSAMP
+    res["bin"] = self.lut[res["pos"]]
+    return res
+
+  def process( self, orbits, first_orbit=1 ):
+    """
+    Run the model over orbits (1-D single orbit or 2-D orbits x samples).
+    Returns a structured array with one entry per reported peak (see report).
+    """
+    orbits = np.atleast_2d( orbits )
+    results = [ np.zeros(0, dtype=self.PEAK_DTYPE) ]
+    for first in range( 0, len(orbits), self.chunk ):
+      rows, idx, val = self._find_peaks( self.derivative(orbits[first:first + self.chunk]) )
+      results.append( self.report(rows, idx, val, first + first_orbit) )
+    return np.concatenate( results )
+
+  def bx_outputs( self, peaks ):
+    """
+    Per (orbit, bx) output words: returns orbit, bx, peaks (bit i = slot i) and peaks_bins (bit b = bin b).
+    """
+    if len(peaks) == 0:
+      empty = np.zeros( 0, dtype=np.int64 )
+      return empty, empty, empty, empty
+    new_group = np.ones( len(peaks), dtype=bool )
+    new_group[1:] = (peaks["orbit"][1:] != peaks["orbit"][:-1]) | (peaks["bx"][1:] != peaks["bx"][:-1])
+    starts = np.nonzero( new_group )[0]
+    peaks_word = np.bitwise_or.reduceat( np.left_shift(1, peaks["slot"]), starts )
+    bins_word = np.bitwise_or.reduceat( np.left_shift(1, peaks["bin"]), starts )
+    return peaks["orbit"][starts], peaks["bx"][starts], peaks_word, bins_word
+
+  def pulses( self, peaks ):
+    """
+    pfu.PulseStore of the reported peaks, as the derivative_producer would register them.
+    """
+    orbit, bx = stamp_bx( peaks["orbit"], peaks["bx"], self.bx_latency, self.orb_size )
+    return pfu.PulseStore.from_columns( orbit=orbit, bx=bx, amplitude=peaks["val"], position=peaks["pos"] )
+
+  def waveforms( self, orbits, peaks, first_orbit=1 ):
+    """
+    pfu.WaveformStore with the sample and derivative waveforms of every bx with a reported peak.
+    """
+    orbits = np.atleast_2d( orbits )
+    orbit, bx, peaks_word, bins_word = self.bx_outputs( peaks )
+    waveforms = pfu.WaveformStore( self.NSAMP )
+    for orb in np.unique( orbit ):
+      data = orbits[orb - first_orbit]
+      orb_bx = bx[orbit == orb]
+      for wf_type, values in [ ("sample", data), ("derivative", self.derivative(data)) ]:
+        rows = np.zeros( len(orb_bx), dtype=pfu.waveform_dtype(self.NSAMP) )
+        rows["orbit"], rows["bx"] = stamp_bx( orb, orb_bx, self.bx_latency, self.orb_size )
+        rows["waveform"] = values.reshape( -1, self.NSAMP )[orb_bx]
+        waveforms.stores[wf_type].extend( rows )
+    return waveforms
+
+class ParallelAnalyzerModel( object ):
+  """
+  Software model of parallel_analyzer.vhd, processing whole orbits in batch.
+  All NSAMP samples of a bx are analyzed in parallel:
+    - samples above level_threshold form runs (time over threshold) within the bx
+    - the first run with at least tot_threshold samples is a pulse
+    - amplitude is the local maximum of that run, position the sample of the maximum
+      within the bx (peaks bit), tot the length of the run
+    - a pulse in the bunch clock directly after another pulse is consecutive (consec_cnt)
+  process() reports pulses in the bx of their samples; pulses() stamps them <bx_latency> bx later
+  (see stamp_bx), as prallel_producer does, so they compare directly with parallel_test results.
+  """
+
+  def __init__( self, level_threshold=130, tot_threshold=3, NSAMP=30, orb_size=3564, chunk=64 ):
+    self.level_threshold = level_threshold
+    self.tot_threshold = tot_threshold
+    self.NSAMP = NSAMP
+    self.orb_size = orb_size
+    # number of orbits processed at once (bounds the memory of the intermediates)
+    self.chunk = chunk
+    # pipeline latency in bx between the samples of a pulse and its detection (the 120 samples recon shifts parallel_test pulses back)
+    self.bx_latency = 4
+    # clock (orbit * orb_size + bx) of the last pulse of the previous process() call
+    self.last_clock = None
+
+  def runs( self, orbits, level_threshold=None ):
+    """
+    All runs above level_threshold within a bx of a 2-D orbits array.
+    Returns row, bx, start, length, maximum and position (of the first maximum) per run.
+    """
+    if level_threshold is None:
+      level_threshold = self.level_threshold
+    orbits = np.atleast_2d( orbits )
+    n_rows = len( orbits )
+    # pad every bx with one sample below threshold, so runs end within their bx
+    values = np.zeros( (n_rows, self.orb_size, self.NSAMP + 1), dtype=np.int64 )
+    values[:, :, :self.NSAMP] = orbits.reshape( n_rows, self.orb_size, self.NSAMP )
+    values = values.ravel()
+    above = np.zeros( len(values) + 1, dtype=np.int8 )
+    above[1:] = values > level_threshold
+    edges = np.diff( above )
+    starts = np.nonzero( edges == 1 )[0]
+    ends = np.nonzero( edges == -1 )[0]
+    length = ends - starts
+    if len(starts) == 0:
+      empty = np.zeros( 0, dtype=np.int64 )
+      return empty, empty, empty, empty, empty, empty
+    bounds = np.empty( 2 * len(starts), dtype=np.int64 )
+    bounds[0::2] = starts
+    bounds[1::2] = ends
+    maximum = np.maximum.reduceat( values, bounds )[0::2]
+    # first position of the maximum within each run
+    in_run = np.repeat( starts, length ) + ( np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length) )
+    at_max = np.where( values[in_run] == np.repeat(maximum, length), in_run, len(values) )
+    argmax = np.minimum.reduceat( at_max, np.cumsum(length) - length )
+    bx_global = starts // (self.NSAMP + 1)
+    return bx_global // self.orb_size, bx_global % self.orb_size, starts % (self.NSAMP + 1), length, maximum, argmax % (self.NSAMP + 1)
+
+  def select( self, runs, tot_threshold=None ):
+    """
+    Pick the first run with at least tot_threshold samples per bx.
+    """
+    if tot_threshold is None:
+      tot_threshold = self.tot_threshold
+    row, bx, start, length, maximum, position = runs
+    keep = np.nonzero( length >= tot_threshold )[0]
+    key = row[keep] * self.orb_size + bx[keep]
+    first = np.ones( len(key), dtype=bool )
+    first[1:] = key[1:] != key[:-1]
+    keep = keep[first]
+    return row[keep], bx[keep], maximum[keep], position[keep], length[keep]
+
+  def process( self, orbits, first_orbit=1, continued=False ):
+    """
+    Run the model over orbits (1-D single orbit or 2-D orbits x samples).
+    Returns a structured array with one entry per pulse:
+    orbit, bx, amplitude (local_maximum), position, tot (time_over_threshold), consec.
+    Orbits are assumed to be driven back to back, so consecutive pulses can span two orbits.
+    With continued, the orbits follow those of the previous call (e.g. fed one orbit at a time),
+    a pulse in the first bx is consecutive to one in the last bx of the previous call's last orbit.
+    """
+    orbits = np.atleast_2d( orbits )
+    dtype = [("orbit", np.int64), ("bx", np.int64), ("amplitude", np.int64), ("position", np.int64), ("tot", np.int64), ("consec", bool)]
+    results = []
+    for first in range( 0, len(orbits), self.chunk ):
+      row, bx, maximum, position, length = self.select( self.runs(orbits[first:first + self.chunk]) )
+      res = np.zeros( len(row), dtype=dtype )
+      res["orbit"] = row + first + first_orbit
+      res["bx"] = bx
+      res["amplitude"] = maximum
+      res["position"] = position
+      res["tot"] = length
+      results.append( res )
+    res = np.concatenate( results ) if len(results) > 0 else np.zeros( 0, dtype=dtype )
+    clock = res["orbit"] * self.orb_size + res["bx"]
+    res["consec"][1:] = clock[1:] == clock[:-1] + 1
+    if len(res) > 0:
+      res["consec"][0] = continued and self.last_clock is not None and clock[0] == self.last_clock + 1
+      self.last_clock = int( clock[-1] )
+    return res
+
+  def pulses( self, res ):
+    """
+    pfu.PulseStore of the pulses, as the prallel_producer would register them.
+    """
+    orbit, bx = stamp_bx( res["orbit"], res["bx"], self.bx_latency, self.orb_size )
+    return pfu.PulseStore.from_columns( orbit=orbit, bx=bx, amplitude=res["amplitude"], position=res["position"], tot=res["tot"] )
+
+def process_segments( model, segments, first_orbit=1 ):
+  """
+  Run a model over zero-suppressed windows (pfio.ZsOrbitFile.segments) instead of whole orbits:
+  every window row is processed as a short orbit, orbit and bx of the results are mapped back.
+  Gives the results of model.process on the expanded orbits, as long as the baseline alone does not
+  trigger the model (parallel: baseline <= level_threshold); the derivative at the first and last samples
+  of an orbit, zero in whole orbits, is computed from the padding.
+  """
+  orbit, start_bx, data = segments
+  windowed = copy.copy( model )
+  windowed.orb_size = data.shape[1] // model.NSAMP
+  res = windowed.process( data, first_orbit=0 )
+  row = res["orbit"].copy()
+  res["orbit"] = orbit[row] + first_orbit
+  res["bx"] += start_bx[row]
+  if "consec" in res.dtype.names:
+    clock = res["orbit"] * model.orb_size + res["bx"]
+    res["consec"][1:] = clock[1:] == clock[:-1] + 1
+  return res
@@ -0,0 +1,244 @@
+################################################
+# Parallel regression runs of the peak finder testbenches over channel/threshold matrices.
+################################################
+import argparse
+import collections
+import csv
+import itertools
+import os
+import shlex
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import peakfinder_utils as pfu
+import peakfinder_models as pfm
+import peakfinder_io as pfio
+
+TB_DIR = os.path.dirname( os.path.abspath(__file__) )
+
+# Simulator command, run in the job directory; {makefile}, {sim} and {testcase} are substituted
+SIM_COMMAND = "make -f {makefile} SIM={sim} TESTCASE={testcase}"
+# Stand-in for the simulator: runs the software model of the testcase with the same parameters
+STUB_COMMAND = sys.executable + " " + os.path.abspath( __file__ ) + " --stub-job"
+
+class Job( object ):
+  """
+  One simulator run: testcase on a channel with a set of thresholds (params) and an orbit range,
+  in its own directory (sim_build, results.xml, sim.log and the results/ directory).
+  Parameters reach the testbench as PFTB_<NAME> environment variables (see pfu.test_param).
+  """
+  def __init__( self, testcase, channel, params, orbit_start, orbits, directory ):
+    self.testcase = testcase
+    self.channel = channel
+    self.params = params
+    self.orbit_start = orbit_start
+    self.orbits = orbits
+    self.directory = os.path.abspath( directory )
+    self.results_dir = os.path.join( self.directory, "results" )
+    self.returncode = None
+    self.duration = 0.
+
+  @property
+  def point( self ):
+    """
+    Matrix point of the job, the same for all orbit ranges of a split run.
+    """
+    return (self.testcase, self.channel) + tuple( sorted(self.params.items()) )
+
+  def env( self, base=None ):
+    env = dict( os.environ if base is None else base )
+    env["TESTCASE"] = self.testcase
+    env["COCOTB_RESULTS_FILE"] = os.path.join( self.directory, "results.xml" )
+    env["PFTB_CHANNEL"] = self.channel
+    env["PFTB_ORBIT_START"] = str( self.orbit_start )
+    env["PFTB_ORBITS"] = str( self.orbits )
+    env["PFTB_RESULTS_DIR"] = self.results_dir
+    for name, value in self.params.items():
+      env["PFTB_" + name.upper()] = str( value )
+    # jobs run in their own directories: the DAQ request file (next to the testbench by default) as an absolute path,
+    # and one DAQ orbit cache for all jobs, so every request is extracted from HDF5 once
+    env["PFTB_DAQ_INPUT"] = os.path.abspath( env.get("PFTB_DAQ_INPUT", os.path.join(TB_DIR, "daq_input.dat")) )
+    env["PFTB_DAQ_CACHE"] = os.path.abspath( env.get("PFTB_DAQ_CACHE", os.path.join(TB_DIR, "daq_cache")) )
+    return env
+
+  def failures( self ):
+    """
+    Number of failed tests in results.xml, None if the simulator did not write one.
+    """
+    path = os.path.join( self.directory, "results.xml" )
+    if not os.path.exists( path ):
+      return None
+    root = ET.parse( path ).getroot()
+    return len( root.findall(".//failure") ) + len( root.findall(".//error") )
+
+  @property
+  def ok( self ):
+    return self.returncode == 0 and not self.failures()
+
+def job_matrix( testcases, channels, params, orbit_start=0, orbits=2, split=1, out_dir="regression" ):
+  """
+  Jobs for all combinations of testcases, channels and params (dict name -> list of values).
+  The orbit range [orbit_start, orbit_start + orbits) of every point is split into <split> jobs.
+  """
+  names = sorted( params )
+  bounds = np.linspace( orbit_start, orbit_start + orbits, split + 1 ).astype( int )
+  jobs = []
+  for testcase, channel, values in itertools.product( testcases, channels, itertools.product(*[params[name] for name in names]) ):
+    for start, stop in zip( bounds[:-1], bounds[1:] ):
+      if stop == start:
+        continue
+      directory = "_".join( [testcase, channel] + [ name + str(value) for name, value in zip(names, values) ] + ["orb" + str(start)] )
+      jobs.append( Job(testcase, channel, dict(zip(names, values)), int(start), int(stop - start), os.path.join(out_dir, directory)) )
+  return jobs
+
+def run_job( job, command=SIM_COMMAND, sim="riviera", env=None ):
+  if not os.path.isdir( job.results_dir ):
+    os.makedirs( job.results_dir )
+  args = shlex.split( command.format(makefile=os.path.join(TB_DIR, "Makefile"), sim=sim, testcase=job.testcase) )
+  start = time.time()
+  with open( os.path.join(job.directory, "sim.log"), "w" ) as log:
+    job.returncode = subprocess.call( args, cwd=job.directory, env=job.env(env), stdout=log, stderr=subprocess.STDOUT )
+  job.duration = time.time() - start
+  return job
+
+def run_jobs( jobs, command=SIM_COMMAND, processes=None, sim="riviera", env=None ):
+  """
+  Run the jobs, <processes> simulator processes at a time (number of CPUs by default).
+  """
+  pool = ThreadPool( processes )
+  try:
+    for job in pool.imap_unordered( lambda job: run_job(job, command, sim, env), jobs ):
+      print( pfu.string_color("%-8s" % ("OK" if job.ok else "FAILED"), "green" if job.ok else "red") + " " + os.path.basename(job.directory) + " (%.1f s)" % job.duration )
+  finally:
+    pool.close()
+    pool.join()
+  return jobs
+
+def merge_results( jobs, report_dir ):
+  """
+  Merge the results of all orbit ranges per matrix point into <report_dir>:
+  one results file (pulses, waveforms, metadata) and live histograms per point,
+  and report.csv with one row per point. Consecutive pulses are recounted on the merged pulses,
+  so pulses on both sides of a split are joined.
+  Returns the report rows.
+  """
+  if not os.path.isdir( report_dir ):
+    os.makedirs( report_dir )
+  points = collections.OrderedDict()
+  for job in jobs:
+    points.setdefault( job.point, [] ).append( job )
+  param_names = sorted( set(name for job in jobs for name in job.params) )
+  rows = []
+  for point, point_jobs in points.items():
+    point_jobs = sorted( point_jobs, key=lambda job: job.orbit_start )
+    pulses = pfu.PulseStore()
+    waveforms = None
+    hist = None
+    metadata = {}
+    orbits = 0
+    for job in point_jobs:
+      for filename in sorted( os.listdir(job.results_dir) if os.path.isdir(job.results_dir) else [] ):
+        path = os.path.join( job.results_dir, filename )
+        if filename.endswith( "_live.npz" ):
+          live = pfu.LiveHistograms.load( path )
+          hist = live if hist is None else hist + live
+        elif filename.endswith( ".h5" ):
+          job_pulses, job_waveforms, job_metadata = pfio.read_results( path )
+          pulses.extend( job_pulses )
+          if job_waveforms is not None:
+            if waveforms is None:
+              waveforms = pfu.WaveformStore( job_waveforms.width )
+            waveforms.extend( job_waveforms )
+          orbits += job_metadata.get( "orbits", 0 )
+          metadata = job_metadata
+    job = point_jobs[0]
+    name = "_".join( [job.testcase, job.channel] + [ key + str(value) for key, value in sorted(job.params.items()) ] )
+    clock = np.unique( pulses.array["orbit"] * metadata.get("orb_size", 3564) + pulses.array["bx"] )
+    metadata.update( orbit_start=job.orbit_start, orbits=orbits, jobs=len(point_jobs) )
+    if "consec_cnt" in metadata:
+      metadata["consec_cnt"] = int( np.count_nonzero(np.diff(clock) == 1) )
+    if len(pulses) > 0 or waveforms is not None:
+      pfio.write_results( os.path.join(report_dir, name), pulses, waveforms, metadata )
+    if hist is not None:
+      hist.save( os.path.join(report_dir, name + "_live.npz") )
+    row = collections.OrderedDict( [("testcase", job.testcase), ("channel", job.channel)] )
+    for param in param_names:
+      row[param] = job.params.get( param, "" )
+    row["orbit_start"] = job.orbit_start
+    row["orbits"] = orbits
+    row["jobs"] = len( point_jobs )
+    row["failed"] = sum( not point_job.ok for point_job in point_jobs )
+    row["pulses"] = len( pulses )
+    row["consec_cnt"] = metadata.get( "consec_cnt", "" )
+    row["sim_time"] = round( sum(point_job.duration for point_job in point_jobs), 1 )
+    rows.append( row )
+  if len(rows) > 0:
+    with open( os.path.join(report_dir, "report.csv"), "w" ) as f:
+      writer = csv.DictWriter( f, fieldnames=list(rows[0].keys()) )
+      writer.writeheader()
+      writer.writerows( rows )
+  return rows
+
+def stub_job():
+  """
+  Simulator stand-in (STUB_COMMAND): runs the software model of $TESTCASE on the uBCM raw data
+  of the job parameters and writes its results like the testbench would.
+  """
+  testcase = os.environ["TESTCASE"]
+  channel = pfu.test_param( "channel", "crate1.amc1_chA" )
+  orbit_start = pfu.test_param( "orbit_start", 0 )
+  results_dir = pfu.test_param( "results_dir", "../results" )
+  raw = pfio.RawOrbitFile( os.path.join(pfu.test_param("raw_data_path", pfio.UBCM_RAW_DATA_PATH), pfio.UBCM_RAW_FILE % channel) )
+  data = raw[orbit_start:orbit_start + pfu.test_param("orbits", 2)]
+  metadata = dict( input_filename=channel, NSAMP=30, NBINS=6, orb_size=3564, orbit_start=orbit_start, orbits=len(data) )
+  if testcase.startswith( "parallel" ):
+    level_threshold = pfu.test_param( "level_threshold", 130 )
+    tot_threshold = pfu.test_param( "tot_threshold", 3 )
+    model = pfm.ParallelAnalyzerModel( level_threshold=level_threshold, tot_threshold=tot_threshold )
+    res = model.process( data, first_orbit=orbit_start + 1 )
+    metadata.update( level_threshold=level_threshold, tot_threshold=tot_threshold, consec_cnt=int(res["consec"].sum()) )
+    pfio.write_results( os.path.join(results_dir, "PARALLELSTUB" + channel), model.pulses(res), metadata=metadata )
+  else:
+    model = pfm.DerivativePeakfinderModel()
+    for reg, default in [ ("top", 1), ("deriv_thr", 5), ("val_thr", 40) ]:
+      metadata[reg] = pfu.test_param( reg, default )
+      model.write( reg, metadata[reg] )
+    peaks = model.process( data, first_orbit=orbit_start + 1 )
+    pfio.write_results( os.path.join(results_dir, "DERIVATIVESTUB" + channel), model.pulses(peaks), model.waveforms(data, peaks, orbit_start + 1), metadata )
+
+def _param( text ):
+  name, values = text.split( "=", 1 )
+  return name, [ int(value) if value.lstrip("-").isdigit() else value for value in values.split(",") ]
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser( description="Run peak finder testbenches over a channel/threshold matrix in parallel and merge the results." )
+  parser.add_argument( "--testcase", nargs="+", default=["parallel_test"] )
+  parser.add_argument( "--channel", nargs="+", default=["crate1.amc1_chA"] )
+  parser.add_argument( "--param", type=_param, action="append", default=[], help="threshold values, e.g. level_threshold=130,132,134" )
+  parser.add_argument( "--set", type=_param, action="append", default=[], help="fixed testbench parameter, e.g. source=ubcm" )
+  parser.add_argument( "--orbit-start", type=int, default=0 )
+  parser.add_argument( "--orbits", type=int, default=2 )
+  parser.add_argument( "--split", type=int, default=1, help="orbit ranges per matrix point" )
+  parser.add_argument( "--processes", type=int, default=None )
+  parser.add_argument( "--sim", default="riviera" )
+  parser.add_argument( "--command", default=SIM_COMMAND, help="simulator command ({makefile}, {sim}, {testcase} are substituted)" )
+  parser.add_argument( "--stub", action="store_true", help="run the software models instead of the simulator" )
+  parser.add_argument( "--out", default="regression" )
+  parser.add_argument( "--stub-job", action="store_true", help=argparse.SUPPRESS )
+  args = parser.parse_args()
+  if args.stub_job:
+    stub_job()
+    sys.exit( 0 )
+  env = dict( os.environ )
+  for name, values in args.set:
+    env["PFTB_" + name.upper()] = ",".join( str(value) for value in values )
+  jobs = job_matrix( args.testcase, args.channel, dict(args.param), args.orbit_start, args.orbits, args.split, args.out )
+  print( "Running " + str(len(jobs)) + " jobs" )
+  run_jobs( jobs, STUB_COMMAND if args.stub else args.command, args.processes, args.sim, env )
+  rows = merge_results( jobs, os.path.join(args.out, "report") )
+  for row in rows:
+    print( ", ".join(str(key) + "=" + str(value) for key, value in row.items()) )
+  sys.exit( 0 if all(job.ok for job in jobs) else 1 )
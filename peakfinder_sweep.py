@@ -0,0 +1,178 @@
+################################################
+# Threshold sweeps over the software peak finder models.
+################################################
+import argparse
+import multiprocessing
+import os
+import numpy as np
+import peakfinder_utils as pfu
+import peakfinder_models as pfm
+import peakfinder_io as pfio
+import peakfinder_bins as pfb
+
+# Orbits of the swept channels, name -> orbits (2-D array, memmap or pfio.RawOrbitFile).
+# Set before the worker pool is started, the workers inherit it (fork) instead of receiving copies.
+_channels = {}
+
+def _pool( processes ):
+  if hasattr( multiprocessing, "get_context" ):
+    return multiprocessing.get_context( "fork" ).Pool( processes )
+  return multiprocessing.Pool( processes )
+
+def _run( task, tasks, processes ):
+  """
+  Run the tasks in a process pool (or inline for processes=1), results sorted by (channel, first orbit).
+  """
+  if processes == 1:
+    results = [ task(args) for args in tasks ]
+  else:
+    pool = _pool( processes )
+    try:
+      results = pool.map( task, tasks )
+    finally:
+      pool.close()
+      pool.join()
+  return sorted( results, key=lambda result: (result[0], result[1]) )
+
+def _orbit_tasks( chunk ):
+  return [ (name, first, min(first + chunk, len(orbits))) for name, orbits in sorted(_channels.items()) for first in range(0, len(orbits), chunk) ]
+
+def _table( params, nbit, NSAMP, orb_size, extra=[] ):
+  return np.dtype( [("channel", "U64")] + [ (name, np.int64) for name in params ] + [("n_pulses", np.int64)] + extra +
+                   [("occ", np.int64, (orb_size,)), ("amp", np.int64, (2**nbit,)), ("pos", np.int64, (NSAMP,)), ("tot", np.int64, (NSAMP + 1,))] )
+
+def _parallel_task( args ):
+  """
+  All (level_threshold, tot_threshold) grid points on one orbit range of a channel.
+  Runs above a level threshold are found once and shared by all ToT thresholds.
+  """
+  name, first, stop, level_thresholds, tot_thresholds, NSAMP, orb_size = args
+  model = pfm.ParallelAnalyzerModel( NSAMP=NSAMP, orb_size=orb_size )
+  orbits = np.asarray( _channels[name][first:stop] )
+  n_clocks = (stop - first) * orb_size
+  results = []
+  for level_threshold in level_thresholds:
+    runs = model.runs( orbits, level_threshold )
+    for tot_threshold in tot_thresholds:
+      row, bx, maximum, position, length = model.select( runs, tot_threshold )
+      hist = pfu.LiveHistograms( 8, NSAMP, orb_size )
+      hist.fill_pulses( pfu.PulseStore.from_columns(row + first + 1, bx, maximum, position, length) )
+      hist.orbits = stop - first
+      clock = row * orb_size + bx
+      # consecutive pulses, plus hits on the first/last clock to join with neighbouring ranges
+      n_consec = int( np.count_nonzero(clock[1:] == clock[:-1] + 1) )
+      results.append( (hist, n_consec, len(clock) > 0 and clock[0] == 0, len(clock) > 0 and clock[-1] == n_clocks - 1) )
+  return name, first, results
+
+def sweep_parallel( channels, level_thresholds, tot_thresholds, processes=None, chunk=16, NSAMP=30, orb_size=3564 ):
+  """
+  parallel_analyzer model over a level_threshold x tot_threshold grid for every channel.
+  channels: dict name -> orbits (2-D array, memmap or pfio.RawOrbitFile), loaded once and shared by the workers
+  Orbit ranges of <chunk> orbits are processed in parallel by <processes> workers (all CPUs by default).
+  Returns one table row per (channel, level_threshold, tot_threshold): pulse and consecutive counts
+  and occupancy, amplitude, position and ToT histograms.
+  """
+  _channels.clear()
+  _channels.update( channels )
+  tasks = [ task + (list(level_thresholds), list(tot_thresholds), NSAMP, orb_size) for task in _orbit_tasks(chunk) ]
+  results = _run( _parallel_task, tasks, processes )
+  grid = [ (level_threshold, tot_threshold) for level_threshold in level_thresholds for tot_threshold in tot_thresholds ]
+  table = np.zeros( len(channels) * len(grid), dtype=_table(["level_threshold", "tot_threshold"], 8, NSAMP, orb_size, [("n_consec", np.int64)]) )
+  for c, name in enumerate( sorted(channels) ):
+    ranges = [ result[2] for result in results if result[0] == name ]
+    for g, (level_threshold, tot_threshold) in enumerate( grid ):
+      hist = pfu.LiveHistograms( 8, NSAMP, orb_size )
+      n_consec = 0
+      for r, partial in enumerate( ranges ):
+        hist += partial[g][0]
+        n_consec += partial[g][1] + int( r > 0 and ranges[r - 1][g][3] and partial[g][2] )
+      entry = table[c * len(grid) + g]
+      entry["channel"] = name
+      entry["level_threshold"] = level_threshold
+      entry["tot_threshold"] = tot_threshold
+      entry["n_pulses"] = hist.occ.sum()
+      entry["n_consec"] = n_consec
+      for hist_name in pfu.LiveHistograms.NAMES:
+        entry[hist_name] = getattr( hist, hist_name )
+  return table
+
+def _derivative_task( args ):
+  """
+  All (deriv_thr, val_thr, top) grid points on one orbit range of a channel.
+  Derivative, zero crossings and peaks_val are computed once, samples over deriv_thr once per deriv_thr.
+  """
+  name, first, stop, deriv_thrs, val_thrs, tops, NSAMP, NPEAKSMAX, NBINS, orb_size = args
+  model = pfm.DerivativePeakfinderModel( NSAMP=NSAMP, NPEAKSMAX=NPEAKSMAX, NBINS=NBINS, orb_size=orb_size )
+  deriv = model.derivative( np.asarray(_channels[name][first:stop]) )
+  rows, idx, start, val = model.candidates( deriv )
+  results = []
+  for deriv_thr in deriv_thrs:
+    n_over = model.samples_over( deriv, rows, idx, start, deriv_thr )
+    for val_thr in val_thrs:
+      for top in tops:
+        keep = (n_over >= top) & (val > val_thr)
+        peaks = model.report( rows[keep], idx[keep], val[keep], first + 1 )
+        hist = pfu.LiveHistograms( 12, NSAMP, orb_size )
+        hist.fill_pulses( model.pulses(peaks) )
+        hist.orbits = stop - first
+        # peaks_bins semantics: a bin counts once per bx (see pfb.BinOccupancy)
+        occupancy = pfb.BinOccupancy( NBINS, orb_size, model.lut )
+        occupancy.fill_peaks( peaks )
+        results.append( (hist, occupancy.per_bin()) )
+  return name, first, results
+
+def sweep_derivative( channels, deriv_thrs, val_thrs, tops=(1,), processes=None, chunk=8, NSAMP=30, NPEAKSMAX=3, NBINS=6, orb_size=3564 ):
+  """
+  derivative_peakfinder model over a deriv_thr x val_thr x top grid for every channel (see sweep_parallel).
+  Returns one table row per (channel, deriv_thr, val_thr, top): pulse count, occupancy, peaks_val,
+  position and peaks_bins bin histograms.
+  """
+  _channels.clear()
+  _channels.update( channels )
+  tasks = [ task + (list(deriv_thrs), list(val_thrs), list(tops), NSAMP, NPEAKSMAX, NBINS, orb_size) for task in _orbit_tasks(chunk) ]
+  results = _run( _derivative_task, tasks, processes )
+  grid = [ (deriv_thr, val_thr, top) for deriv_thr in deriv_thrs for val_thr in val_thrs for top in tops ]
+  table = np.zeros( len(channels) * len(grid), dtype=_table(["deriv_thr", "val_thr", "top"], 12, NSAMP, orb_size, [("bins", np.int64, (NBINS,))]) )
+  for c, name in enumerate( sorted(channels) ):
+    ranges = [ result[2] for result in results if result[0] == name ]
+    for g, (deriv_thr, val_thr, top) in enumerate( grid ):
+      hist = pfu.LiveHistograms( 12, NSAMP, orb_size )
+      bins = np.zeros( NBINS, dtype=np.int64 )
+      for partial in ranges:
+        hist += partial[g][0]
+        bins += partial[g][1]
+      entry = table[c * len(grid) + g]
+      entry["channel"] = name
+      entry["deriv_thr"] = deriv_thr
+      entry["val_thr"] = val_thr
+      entry["top"] = top
+      entry["n_pulses"] = hist.occ.sum()
+      entry["bins"] = bins
+      for hist_name in pfu.LiveHistograms.NAMES:
+        entry[hist_name] = getattr( hist, hist_name )
+  return table
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser( description="Threshold sweep of the software peak finder models over uBCM raw data files." )
+  parser.add_argument( "model", choices=["parallel", "derivative"] )
+  parser.add_argument( "files", nargs="+", help="raw data .bin files, one channel each" )
+  parser.add_argument( "--level-threshold", type=int, nargs="+", default=[130, 132, 134, 136, 140, 142] )
+  parser.add_argument( "--tot-threshold", type=int, nargs="+", default=[2, 3, 4] )
+  parser.add_argument( "--deriv-thr", type=int, nargs="+", default=[5] )
+  parser.add_argument( "--val-thr", type=int, nargs="+", default=[40] )
+  parser.add_argument( "--top", type=int, nargs="+", default=[1] )
+  parser.add_argument( "--orbits", type=int, default=None, help="number of orbits per channel (all by default)" )
+  parser.add_argument( "--processes", type=int, default=None )
+  parser.add_argument( "--out", default="sweep.npy" )
+  args = parser.parse_args()
+  channels = dict( (os.path.basename(filename), pfio.RawOrbitFile(filename)[:args.orbits]) for filename in args.files )
+  if args.model == "parallel":
+    table = sweep_parallel( channels, args.level_threshold, args.tot_threshold, args.processes )
+    columns = ["channel", "level_threshold", "tot_threshold", "n_pulses", "n_consec"]
+  else:
+    table = sweep_derivative( channels, args.deriv_thr, args.val_thr, args.top, args.processes )
+    columns = ["channel", "deriv_thr", "val_thr", "top", "n_pulses"]
+  np.save( args.out, table )
+  print( ",".join(columns) )
+  for entry in table:
+    print( ",".join(str(entry[column]) for column in columns) )
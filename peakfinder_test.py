@@ -3,11 +3,16 @@ from cocotb.clock import Clock
 from cocotb.triggers import Timer, RisingEdge, ReadOnly
 from cocotb.regression import TestFactory
 from cocotb.binary import BinaryRepresentation
+from cocotb.utils import get_sim_time
 import math
-import struct
+import os
+import time
+import binascii
 import peakfinder_utils as pfu
-import tables
-import matplotlib.pyplot as plt
+import peakfinder_models as pfm
+import peakfinder_io as pfio
+import peakfinder_gen as pfg
+import peakfinder_bins as pfb
 import numpy as np
 
 class PeakfinderTB( object ):
@@ -26,72 +31,144 @@ class PeakfinderTB( object ):
     # Number of samples per bx
     self.NSAMP = int(self.dut.NSAMPLES)
     self.NBINS = int(self.dut.NBINS)
+    # Bits per sample of the samples_flat port (SAMPLE_WIDTH generic of the wrapper toplevels)
+    self.SAMPLE_WIDTH = int(self.dut.SAMPLE_WIDTH) if hasattr(self.dut, "SAMPLE_WIDTH") else 8
     # No. of bx per orbit
     self.orb_size = 3564
     # Raw data orbit is <orb_excess> samples longer than normal orbit (firmware specific)
     self.orb_excess = 3672
     # Size of a raw data orbit in samples
     self.raw_orb_size = ( self.orb_size * self.NSAMP ) + self.orb_excess
+    # Orbits <orbit_start> ... of the input are processed
+    self.orbit_start = pfu.test_param("orbit_start", 0)
     # Orbit counter
-    self.orb_cnt = 0
+    self.orb_cnt = self.orbit_start
+    # Index of the next orbit to read from the input
+    self.input_position = self.orbit_start
     # Bunch clock counter
     self.bx_cnt = 0
-    # List with all detected pulses
-    self.pulses = []
+    # Detected pulses (since the last flush to <results>)
+    self.pulses = pfu.PulseStore()
+    # incremental results file (pfio.ResultsWriter), pulses and waveforms are flushed with a checkpoint every <flush_every> orbits,
+    # with <resume> an interrupted run continues after the last checkpoint (see open_results)
+    self.results = None
+    self.flush_every = pfu.test_param("flush_every", 10)
+    self.resume = pfu.test_param("resume", False)
+    # Running histograms of the detected pulses, snapshot to <snapshot_path> every <snapshot_every> orbits
+    self.live_hist = pfu.LiveHistograms(12, self.NSAMP, self.orb_size)
+    self.snapshot_every = 0
+    self.snapshot_path = None
     # Consecutive hits (in neighbouring bx)
     self.consec_cnt = 0
-    # Storing waveforms (buffer size is the actual latency of the peak with respect to the bx)
-    self.deriv_buffer = pfu.RingBuffer(8 + 1)
-    self.sample_buffer = pfu.RingBuffer(12 + 1)
-    self.waveforms = []
+    # Storing waveforms: reconstructed from the stimulus ("stimulus", latency of the peak with respect
+    # to the bx is 12) or sampled from the DUT on every clock ("dut", buffer size is the actual latency)
+    self.waveform_source = "stimulus"
+    self.capture = pfu.WaveformCapture(self.NSAMP, latency=12)
+    self.deriv_buffer = pfu.RingBuffer(8 + 1, self.NSAMP)
+    self.sample_buffer = pfu.RingBuffer(12 + 1, self.NSAMP)
+    # internal derivative_peakfinder_inst signals (NSAMP wide arrays) read on detection only
+    self.capture_signals = []
+    self.waveforms = pfu.WaveformStore(self.NSAMP)
+    # index of the bunch clock currently fed
+    self.clk_cnt = -1
     # reg map to be filled for exact tb
     self.reg_map = {}
+    # shadow of the register words in the DUT (address -> word), known words are not read back for masked writes,
+    # writes of unchanged words are skipped with <skip_unchanged>; cleared on reset
+    self.shadow = {}
+    self.skip_unchanged = True
+    # input ("ubcm", "daq", "zs" or "synthetic"), uBCM channel, DAQ request file and zero-suppressed file, results directory
+    self.input_source = pfu.test_param("source", "daq")
+    self.channel = pfu.test_param("channel", "crate1.amc1_chA")
+    self.raw_data_path = pfu.test_param("raw_data_path", pfio.UBCM_RAW_DATA_PATH)
+    self.daq_input = pfu.test_param("daq_input", "daq_input.dat")
+    self.zs_file = pfu.test_param("zs_file", "")
+    # reader of the zero-suppressed input (pfio.ZsOrbitFile), its windows replace the sparse pre-scan
+    self.zs = None
+    # synthetic input generator (pfg.OrbitGenerator) and the ground truth of the generated pulses
+    self.generator = None
+    self.truth = None
+    self.results_dir = pfu.test_param("results_dir", "../results")
+    # local cache of orbits extracted from DAQ HDF5 files (shared by the jobs of a regression, see Job.env)
+    self.daq_cache_dir = pfu.test_param("daq_cache", "daq_cache")
+    # number of orbits read ahead of the simulation
+    self.prefetch_depth = 4
+    # stimulus: one write per sample ("element") or per bx ("flat"), see set_drive_mode
+    self.drive_mode = "element"
+    self.drive_rate = 0.
+    # sparse drive: only bx windows around activity (and <sparse_model> peaks) are simulated,
+    # the first <sparse_check_orbits> orbits are also fed in full to compare the pulses
+    self.sparse = False
+    self.sparse_band = 3
+    self.sparse_pre = 1
+    self.sparse_post = 12 + 1
+    self.sparse_model = None
+    self.sparse_check_orbits = 0
+    self.sparse_mismatches = 0
+    # bx of the next orbit still in the window of the last active bx (see pfu.bx_overflow)
+    self.sparse_carry = 0
+    # stage timers and counters of the run, cProfile around the stages listed in PFTB_PROFILE (e.g. "drive,ipbus")
+    self.prof = pfu.StageProfiler([name for name in pfu.test_param("profile", "").split(",") if name])
+
+  def metadata(self, **thresholds):
+    """
+    Run metadata stored with the results.
+    """
+    metadata = dict(input_filename=self.input_filename, NSAMP=self.NSAMP, NBINS=self.NBINS, orb_size=self.orb_size, orbit_start=self.orbit_start, orbits=self.orb_cnt - 1 - self.orbit_start)
+    metadata.update(thresholds)
+    return metadata
+
+  @property
+  def input_filename(self):
+    """
+    Name of the input in result file names.
+    """
+    return {"ubcm": self.channel, "daq": "daq_data", "zs": os.path.basename(self.zs_file).split(".")[0], "synthetic": "sweep"}[self.input_source]
 
   def input_process_ubcm(self):
-    self.input_filename = "crate1.amc1_chA"
-    raw_data_path = "/home/bril_firmware/Documents/peakfindertb/raw_data/"
-    filepath = raw_data_path + "stable_1000orbits_bcm1f." + self.input_filename + ".bin"
-    # Read file
-    self._input_data = []
-    with open(filepath, "rb") as self._input_file:
-      for byte_list in pfu.read_binary(self._input_file, self.raw_orb_size):
-        self._input_data.append( [struct.unpack('B', byte_list[i])[0] for i in range(self.raw_orb_size - self.orb_excess)] )
+    filepath = os.path.join(self.raw_data_path, pfio.UBCM_RAW_FILE % self.channel)
+    # Map file, orbits are read on access
+    return pfio.UbcmOrbitSource(filepath, self.raw_orb_size, self.orb_excess, start=self.input_position)
 
   def input_process_daq(self):
-    self.input_filename = "daq_data"
     # process file with daq data
-    daq_input = open("daq_input.dat", "r")
-    daq_input_lines = daq_input.readlines()
-    daq_input.close()
-    daq_filepath = daq_input_lines[0][:-2]
-    # read file
-    self._input_data = []
-    for line in daq_input_lines[1:]:
-      if line[0] == "#":
-        continue
-      line_split = line.split(",")
-      filename = line_split[0]
-      runnum = int(line_split[1])
-      lsnum = int(line_split[2])
-      nbnum = int(line_split[3])
-      channelid = int(line_split[4])
-      h5file = tables.open_file(daq_filepath+"/"+filename, "r")
-      if "/bcm1futcarawdata" in h5file:
-        for row in h5file.get_node("/bcm1futcarawdata").iterrows():
-          if row['algoid'] == 100 and row['runnum'] == runnum and row['lsnum'] == lsnum and row['nbnum'] == nbnum and row['channelid'] == channelid:
-            self._input_data.append(row['data'][:(self.raw_orb_size - self.orb_excess)])
-            break
-      h5file.close()
-
-  def input_process(self):
-    #self.input_process_ubcm()
-    self.input_process_daq()
+    daq_filepath, requests = pfio.read_daq_input(self.daq_input)
+    # read files, one query per file, cached locally
+    return pfio.DaqOrbitSource(daq_filepath, requests, self.raw_orb_size - self.orb_excess, cache_dir=self.daq_cache_dir, start=self.input_position)
+
+  def input_process_zs(self):
+    # zero-suppressed orbits (see pfio.write_zs), expanded on read
+    source = pfio.ZsOrbitSource(self.zs_file, start=self.input_position)
+    self.zs = source.zs
+    return source
+
+  def input_process_synthetic(self, n_orbits=9):
+    """
+    Orbits of <generator> (see peakfinder_gen), the ground truth of the fed orbits is collected in <truth>.
+    Default is the sweep: one pulse in bx 200, shifted by one sample per orbit.
+    """
+    if self.generator is None:
+      # rise by 4 over 8 samples, fall by 1 per sample
+      self.generator = pfg.OrbitGenerator(shape=pfg.PulseShape(rise_width=8, fall_rise_ratio=4), amplitude=4*8, bx=[200],
+                                          position=lambda rng, orbit, n: np.full(n, 20 + orbit), NSAMP=self.NSAMP, orb_size=self.orb_size)
+    self.truth = pfu.ChunkedStore(pfg.TRUTH_DTYPE)
+    return self.generator.source(n_orbits, start=self.input_position, truth=self.truth)
+
+  def input_process(self, source=None):
+    """
+    Open the orbit source (<input_source> by default), orbits are streamed and prefetched in the background.
+    """
+    if source is None:
+      source = {"ubcm": self.input_process_ubcm, "daq": self.input_process_daq, "zs": self.input_process_zs, "synthetic": self.input_process_synthetic}[self.input_source]()
+    self._input_source = pfio.PrefetchOrbitSource(source, depth=self.prefetch_depth)
+    self._input_iter = iter(self._input_source)
 
   def input_get_next_orbit(self):
-    if len(self._input_data) > 0:
-      return self._input_data.pop(0)
-    else:
-      return []
+    return next(self._input_iter, [])
+
+  def input_close(self):
+    # stops the prefetching and closes the input files (e.g. the zero-suppressed samples)
+    self._input_source.close()
 
   @cocotb.coroutine
   def reset( self, clk, rst, duration=10):
@@ -99,32 +176,253 @@ class PeakfinderTB( object ):
     Basic resetting routine.
     """
     self.dut._log.info(pfu.string_color("Resetting DUT.", "blue"))
-    rst.value = 1
-    for i in range(self.NSAMP):
-      self.dut.samples[i].value = 128
-    for i in range(duration):
-      yield RisingEdge(clk)
-    rst.value = 0
-    for i in range(duration):
-      yield RisingEdge(clk)
+    self.shadow.clear()
+    with self.prof.stage("reset"):
+      rst.value = 1
+      self.drive_baseline(128)
+      for i in range(duration):
+        yield RisingEdge(clk)
+      rst.value = 0
+      for i in range(duration):
+        yield RisingEdge(clk)
     self.dut._log.info(pfu.string_color("Reset complete.", "blue"))
 
+  def set_drive_mode( self, mode ):
+    """
+    "element": one write per sample on the samples array port,
+    "flat": one write per bx on the flattened samples_flat port (wrapper toplevels only).
+    """
+    if mode not in ["element", "flat"]:
+      raise ValueError("Unknown drive mode: " + str(mode))
+    if mode == "flat":
+      self.dut.samples_flat_en.value = 1
+    elif hasattr(self.dut, "samples_flat_en"):
+      self.dut.samples_flat_en.value = 0
+    self.drive_mode = mode
+
+  def pack_samples( self, data ):
+    """
+    Pack an orbit into one integer per bx for the samples_flat port,
+    sample i of a bx is bits [(i+1)*SAMPLE_WIDTH-1 : i*SAMPLE_WIDTH].
+    Raises ValueError for samples that do not fit into SAMPLE_WIDTH bits.
+    """
+    rows = np.asarray(data).astype(np.int64).reshape(-1, self.NSAMP)
+    if rows.size > 0 and (rows.min() < 0 or rows.max() >= 1 << self.SAMPLE_WIDTH):
+      raise ValueError("Samples out of range for SAMPLE_WIDTH " + str(self.SAMPLE_WIDTH) + ": " + str(rows.min()) + " ... " + str(rows.max()))
+    # reverse the samples of each bx, so the hex string of a bx is its word with sample 0 last (LSB)
+    rows = np.ascontiguousarray(rows[:, ::-1])
+    if self.SAMPLE_WIDTH in (8, 16, 32):
+      raw = rows.astype(">u" + str(self.SAMPLE_WIDTH // 8)).tobytes()
+    else:
+      # bits of the word MSB first, left-padded to whole bytes
+      bits = ((rows[:, :, None] >> np.arange(self.SAMPLE_WIDTH - 1, -1, -1)) & 1).astype(np.uint8).reshape(len(rows), -1)
+      raw = np.packbits(np.pad(bits, ((0, 0), (-bits.shape[1] % 8, 0))), axis=1).tobytes()
+    hex_data = binascii.hexlify(raw)
+    width = 2 * (-(-self.SAMPLE_WIDTH * self.NSAMP // 8))
+    return [int(hex_data[i:i + width], 16) for i in range(0, len(hex_data), width)]
+
+  def drive_baseline( self, value=128 ):
+    """
+    Set all samples of the bx to a constant value.
+    """
+    if self.drive_mode == "flat":
+      self._drive_bx_flat(self.pack_samples([value] * self.NSAMP)[0])
+    else:
+      self._drive_bx_element([value] * self.NSAMP)
+
+  def _drive_bx_element( self, row ):
+    for i in range(self.NSAMP):
+      self.dut.samples[i].value = row[i]
+
+  def _drive_bx_flat( self, word ):
+    self.dut.samples_flat.value = word
+
   @cocotb.coroutine
-  def drive_samples( self, clk, input_signal, data, plot = False ):
+  def drive_samples( self, clk, input_signal, data, plot = False, windows = None ):
     """
-    Feeding data into samples input, one bx at a time.
+    Feeding data into samples input, one bx at a time (see set_drive_mode).
+    windows: list of (start_bx, stop_bx) to feed, the whole orbit by default.
+    The achieved rate, clock edges included, is kept in drive_rate (bx/s); the "drive" stage
+    only times the packing and the signal assignments of each bx, not the waits on the simulator.
     """
-    for bx in range( int (len(data) / self.NSAMP) ):
+    t_start = time.time()
+    with self.prof.stage("drive"):
+      if self.drive_mode == "flat":
+        drive_bx = self._drive_bx_flat
+        bx_data = self.pack_samples(data)
+      else:
+        drive_bx = self._drive_bx_element
+        bx_data = np.asarray(data).astype(int).reshape(-1, self.NSAMP).tolist()
+    if windows is None:
+      windows = [(0, len(bx_data))]
+    bx_seq = np.concatenate([np.arange(start, stop) for start, stop in windows] + [np.zeros(0, dtype=int)])
+    self.capture.add_segment(self.clk_cnt + 1, self.orb_cnt, data, bx_seq)
+    for bx in bx_seq.tolist():
+      token = self.prof.start("drive")
       self.bx_cnt = bx
-      for i in range(self.NSAMP):
-        self.dut.samples[i].value = int(data[ (bx*self.NSAMP) + i ])
+      self.clk_cnt += 1
+      drive_bx(bx_data[bx])
+      self.prof.stop(token)
       yield RisingEdge( clk )
+    n_bx = len(bx_seq)
+    self.prof.count("bx", n_bx)
+    self.prof.count("vpi_writes_est", n_bx * (1 if self.drive_mode == "flat" else self.NSAMP))
+    self.drive_rate = n_bx / max(time.time() - t_start, 1e-9)
+    self.dut._log.info("Orbit " + str(self.orb_cnt) + " driven at " + str(int(self.drive_rate)) + " bx/s (" + self.drive_mode + ")")
     # plot if needed
     if plot:
       x = [number/self.NSAMP for number in list(range(self.raw_orb_size - self.orb_excess))]
+      plt = pfu.pyplot()
       plt.plot(x, data)
       plt.show()
 
+  def sparse_windows( self, data ):
+    """
+    Pre-scan of an orbit for the sparse drive mode, returns the bx windows to simulate.
+    Zero-suppressed input already has its windows, the stored bx are taken without a scan.
+    Pulses of the last bx leave the pipeline in the next orbit, its first window covers them as in a full run.
+    """
+    with self.prof.stage("sparse_scan"):
+      if self.zs is not None:
+        active = self.zs.active(self.orb_cnt - 1)
+      else:
+        active = pfu.active_bx(data, self.NSAMP, band=self.sparse_band)
+      if self.sparse_model is not None:
+        active[self.sparse_model.process(data)["bx"]] = True
+      windows = pfu.bx_windows(active, self.sparse_pre, self.sparse_post, carry=self.sparse_carry)
+      self.sparse_carry = pfu.bx_overflow(active, self.sparse_post)
+      return windows
+
+  @cocotb.coroutine
+  def drive_orbit( self, clk, data ):
+    """
+    Feed one orbit: all bx, or in sparse mode only the pre-scanned windows.
+    bx_cnt always holds the true bx, so the pulse bookkeeping is the same in both modes.
+    """
+    if not self.sparse:
+      yield self.drive_samples(clk, self.dut.samples, data)
+      return
+    windows = self.sparse_windows(data)
+    if self.orb_cnt - self.orbit_start > self.sparse_check_orbits:
+      yield self.drive_samples(clk, self.dut.samples, data, windows=windows)
+      return
+    # self-check: full orbit first, then the sparse run into scratch stores
+    n_full = len(self.pulses)
+    yield self.drive_samples(clk, self.dut.samples, data)
+    yield self.flush_pipeline(clk)
+    full = self.pulses[n_full:]
+    kept = (self.pulses, self.waveforms, self.live_hist, self.consec_cnt)
+    self.pulses = pfu.PulseStore()
+    self.waveforms = pfu.WaveformStore(self.NSAMP)
+    self.live_hist = pfu.LiveHistograms(12, self.NSAMP, self.orb_size)
+    yield self.drive_samples(clk, self.dut.samples, data, windows=windows)
+    yield self.flush_pipeline(clk)
+    sparse = self.pulses
+    self.pulses, self.waveforms, self.live_hist, self.consec_cnt = kept
+    n_sparse_bx = sum(stop - start for start, stop in windows)
+    if np.array_equal(full.array, sparse.array):
+      self.dut._log.info(pfu.string_color("Sparse check orbit " + str(self.orb_cnt) + ": OK, " + str(len(full)) + " pulses, " + str(n_sparse_bx) + " bx simulated", "green"))
+    else:
+      self.sparse_mismatches += 1
+      self.dut._log.warning(pfu.string_color("Sparse check orbit " + str(self.orb_cnt) + ": " + str(len(full)) + " pulses in full run, " + str(len(sparse)) + " in sparse run", "red"))
+
+  def check_sparse( self ):
+    """
+    Fail the test if a sparse check orbit (see drive_orbit) differed from its full run.
+    """
+    if self.sparse_mismatches > 0:
+      raise RuntimeError("Sparse drive mismatch in " + str(self.sparse_mismatches) + " of " + str(self.sparse_check_orbits) + " check orbits")
+
+  @cocotb.coroutine
+  def flush_pipeline( self, clk ):
+    """
+    Hold the baseline until all pulses of the last fed bx left the pipeline.
+    """
+    self.drive_baseline(128)
+    self.capture.add_segment(self.clk_cnt + 1, self.orb_cnt, None, [-1] * self.sparse_post)
+    for i in range(self.sparse_post):
+      self.clk_cnt += 1
+      yield RisingEdge( clk )
+
+  def register_pulse( self, orbit, bx, amplitude, position, tot ):
+    """
+    Store a detected pulse and fill the live histograms.
+    """
+    self.pulses.add( orbit, bx, amplitude, position, tot )
+    self.live_hist.fill( bx, amplitude, position, tot )
+
+  def n_pulses( self ):
+    """
+    Number of detected pulses, flushed and buffered.
+    """
+    return len(self.pulses) + (self.results.n_pulses if self.results is not None else 0)
+
+  def open_results( self, filename, waveforms=False ):
+    """
+    Write the results incrementally to <filename>.h5 (see pfio.ResultsWriter), to be called after the reset
+    and register setup and before input_process. With <resume> and a checkpoint in the file the run continues
+    after the checkpoint orbit: counters and live histograms are restored and the input starts at the checkpoint position.
+    The DUT pipeline restarts empty, pulses still in flight at the checkpoint (last bx of the orbit) are not reproduced.
+    """
+    self.results = pfio.ResultsWriter(filename, self.NSAMP if waveforms else None, resume=self.resume)
+    state = self.results.state
+    if state is None:
+      return
+    self.orb_cnt = state["orbit"]
+    self.input_position = state["input_position"]
+    self.consec_cnt = state["consec_cnt"]
+    self.sparse_mismatches = state["sparse_mismatches"]
+    for block in self.results.iter_pulses():
+      self.live_hist.fill_pulses(block)
+    self.live_hist.orbits = self.orb_cnt - self.orbit_start
+    self.dut._log.info(pfu.string_color("Resuming after orbit " + str(self.orb_cnt) + " (" + str(self.results.n_pulses) + " pulses) from " + self.results.filename, "blue"))
+
+  def flush_results( self ):
+    """
+    Append the buffered pulses and waveforms to the results file and checkpoint the completed orbit.
+    """
+    with self.prof.stage("flush"):
+      self.results.append(self.pulses, self.waveforms)
+      self.input_position = self.orb_cnt
+      self.results.checkpoint(self.orb_cnt, self.input_position, consec_cnt=self.consec_cnt, sparse_mismatches=self.sparse_mismatches)
+      self.pulses.clear()
+      self.waveforms.clear()
+
+  def close_results( self, metadata ):
+    """
+    Flush the rest of the run and finish the results file with the run metadata.
+    """
+    self.results.append(self.pulses, self.waveforms)
+    self.pulses.clear()
+    self.waveforms.clear()
+    return self.results.close(metadata)
+
+  def orbit_done( self ):
+    """
+    Bookkeeping after an orbit was fed: live histogram snapshots, flushing results.
+    """
+    self.live_hist.orbits = self.orb_cnt - self.orbit_start
+    self.prof.count("orbits")
+    if self.results is not None and self.flush_every > 0 and self.live_hist.orbits % self.flush_every == 0:
+      self.flush_results()
+    if self.snapshot_every > 0 and self.snapshot_path is not None and self.orb_cnt % self.snapshot_every == 0:
+      self.live_hist.save( self.snapshot_path )
+      self.dut._log.info("Orbit " + str(self.orb_cnt) + ": " + str(self.n_pulses()) + " pulses, histograms saved to " + self.snapshot_path)
+
+  def profile_report( self, filename=None ):
+    """
+    Stage times, counters, rates and the simulated to wall time ratio of the run (see pfu.StageProfiler),
+    logged and saved as JSON to <filename>.
+    """
+    self.prof.counters["pulses"] = self.n_pulses()
+    report = self.prof.report(get_sim_time("ns"))
+    if filename is not None:
+      self.prof.save(filename, report)
+    for name, stage in report["stages"].items():
+      self.dut._log.info("Stage %-12s %8.2f s %6.1f %% (%d calls)" % (name, stage["time"], 100 * stage["fraction"], stage["calls"]))
+    self.dut._log.info("%.0f bx/s, %.2f orbits/s, %.0f pulses/s, sim/wall %.3g" % (report["rates"].get("bx/s", 0), report["rates"].get("orbits/s", 0), report["rates"]["pulses/s"], report["sim_wall_ratio"]))
+    return report
+
   @cocotb.coroutine
   def prallel_producer( self ):
     """
@@ -137,160 +435,345 @@ class PeakfinderTB( object ):
     while True:
       yield [ RisingEdge(self.dut.peaks[i]) for i in range(self.NSAMP) ]
       yield ReadOnly()
-      detected_pulse = pfu.pulse( orbit=self.orb_cnt, bx=self.bx_cnt, amplitude=int(self.dut.local_maximum), position=int(math.log(int(self.dut.peaks),2)), tot=int(self.dut.time_over_threshold) )
-      self.pulses.append( detected_pulse )
+      with self.prof.stage("producer"):
+        self.register_pulse( orbit=self.orb_cnt, bx=self.bx_cnt, amplitude=int(self.dut.local_maximum), position=int(math.log(int(self.dut.peaks),2)), tot=int(self.dut.time_over_threshold) )
+      self.prof.count("vpi_reads_est", 3)
       trig = True
       while trig:
         yield RisingEdge( self.dut.bunch_clk )
         yield ReadOnly()
+        self.prof.count("vpi_reads_est")
         if int(self.dut.peaks) > 0:
           # self.dut._log.info( pfu.string_color("CONSECUTIVE", "yellow") )
           self.consec_cnt += 1
-          detected_pulse = pfu.pulse( orbit=self.orb_cnt, bx=self.bx_cnt, amplitude=int(self.dut.local_maximum), position=int(math.log(int(self.dut.peaks),2)), tot=int(self.dut.time_over_threshold) )
-          self.pulses.append( detected_pulse )
+          with self.prof.stage("producer"):
+            self.register_pulse( orbit=self.orb_cnt, bx=self.bx_cnt, amplitude=int(self.dut.local_maximum), position=int(math.log(int(self.dut.peaks),2)), tot=int(self.dut.time_over_threshold) )
+          self.prof.count("vpi_reads_est", 3)
           trig = True
         else:
           trig = False
 
+  def buffer_dut_waveforms( self ):
+    """
+    Sample the DUT waveform signals of this clock (waveform_source "dut" only).
+    """
+    self.sample_buffer.append([x.integer for x in self.dut.derivative_peakfinder_inst.samples.value])
+    self.deriv_buffer.append([x.signed_integer for x in self.dut.derivative_peakfinder_inst.deriv_s.value])
+    self.prof.count("vpi_reads_est", 2)
+
+  def capture_waveforms( self ):
+    """
+    Store the sample and derivative waveforms of a detection on the current clock.
+    """
+    if self.waveform_source == "dut":
+      self.waveforms.add(orbit=self.orb_cnt, bx=self.bx_cnt, type="sample", waveform=self.sample_buffer.get()[0])
+      self.waveforms.add(orbit=self.orb_cnt, bx=self.bx_cnt, type="derivative", waveform=self.deriv_buffer.get()[0][::-1])
+    else:
+      captured = self.capture.capture(self.clk_cnt)
+      if captured is not None:
+        orbit, bx, samples, derivative = captured
+        self.waveforms.add(orbit=self.orb_cnt, bx=self.bx_cnt, type="sample", waveform=samples)
+        self.waveforms.add(orbit=self.orb_cnt, bx=self.bx_cnt, type="derivative", waveform=derivative)
+    for name in self.capture_signals:
+      value = getattr(self.dut.derivative_peakfinder_inst, name).value
+      self.waveforms.add(orbit=self.orb_cnt, bx=self.bx_cnt, type=name, waveform=[x.signed_integer for x in value])
+
   @cocotb.coroutine
   def derivative_producer( self ):
     """
     Registering detected pulses for the
     derivative_peakfinder.vhd peak finder.
+    Waveforms are captured on detection only (see capture_waveforms).
     TODO: Yield for something else than rising edge.
     TODO: "No coroutines waiting on trigger that fired: RisingEdge(peaks(1))" -> solved with yielding to ReadOnly after RisingEdge
     """
     while True:
       yield RisingEdge(self.dut.clk)
-      # store waveforms
-      self.sample_buffer.append(self.dut.derivative_peakfinder_inst.samples.value)
-      self.deriv_buffer.append(self.dut.derivative_peakfinder_inst.deriv_s.value)
+      if self.waveform_source == "dut":
+        self.buffer_dut_waveforms()
       # peak detect
+      self.prof.count("vpi_reads_est")
       if self.dut.peaks.value == 0:
         continue
-      if self.dut.peaks==3 or self.dut.peaks==5 or self.dut.peaks==6 or self.dut.peaks==7:
-        self.dut._log.info( pfu.string_color("Double Pulse!", "yellow") )
-      for i in range( self.dut.NPEAKSMAX.value ):
-        if int(self.dut.peaks[i].value) > 0:
-          detected_pulse = pfu.pulse( orbit=self.orb_cnt, bx=self.bx_cnt, amplitude=int(self.dut.peaks_val[i]), position=int(self.dut.peaks_pos[i]), tot=None )
-          self.pulses.append( detected_pulse )
-      # append waveforms
-      sample_converted = [x.integer for x in self.sample_buffer.get()[0]]
-      self.waveforms.append(pfu.waveform(orbit=self.orb_cnt, bx=self.bx_cnt, type="sample", waveform=sample_converted))
-      derivative_converted = [x.signed_integer for x in self.deriv_buffer.get()[0]]
-      derivative_converted.reverse()
-      self.waveforms.append(pfu.waveform(orbit=self.orb_cnt, bx=self.bx_cnt, type="derivative", waveform=derivative_converted))
+      with self.prof.stage("producer"):
+        if self.dut.peaks==3 or self.dut.peaks==5 or self.dut.peaks==6 or self.dut.peaks==7:
+          self.dut._log.info( pfu.string_color("Double Pulse!", "yellow") )
+        for i in range( self.dut.NPEAKSMAX.value ):
+          if int(self.dut.peaks[i].value) > 0:
+            self.register_pulse( orbit=self.orb_cnt, bx=self.bx_cnt, amplitude=int(self.dut.peaks_val[i]), position=int(self.dut.peaks_pos[i]), tot=None )
+            self.prof.count("vpi_reads_est", 2)
+        self.prof.count("vpi_reads_est", self.dut.NPEAKSMAX.value)
+        # append waveforms
+        self.capture_waveforms()
       trig = True
       while trig:
         yield RisingEdge( self.dut.clk )
-        # store waveforms
-        self.sample_buffer.append(self.dut.derivative_peakfinder_inst.samples.value)
-        self.deriv_buffer.append(self.dut.derivative_peakfinder_inst.deriv_s.value)
+        if self.waveform_source == "dut":
+          self.buffer_dut_waveforms()
         yield ReadOnly()
+        self.prof.count("vpi_reads_est")
         if int(self.dut.peaks) > 0:
-          for i in range( self.dut.NPEAKSMAX.value ):
-            if self.dut.peaks[i]:
-              # self.dut._log.info( pfu.string_color("CONSECUTIVE", "yellow") )
-              self.consec_cnt += 1
-              detected_pulse = pfu.pulse( orbit=self.orb_cnt, bx=self.bx_cnt, amplitude=int(self.dut.peaks_val[i]), position=int(self.dut.peaks_pos[i]), tot=None )
-              self.pulses.append( detected_pulse )
+          with self.prof.stage("producer"):
+            for i in range( self.dut.NPEAKSMAX.value ):
+              if self.dut.peaks[i]:
+                # self.dut._log.info( pfu.string_color("CONSECUTIVE", "yellow") )
+                self.consec_cnt += 1
+                self.register_pulse( orbit=self.orb_cnt, bx=self.bx_cnt, amplitude=int(self.dut.peaks_val[i]), position=int(self.dut.peaks_pos[i]), tot=None )
+                self.prof.count("vpi_reads_est", 2)
+            self.prof.count("vpi_reads_est", self.dut.NPEAKSMAX.value)
           trig = True
         else:
           trig = False
 
-  def simulation_producer( self, data ):
-    for i, d in enumerate( data ):
-      if d < THR:
-        prev = False
-        continue
-      elif d > THR and prev == True:
-        prev = True
-      #if prev == True:
-
-    # derivative = pfu.snrd( data, 7 )
+  def simulation_producer( self, data, model ):
+    """
+    Registering detected pulses of one orbit with a software model
+    of the peak finder (see peakfinder_models) instead of the simulator.
+    Orbits are fed back to back, consecutive pulses across the orbit boundary are counted as in the HDL.
+    """
+    # models with consecutive pulses keep the last pulse of the previous orbit (see pfm.ParallelAnalyzerModel.process)
+    peaks = model.process( data, first_orbit=self.orb_cnt, **({"continued": True} if hasattr(model, "last_clock") else {}) )
+    pulses = model.pulses(peaks)
+    self.pulses.extend( pulses )
+    self.live_hist.fill_pulses( pulses )
+    if "consec" in peaks.dtype.names:
+      self.consec_cnt += int( np.count_nonzero(peaks["consec"]) )
+    if hasattr( model, "waveforms" ):
+      self.waveforms.extend( model.waveforms(data, peaks, first_orbit=self.orb_cnt) )
+    return len( peaks )
 
   def shiftToMask(self, mask, data):
-    shift_val = 0
-    mask_copy = mask
-    while (mask_copy & 0x1 == 0):
-      mask_copy = mask_copy >> 1
-      shift_val += 1
-    return (data << shift_val) & mask
+    # same register field packing as the software models
+    return pfm.shift_to_mask(mask, data)
 
   def shiftFromMask(self, mask, data):
-    shift_val = 0
-    mask_copy = mask
-    while (mask_copy & 0x1 == 0):
-      mask_copy = mask_copy >> 1
-      shift_val += 1
-    return (data & mask) >> shift_val
+    return pfm.shift_from_mask(mask, data)
+
+  @cocotb.coroutine
+  def _ipb_read(self, addr):
+    """
+    One IPbus read transaction, returns the register word (also stored in the shadow).
+    """
+    with self.prof.stage("ipbus"):
+      self.prof.count("ipbus_transactions")
+      self.prof.count("vpi_writes_est", 8)
+      yield RisingEdge(self.dut.ipb_clk)
+      self.dut.ipb_mosi_i.ipb_strobe.value = 1
+      self.dut.ipb_mosi_i.ipb_write.value = 0
+      self.dut.ipb_mosi_i.ipb_addr.value = addr
+      self.dut.ipb_mosi_i.ipb_wdata.value = 0
+      yield RisingEdge(self.dut.ipb_clk)
+      res = int(self.dut.ipb_miso_o.ipb_rdata.value)
+      timeout = 0
+      while (self.dut.ipb_miso_o.ipb_ack.value == 0):
+        yield RisingEdge(self.dut.ipb_clk)
+        res = int(self.dut.ipb_miso_o.ipb_rdata.value)
+        timeout += 1
+        if timeout >= 10:
+          raise RuntimeError("Failed IPbus read")
+      self.dut.ipb_mosi_i.ipb_strobe.value = 0
+      self.dut.ipb_mosi_i.ipb_write.value = 0
+      self.dut.ipb_mosi_i.ipb_addr.value = 0
+      self.dut.ipb_mosi_i.ipb_wdata.value = 0
+    self.shadow[addr] = res
+    return res
+
+  @cocotb.coroutine
+  def _ipb_write(self, addr, word):
+    """
+    One IPbus write transaction of a full register word, skipped if the shadow already holds it.
+    """
+    if self.skip_unchanged and self.shadow.get(addr) == word:
+      self.prof.count("ipbus_skipped")
+      return
+    with self.prof.stage("ipbus"):
+      self.prof.count("ipbus_transactions")
+      self.prof.count("vpi_writes_est", 8)
+      yield RisingEdge(self.dut.ipb_clk)
+      self.dut.ipb_mosi_i.ipb_strobe.value = 1
+      self.dut.ipb_mosi_i.ipb_write.value = 1
+      self.dut.ipb_mosi_i.ipb_addr.value = addr
+      self.dut.ipb_mosi_i.ipb_wdata.value = word
+      yield RisingEdge(self.dut.ipb_clk)
+      timeout = 0
+      while (self.dut.ipb_miso_o.ipb_ack.value == 0):
+        yield RisingEdge(self.dut.ipb_clk)
+        timeout += 1
+        if timeout >= 10:
+          raise RuntimeError("Failed IPbus write")
+      self.dut.ipb_mosi_i.ipb_strobe.value = 0
+      self.dut.ipb_mosi_i.ipb_write.value = 0
+      self.dut.ipb_mosi_i.ipb_addr.value = 0
+      self.dut.ipb_mosi_i.ipb_wdata.value = 0
+    self.shadow[addr] = word
+
+  @cocotb.coroutine
+  def shadow_word(self, addr):
+    """
+    Register word from the shadow, read from the DUT once if not known yet.
+    """
+    if addr not in self.shadow:
+      yield self._ipb_read(addr)
+    return self.shadow[addr]
 
   @cocotb.coroutine
   def read(self, reg_name, applyMask=True):
     if not (reg_name in self.reg_map.keys()):
       raise ValueError("Failed IPbus read: unknown register")
-      return []
-    yield RisingEdge(self.dut.ipb_clk)
-    self.dut.ipb_mosi_i.ipb_strobe.value = 1
-    self.dut.ipb_mosi_i.ipb_write.value = 0
-    self.dut.ipb_mosi_i.ipb_addr.value = int(self.reg_map[reg_name][0])
-    self.dut.ipb_mosi_i.ipb_wdata.value = 0
-    yield RisingEdge(self.dut.ipb_clk)
-    res = self.shiftFromMask(self.reg_map[reg_name][1], int(self.dut.ipb_miso_o.ipb_rdata.value)) if applyMask else int(
-      self.dut.ipb_miso_o.ipb_rdata.value)
-    timeout = 0
-    while (self.dut.ipb_miso_o.ipb_ack.value == 0):
-      yield RisingEdge(self.dut.ipb_clk)
-      res = self.shiftFromMask(self.reg_map[reg_name][1], int(self.dut.ipb_miso_o.ipb_rdata.value)) if applyMask else int(
-        self.dut.ipb_miso_o.ipb_rdata.value)
-      timeout += 1
-      if timeout >= 10:
-        raise RuntimeError("Failed IPbus read")
-        break
-    self.dut.ipb_mosi_i.ipb_strobe.value = 0
-    self.dut.ipb_mosi_i.ipb_write.value = 0
-    self.dut.ipb_mosi_i.ipb_addr.value = 0
-    self.dut.ipb_mosi_i.ipb_wdata.value = 0
+    addr, mask = self.reg_map[reg_name]
+    word = yield self._ipb_read(int(addr))
+    res = self.shiftFromMask(mask, word) if applyMask else word
     self.dut.ipb_mosi_i._log.debug("Success IPbus read : %d" % (res))
     return [res]
 
   @cocotb.coroutine
   def write(self, reg_name, data):
+    """
+    Masked register write, the other fields of the address come from the shadow (no bus read once known).
+    """
     if not (reg_name in self.reg_map.keys()):
       raise ValueError("Failed IPbus write: unknown register")
-      return [1]
-    mask = self.reg_map[reg_name][1]
+    addr, mask = self.reg_map[reg_name]
     data_to_write = self.shiftToMask(mask, data)
     if mask != 0xffffffff:
-      current_value = yield self.read(reg_name, False)
-      data_to_write |= (current_value[0] & ~mask)
-    yield RisingEdge(self.dut.ipb_clk)
-    self.dut.ipb_mosi_i.ipb_strobe.value = 1
-    self.dut.ipb_mosi_i.ipb_write.value = 1
-    self.dut.ipb_mosi_i.ipb_addr.value = int(self.reg_map[reg_name][0])
-    self.dut.ipb_mosi_i.ipb_wdata.value = data_to_write
-    yield RisingEdge(self.dut.ipb_clk)
-    timeout = 0
-    while (self.dut.ipb_miso_o.ipb_ack.value == 0):
-      yield RisingEdge(self.dut.ipb_clk)
-      timeout += 1
-      if timeout >= 10:
-        raise RuntimeError("Failed IPbus write")
-        break
-    self.dut.ipb_mosi_i.ipb_strobe.value = 0
-    self.dut.ipb_mosi_i.ipb_write.value = 0
-    self.dut.ipb_mosi_i.ipb_addr.value = 0
-    self.dut.ipb_mosi_i.ipb_wdata.value = 0
+      current_value = yield self.shadow_word(int(addr))
+      data_to_write |= (current_value & ~mask)
+    yield self._ipb_write(int(addr), data_to_write)
     self.dut.ipb_mosi_i._log.debug("Success IPbus write")
     return [0]
 
+  @cocotb.coroutine
+  def write_many(self, values, verify=False):
+    """
+    Write several registers, values: list of (reg_name, data) or dict.
+    Fields of the same address are merged, so every address is written once (in order of first appearance).
+    With verify, all written addresses are read back at the end (see verify_registers).
+    """
+    if isinstance(values, dict):
+      values = list(values.items())
+    words = {}
+    for reg_name, data in values:
+      if not (reg_name in self.reg_map.keys()):
+        raise ValueError("Failed IPbus write: unknown register")
+      addr, mask = self.reg_map[reg_name]
+      addr = int(addr)
+      if addr not in words:
+        words[addr] = 0
+        if mask != 0xffffffff:
+          words[addr] = yield self.shadow_word(addr)
+      words[addr] = (words[addr] & ~mask) | self.shiftToMask(mask, data)
+    for addr, word in words.items():
+      yield self._ipb_write(addr, word)
+    if verify:
+      yield self.verify_registers(list(words.keys()))
+    return [0]
+
+  @cocotb.coroutine
+  def verify_registers(self, addrs=None):
+    """
+    Read back the registers (all shadowed addresses by default) and compare the fields of reg_map with the shadow.
+    """
+    if addrs is None:
+      addrs = sorted(self.shadow.keys())
+    mismatches = []
+    for addr in addrs:
+      mask = 0
+      for reg_addr, reg_mask in self.reg_map.values():
+        if int(reg_addr) == addr:
+          mask |= reg_mask
+      expected = self.shadow[addr]
+      actual = yield self._ipb_read(addr)
+      if (actual ^ expected) & mask:
+        mismatches.append("0x%x: wrote 0x%08x, read 0x%08x" % (addr, expected, actual))
+    if len(mismatches) > 0:
+      raise RuntimeError("IPbus readback mismatch: " + ", ".join(mismatches))
+    self.dut._log.info(pfu.string_color("Verified " + str(len(addrs)) + " registers.", "blue"))
+
 
 ###############################
 ## TEST FUNCTIONS
 ###############################
+def run_derivative_model( dut, iter_max=100 ):
+  """
+  Software model of derivative_peakfinder.vhd, same settings as derivative_test.
+  Needs no simulator: dut only provides the generics and the log (e.g. peakfinder_mock.MockDUT).
+  """
+  tb = PeakfinderTB( dut )
+  iter_max = pfu.test_param("orbits", iter_max)
+  model = pfm.DerivativePeakfinderModel( NSAMP=tb.NSAMP, NPEAKSMAX=int(dut.NPEAKSMAX), NBINS=tb.NBINS, orb_size=tb.orb_size )
+  # Setting thresholds
+  top = pfu.test_param("top", 1)
+  deriv_thr = pfu.test_param("deriv_thr", 5)
+  val_thr = pfu.test_param("val_thr", 40)
+  model.write("top", top)
+  model.write("deriv_thr", deriv_thr)
+  model.write("val_thr", val_thr)
+  # process input
+  tb.input_process()
+  while True:
+    tb.orb_cnt += 1
+    if iter_max > 0 and tb.orb_cnt > tb.orbit_start + iter_max: break
+    data = tb.input_get_next_orbit()
+    # input without data (DAQ request missing in its file), the orbit number stays reserved for it
+    if data is None: continue
+    if len(data) == 0: break
+    tb.simulation_producer( data, model )
+    tb.orbit_done()
+  tb.input_close()
+
+  dut._log.info("Quick stat: Detected " + str(len(tb.pulses)) + " pulses")
+  name = tb.results_dir + "/DERIVATIVEMODEL"+tb.input_filename+"_deriv_thr"+str(deriv_thr)+"_val_thr"+str(val_thr)
+  pfio.write_results( name, tb.pulses, tb.waveforms, tb.metadata(top=top, deriv_thr=deriv_thr, val_thr=val_thr) )
+  # bx x bin occupancy as reported in peaks_bins
+  occupancy = pfb.BinOccupancy( tb.NBINS, tb.orb_size, model.lut )
+  occupancy.fill_pulses( tb.pulses )
+  occupancy.orbits = tb.orb_cnt - 1 - tb.orbit_start
+  occupancy.save( name + "_bins.npz" )
+  return tb
+
 @cocotb.test()
-def derivative_model( dut ):
-  pass
+def derivative_model( dut, iter_max=100 ):
+  """
+  Software model of derivative_peakfinder.vhd in the simulator (see run_derivative_model)
+  """
+  run_derivative_model( dut, iter_max )
+  yield Timer(1)
+
+def run_parallel_model( dut, iter_max=2 ):
+  """
+  Software model of parallel_analyzer.vhd, same settings as parallel_test.
+  Needs no simulator: dut only provides the generics and the log (e.g. peakfinder_mock.MockDUT).
+  """
+  tb = PeakfinderTB( dut )
+  iter_max = pfu.test_param("orbits", iter_max)
+  level_threshold = pfu.test_param("level_threshold", 130)
+  tot_threshold = pfu.test_param("tot_threshold", 3)
+  model = pfm.ParallelAnalyzerModel( level_threshold=level_threshold, tot_threshold=tot_threshold, NSAMP=tb.NSAMP, orb_size=tb.orb_size )
+  # process input
+  tb.input_process()
+  while True:
+    tb.orb_cnt += 1
+    if iter_max > 0 and tb.orb_cnt > tb.orbit_start + iter_max: break
+    data = tb.input_get_next_orbit()
+    # input without data (DAQ request missing in its file), the orbit number stays reserved for it
+    if data is None: continue
+    if len(data) == 0: break
+    tb.simulation_producer( data, model )
+    tb.orbit_done()
+  tb.input_close()
+
+  dut._log.info( pfu.string_color("Quick stat: Detected ", "green") + pfu.string_color( str(len(tb.pulses)), "yellow") + pfu.string_color(" pulses", "green") )
+  dut._log.info( pfu.string_color("Out of which ", "green") + pfu.string_color( str(tb.consec_cnt), "yellow") + pfu.string_color(" were consecutive.", "green") )
+  pfio.write_results( tb.results_dir + "/PARALLELMODEL"+tb.input_filename+"_lvlthr"+str(level_threshold)+"_totthr"+str(tot_threshold), tb.pulses, metadata=tb.metadata(level_threshold=level_threshold, tot_threshold=tot_threshold, consec_cnt=tb.consec_cnt) )
+  return tb
+
+@cocotb.test()
+def parallel_model( dut, iter_max=2 ):
+  """
+  Software model of parallel_analyzer.vhd in the simulator (see run_parallel_model)
+  """
+  run_parallel_model( dut, iter_max )
+  yield Timer(1)
 
 @cocotb.test()
 def parallel_test( dut, iter_max=2 ):
@@ -298,10 +781,11 @@ def parallel_test( dut, iter_max=2 ):
   Parallel_analyzer.vhd basic test function
   """
   tb = PeakfinderTB( dut )
+  iter_max = pfu.test_param("orbits", iter_max)
   # Setting thresholds
   dut._log.info(pfu.string_color("Setting thresholds.", "blue"))
-  level_threshold = 130
-  tot_threshold = 3
+  level_threshold = pfu.test_param("level_threshold", 130)
+  tot_threshold = pfu.test_param("tot_threshold", 3)
   dut.level_threshold.value = level_threshold
   dut.tot_threshold.value = tot_threshold
   # Start
@@ -312,21 +796,35 @@ def parallel_test( dut, iter_max=2 ):
   yield tb.reset( dut.clk, dut.ipb_rst )
   yield tb.reset( dut.clk, dut.srst )
   cocotb.fork( tb.prallel_producer() )
+  # results written every <flush_every> orbits, resumed from the last checkpoint with PFTB_RESUME
+  name = tb.results_dir + "/PARALLELTEST"+tb.input_filename+"_lvlthr"+str(level_threshold)+"_totthr"+str(tot_threshold)
+  tb.open_results( name )
   # process input
   tb.input_process()
+  # live histograms for monitoring
+  tb.snapshot_every = 10
+  tb.snapshot_path = name + "_live.npz"
   # inject
   while True:
     # count orbits
     tb.orb_cnt += 1
-    if iter_max>0 and tb.orb_cnt > iter_max: break
-    data = tb.input_get_next_orbit()
+    if iter_max > 0 and tb.orb_cnt > tb.orbit_start + iter_max: break
+    with tb.prof.stage("input"):
+      data = tb.input_get_next_orbit()
+    # input without data (DAQ request missing in its file), the orbit number stays reserved for it
+    if data is None: continue
     if len(data) == 0: break
     # Feed data
-    yield tb.drive_samples( clk=dut.clk, input_signal=dut.samples, data=data )
+    yield tb.drive_orbit( dut.clk, data )
+    tb.orbit_done()
+  tb.input_close()
+  tb.live_hist.save( tb.snapshot_path )
 
-  dut._log.info( pfu.string_color("Quick stat: Detected ", "green") + pfu.string_color( str(len(tb.pulses)), "yellow") + pfu.string_color(" pulses", "green") )
+  dut._log.info( pfu.string_color("Quick stat: Detected ", "green") + pfu.string_color( str(tb.n_pulses()), "yellow") + pfu.string_color(" pulses", "green") )
   dut._log.info( pfu.string_color("Out of which ", "green") + pfu.string_color( str(tb.consec_cnt), "yellow") + pfu.string_color(" were consecutive.", "green") )
-  pfu.write_pulses( "../results/PARALLELTEST"+tb.input_filename+"_lvlthr"+str(level_threshold)+"_totthr"+str(tot_threshold), tb.pulses )
+  with tb.prof.stage("write_results"):
+    tb.close_results( tb.metadata(level_threshold=level_threshold, tot_threshold=tot_threshold, consec_cnt=tb.consec_cnt) )
+  tb.profile_report( name + "_profile.json" )
 
 @cocotb.test()
 def derivative_test( dut, iter_max=100 ):
@@ -334,13 +832,9 @@ def derivative_test( dut, iter_max=100 ):
   Parallel_analyzer.vhd basic test function
   """
   tb = PeakfinderTB( dut )
+  iter_max = pfu.test_param("orbits", iter_max)
   # register map
-  tb.reg_map["deriv_thr"] = (0x0, 0x00000FFF)
-  tb.reg_map["top"] = (0x1, 0x0000000F)
-  tb.reg_map["val_thr"] = (0x2, 0x00000FFF)
-  tb.reg_map["bin_LUT_0"] = (0x3, 0xFFFFFFFF)
-  tb.reg_map["bin_LUT_1"] = (0x4, 0xFFFFFFFF)
-  tb.reg_map["bin_LUT_2"] = (0x5, 0xFFFFFFFF)
+  tb.reg_map.update( pfm.DERIVATIVE_REG_MAP )
   # init ipb and samples
   dut.ipb_rst.value = 1
   dut.rst.value = 1
@@ -350,20 +844,17 @@ def derivative_test( dut, iter_max=100 ):
   dut.ipb_mosi_i.ipb_wdata.value = 0
   for i in range(tb.NSAMP):
     dut.samples[i].value = 0
+  tb.set_drive_mode("flat")
+  # PFTB_SPARSE: simulate only the bx around pulses, the first PFTB_SPARSE_CHECK orbits are checked against full runs
+  tb.sparse = pfu.test_param("sparse", False)
+  tb.sparse_check_orbits = pfu.test_param("sparse_check", 0)
   # Setting thresholds
   dut._log.info(pfu.string_color("Setting thresholds.", "blue"))
-  top = 1
-  deriv_thr = 5
-  val_thr = 40
+  top = pfu.test_param("top", 1)
+  deriv_thr = pfu.test_param("deriv_thr", 5)
+  val_thr = pfu.test_param("val_thr", 40)
   # Bin LUTs
-  lut = [int((i * tb.NBINS) / tb.NSAMP) for i in range(tb.NSAMP)]
-  lut_0 = 0
-  lut_1 = 0
-  lut_2 = 0
-  for i in range(10):
-    lut_0 |= lut[i] << 3 * i
-    lut_1 |= lut[i + 10] << 3 * i
-    lut_2 |= lut[i + 20] << 3 * i
+  lut_0, lut_1, lut_2 = pfb.encode_bin_lut( pfb.bin_lut(tb.NSAMP, tb.NBINS) )
   # Start
   dut._log.info(pfu.string_color("Starting bunch clock.", "blue"))
   cocotb.fork(Clock(dut.clk, 25000, 'ps').start())
@@ -371,48 +862,46 @@ def derivative_test( dut, iter_max=100 ):
   cocotb.fork(Clock(dut.ipb_clk, 32500, 'ps').start())
   yield tb.reset(dut.clk, dut.ipb_rst)
   yield tb.reset(dut.clk, dut.rst)
-  # now write ipbus registers
-  yield tb.write("top", top)
-  yield tb.write("deriv_thr", deriv_thr)
-  yield tb.write("val_thr", val_thr)
-  yield tb.write("bin_LUT_0", lut_0)
-  yield tb.write("bin_LUT_1", lut_1)
-  yield tb.write("bin_LUT_2", lut_2)
+  # now write ipbus registers, one transaction per address, read back at the end with PFTB_VERIFY_REGISTERS
+  yield tb.write_many([("top", top), ("deriv_thr", deriv_thr), ("val_thr", val_thr), ("bin_LUT_0", lut_0), ("bin_LUT_1", lut_1), ("bin_LUT_2", lut_2)], verify=pfu.test_param("verify_registers", False))
   # run producer
   cocotb.fork( tb.derivative_producer() )
+  doSweep = pfu.test_param("sweep", True)
+  if doSweep:
+    tb.input_source = "synthetic"
+  # results written every <flush_every> orbits, resumed from the last checkpoint with PFTB_RESUME
+  name = tb.results_dir + "/DERIVATIVETEST"+tb.input_filename+"_deriv_thr"+str(deriv_thr)+"_val_thr"+str(val_thr)
+  tb.open_results( name, waveforms=True )
   # process input
   tb.input_process()
+  # live histograms for monitoring
+  tb.snapshot_every = 10
+  tb.snapshot_path = name + "_live.npz"
   # inject
   while True:
     # Orbit
     dut._log.info("Injecting orbit # " + str(tb.orb_cnt))
     # count orbits
     tb.orb_cnt += 1
-    if iter_max > 0 and tb.orb_cnt > iter_max: break
-    doSweep = True
-    if not doSweep:
+    if iter_max > 0 and tb.orb_cnt > tb.orbit_start + iter_max: break
+    with tb.prof.stage("input"):
       data = tb.input_get_next_orbit()
-    else:
-      if tb.orb_cnt < 10:
-        data = np.ones(tb.orb_size*tb.NSAMP)
-        data = data*128 # baseline
-        rise_step = 4
-        rise_width = 8
-        fall_rise_ratio = 4
-        bx_id = 200
-        offset = 20
-        for i in range(rise_width):
-          data[bx_id*tb.NSAMP + offset + tb.orb_cnt + i] = data[bx_id*tb.NSAMP + offset + tb.orb_cnt + i - 1] + rise_step
-        for i in range(fall_rise_ratio*rise_width):
-          data[bx_id * tb.NSAMP + offset + tb.orb_cnt + rise_width + i] = data[bx_id * tb.NSAMP + offset + tb.orb_cnt + rise_width + i - 1] - int(rise_step/fall_rise_ratio)
-      else:
-        data = []
+    # input without data (DAQ request missing in its file), the orbit number stays reserved for it
+    if data is None: continue
     if len(data) == 0: break
     # Feed data
-    yield tb.drive_samples(clk=dut.clk, input_signal=dut.samples, data=data)
+    yield tb.drive_orbit(dut.clk, data)
+    tb.orbit_done()
+  tb.input_close()
+  tb.live_hist.save( tb.snapshot_path )
 
-  dut._log.info("Quick stat: Detected " + str(len(tb.pulses)) + " pulses")
-  pfu.write_pulses( "../results/DERIVATIVETEST"+tb.input_filename+"_deriv_thr"+str(deriv_thr)+"_val_thr"+str(val_thr), tb.pulses, tb.waveforms )
+  dut._log.info("Quick stat: Detected " + str(tb.n_pulses()) + " pulses")
+  with tb.prof.stage("write_results"):
+    tb.close_results( tb.metadata(top=top, deriv_thr=deriv_thr, val_thr=val_thr) )
+  if tb.truth is not None:
+    np.save( name + "_truth.npy", tb.truth.array )
+  tb.profile_report( name + "_profile.json" )
+  tb.check_sparse()
 
 
 
@@ -422,6 +911,8 @@ def derivative_test( dut, iter_max=100 ):
 # # Specify permutations
 # # and generate the tests
 # ###########################
+# The same grid on the parallel_analyzer software model, all channels in parallel:
+#   python peakfinder_sweep.py parallel <raw_data_path>/stable_1000orbits_bcm1f.crate*.bin --level-threshold 130 132 134 136 140 142 --tot-threshold 2 3 4
 # factory = TestFactory(run_test)
 # factory.add_option("filename",
 #                    ["crate1.amc1_chA", "crate1.amc1_chC", "crate1.amc2_chA", "crate1.amc2_chC", "crate2.amc1_chA", "crate2.amc1_chC", "crate2.amc2_chA", "crate2.amc2_chC"])
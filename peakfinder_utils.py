@@ -1,13 +1,41 @@
 ################################################
 # Common utilities for peak finder testbenches.
 ################################################
-import matplotlib
-matplotlib.use('Qt4Agg')
-import matplotlib.pyplot as plt
 import numpy as np
+import os
 import csv
+import collections
+import contextlib
+import json
 import sys
-import struct
+import time
+import peakfinder_io as pfio
+
+# matplotlib.pyplot, imported on first use (see pyplot)
+_plt = None
+# matplotlib backends that render to files only, plt.show() does nothing with them
+NON_INTERACTIVE_BACKENDS = ( "agg", "cairo", "pdf", "pgf", "ps", "svg", "template" )
+
+def pyplot():
+  """
+  matplotlib.pyplot, imported on first use, so simulations and workers that never plot don't load it.
+  The backend is the non-interactive Agg (headless farm nodes) unless MPLBACKEND is set,
+  e.g. MPLBACKEND=Qt5Agg for interactive windows.
+  """
+  global _plt
+  if _plt is None:
+    import matplotlib
+    if "MPLBACKEND" not in os.environ and "matplotlib.pyplot" not in sys.modules:
+      matplotlib.use( "Agg" )
+    import matplotlib.pyplot
+    _plt = matplotlib.pyplot
+  return _plt
+
+def interactive_backend():
+  """
+  True if pyplot() shows windows, i.e. MPLBACKEND is set to an interactive backend.
+  """
+  return pyplot().get_backend().lower() not in NON_INTERACTIVE_BACKENDS
 
 class pulse( object ):
   """
@@ -18,6 +46,8 @@ class pulse( object ):
   position: Pulse/peak position within bx
   tot: Time over Threshold
   """
+  __slots__ = ( "orbit", "bx", "amplitude", "position", "tot" )
+
   def __init__( self, orbit, bx, amplitude, position, tot ):
     self.orbit = orbit
     self.bx = bx
@@ -39,6 +69,314 @@ class waveform( object ):
     self.type = type
     self.waveform = waveform
 
+# Column layout of stored pulses, tot is NO_TOT for peak finders without time over threshold
+PULSE_DTYPE = np.dtype( [("orbit", np.int64), ("bx", np.int32), ("amplitude", np.int32), ("position", np.int32), ("tot", np.int32)] )
+NO_TOT = -1
+
+class ChunkedStore( object ):
+  """
+  Append-only store of rows of a structured dtype.
+  Single rows are appended into preallocated chunks, arrays of rows are appended in bulk.
+  """
+  def __init__( self, dtype, data=None, chunk_size=65536 ):
+    self.dtype = np.dtype( dtype )
+    self.chunk_size = chunk_size
+    self._chunks = []
+    self._buf = np.zeros( chunk_size, dtype=self.dtype )
+    self._n = 0
+    if data is not None:
+      self.extend( data )
+
+  def add_row( self, row ):
+    """
+    Append a single row (tuple in dtype field order).
+    """
+    if self._n == len(self._buf):
+      self._chunks.append( self._buf )
+      self._buf = np.zeros( self.chunk_size, dtype=self.dtype )
+      self._n = 0
+    self._buf[self._n] = row
+    self._n += 1
+
+  def extend( self, rows ):
+    """
+    Append a store or an array of rows.
+    """
+    if isinstance( rows, ChunkedStore ):
+      rows = rows.array
+    if len(rows) > 0:
+      self._flush()
+      self._chunks.append( np.asarray(rows, dtype=self.dtype) )
+
+  def _flush( self ):
+    if self._n > 0:
+      self._chunks.append( self._buf[:self._n].copy() )
+      self._n = 0
+
+  def clear( self ):
+    self._chunks = []
+    self._n = 0
+
+  def truncate( self, n ):
+    """
+    Keep only the first n rows.
+    """
+    data = self.array[:n].copy()
+    self.clear()
+    self.extend( data )
+
+  @property
+  def array( self ):
+    """
+    All rows as one array (chunks are merged once, on demand).
+    """
+    self._flush()
+    if len(self._chunks) != 1:
+      self._chunks = [ np.concatenate(self._chunks) if len(self._chunks) > 0 else np.zeros(0, dtype=self.dtype) ]
+    return self._chunks[0]
+
+  def __len__( self ):
+    return sum( len(c) for c in self._chunks ) + self._n
+
+class PulseStore( ChunkedStore ):
+  """
+  Columnar, append-only store of detected pulses (see PULSE_DTYPE).
+  Iterating or indexing with an int gives pulse() objects for compatibility,
+  indexing with a slice or mask gives a new PulseStore.
+  """
+  def __init__( self, data=None, chunk_size=65536 ):
+    ChunkedStore.__init__( self, PULSE_DTYPE, data, chunk_size )
+
+  @classmethod
+  def from_columns( cls, orbit, bx, amplitude, position, tot=None ):
+    data = np.zeros( len(orbit), dtype=PULSE_DTYPE )
+    data["orbit"] = orbit
+    data["bx"] = bx
+    data["amplitude"] = amplitude
+    data["position"] = position
+    data["tot"] = NO_TOT if tot is None else tot
+    return cls( data )
+
+  def add( self, orbit, bx, amplitude, position, tot=None ):
+    """
+    Append a single pulse.
+    """
+    self.add_row( (orbit, bx, amplitude, position, NO_TOT if tot is None else tot) )
+
+  def append( self, pls ):
+    self.add( pls.orbit, pls.bx, pls.amplitude, pls.position, pls.tot )
+
+  def extend( self, pulses ):
+    """
+    Append a PulseStore, a PULSE_DTYPE array or an iterable of pulse() objects.
+    """
+    if isinstance( pulses, (ChunkedStore, np.ndarray) ):
+      ChunkedStore.extend( self, pulses )
+    else:
+      for pls in pulses:
+        self.append( pls )
+
+  def __getitem__( self, key ):
+    if isinstance( key, (int, np.integer) ):
+      return self._pulse( self.array[key] )
+    return PulseStore( self.array[key] )
+
+  def __iter__( self ):
+    for row in self.array.tolist():
+      yield self._pulse( row )
+
+  @staticmethod
+  def _pulse( row ):
+    orbit, bx, amplitude, position, tot = row
+    return pulse( int(orbit), int(bx), int(amplitude), int(position), None if tot == NO_TOT else int(tot) )
+
+  def select( self, mask ):
+    return PulseStore( self.array[mask] )
+
+  def bx_mask( self, bx_start, bx_stop ):
+    """
+    Mask of the pulses with bx_start <= bx <= bx_stop.
+    """
+    bx = self.array["bx"]
+    return (bx >= bx_start) & (bx <= bx_stop)
+
+  def exclude_bx( self, bx_start, bx_stop ):
+    """
+    Pulses outside the bx window, e.g. without the test pulse (tp_start..tp_stop).
+    """
+    return self.select( ~self.bx_mask(bx_start, bx_stop) )
+
+  def group_by_orbit( self ):
+    """
+    Pulses sorted by orbit (stable), the orbit numbers and offsets:
+    pulses of orbits[i] are sorted[offsets[i]:offsets[i+1]].
+    """
+    data = self.array
+    sorted_data = data[ np.argsort(data["orbit"], kind="mergesort") ]
+    orbits, offsets = np.unique( sorted_data["orbit"], return_index=True )
+    return sorted_data, orbits, np.append( offsets, len(sorted_data) )
+
+class OrbitIndex( object ):
+  """
+  Per-orbit lookup of pulses: index[orbit] is the PULSE_DTYPE array of the pulses of that orbit,
+  a slice of the pulses sorted by orbit (binary search over the orbit numbers, no scan).
+  """
+  def __init__( self, pulses ):
+    if not isinstance( pulses, PulseStore ):
+      pulses = PulseStore( pulses )
+    self.sorted, self.orbits, self.offsets = pulses.group_by_orbit()
+
+  def __getitem__( self, orbit ):
+    i = np.searchsorted( self.orbits, orbit )
+    if i == len(self.orbits) or self.orbits[i] != orbit:
+      return self.sorted[:0]
+    return self.sorted[ self.offsets[i]:self.offsets[i + 1] ]
+
+  def __len__( self ):
+    return len( self.orbits )
+
+WAVEFORM_TYPES = ( "sample", "derivative" )
+
+def waveform_dtype( width=30 ):
+  """
+  Row layout of stored waveforms of <width> samples.
+  """
+  return np.dtype( [("orbit", np.int64), ("bx", np.int32), ("waveform", np.int16, (width,))] )
+
+class WaveformStore( object ):
+  """
+  Columnar store of pulse waveforms, one fixed-width int16 matrix per waveform type.
+  Iterating gives waveform() objects (all samples first, then all derivatives).
+  """
+  def __init__( self, width=30, chunk_size=4096 ):
+    self.width = width
+    self.stores = dict( (wf_type, ChunkedStore(waveform_dtype(width), chunk_size=chunk_size)) for wf_type in WAVEFORM_TYPES )
+
+  def add( self, orbit, bx, type, waveform ):
+    if type not in self.stores:
+      self.stores[type] = ChunkedStore( waveform_dtype(self.width), chunk_size=self.stores["sample"].chunk_size )
+    self.stores[type].add_row( (orbit, bx, waveform) )
+
+  def append( self, wf ):
+    self.add( wf.orbit, wf.bx, wf.type, wf.waveform )
+
+  def extend( self, waveforms ):
+    if isinstance( waveforms, WaveformStore ):
+      for wf_type, store in waveforms.stores.items():
+        if wf_type not in self.stores:
+          self.stores[wf_type] = ChunkedStore( store.dtype, chunk_size=store.chunk_size )
+        self.stores[wf_type].extend( store )
+    else:
+      for wf in waveforms:
+        self.append( wf )
+
+  def clear( self ):
+    for store in self.stores.values():
+      store.clear()
+
+  def array( self, type ):
+    return self.stores[type].array
+
+  def __len__( self ):
+    return sum( len(store) for store in self.stores.values() )
+
+  def __iter__( self ):
+    for wf_type, store in self.stores.items():
+      for orbit, bx, data in store.array.tolist():
+        yield waveform( orbit, bx, wf_type, data.tolist() )
+
+def save_npz( filename, **arrays ):
+  """
+  Save arrays to a .npz file, written aside and renamed, so readers never see a partial file.
+  """
+  tmp = filename + ".tmp.npz"
+  np.savez( tmp, **arrays )
+  os.rename( tmp, filename )
+
+class Accumulator( object ):
+  """
+  Base of counts accumulated over <orbits> orbits, merged by addition (a + b, a += b, merge) and saved as .npz.
+  Subclasses implement __iadd__, empty() (zero counts with the same binning) and arrays() (the saved arrays).
+  """
+  def __add__( self, other ):
+    merged = self.empty()
+    merged += self
+    merged += other
+    return merged
+
+  @classmethod
+  def merge( cls, accumulators ):
+    """
+    Sum of several accumulators, e.g. of all channels or runs.
+    """
+    accumulators = list( accumulators )
+    merged = accumulators[0].empty()
+    for accumulator in accumulators:
+      merged += accumulator
+    return merged
+
+  def save( self, filename ):
+    save_npz( filename, orbits=self.orbits, **self.arrays() )
+
+class LiveHistograms( Accumulator ):
+  """
+  Running occupancy (per bx), amplitude, position and ToT histograms, filled during the simulation.
+  Histograms of separate runs or channels are merged by addition (h1 + h2, h1 += h2, merge).
+  orbits: number of orbits accumulated so far
+  """
+  NAMES = ( "occ", "amp", "pos", "tot" )
+
+  def __init__( self, nbit=12, NSAMP=30, orb_size=3564 ):
+    self.occ = np.zeros( orb_size, dtype=np.int64 )
+    self.amp = np.zeros( 2**int(nbit), dtype=np.int64 )
+    self.pos = np.zeros( NSAMP, dtype=np.int64 )
+    self.tot = np.zeros( NSAMP + 1, dtype=np.int64 )
+    self.orbits = 0
+
+  def fill( self, bx, amplitude, position, tot=None ):
+    """
+    Add a single pulse.
+    """
+    self.occ[bx] += 1
+    if 0 <= amplitude < len(self.amp):
+      self.amp[amplitude] += 1
+    self.pos[position] += 1
+    if tot is not None and tot != NO_TOT:
+      self.tot[ min(tot, len(self.tot) - 1) ] += 1
+
+  def fill_pulses( self, pulses ):
+    """
+    Add a PulseStore or PULSE_DTYPE array of pulses.
+    """
+    data = pulses.array if isinstance( pulses, PulseStore ) else pulses
+    amp = data["amplitude"][ (data["amplitude"] >= 0) & (data["amplitude"] < len(self.amp)) ]
+    tot = data["tot"][ data["tot"] != NO_TOT ]
+    self.occ += np.bincount( data["bx"], minlength=len(self.occ) )[:len(self.occ)]
+    self.amp += np.bincount( amp, minlength=len(self.amp) )
+    self.pos += np.bincount( data["position"], minlength=len(self.pos) )[:len(self.pos)]
+    self.tot += np.bincount( np.minimum(tot, len(self.tot) - 1), minlength=len(self.tot) )
+
+  def __iadd__( self, other ):
+    for name in self.NAMES:
+      getattr( self, name )[:] += getattr( other, name )
+    self.orbits += other.orbits
+    return self
+
+  def empty( self ):
+    return LiveHistograms( int(np.log2(len(self.amp))), len(self.pos), len(self.occ) )
+
+  def arrays( self ):
+    return dict( (name, getattr(self, name)) for name in self.NAMES )
+
+  @classmethod
+  def load( cls, filename ):
+    data = np.load( filename )
+    hist = cls( int(np.log2(len(data["amp"]))), len(data["pos"]), len(data["occ"]) )
+    for name in cls.NAMES:
+      getattr( hist, name )[:] = data[name]
+    hist.orbits = int( data["orbits"] )
+    return hist
+
 def string_color( strng, color ):
   """
   Add color to a string.
@@ -53,6 +391,20 @@ def string_color( strng, color ):
     strng = '\x1b[0;34;40m' + strng + '\x1b[0m'
   return strng
 
+def test_param( name, default ):
+  """
+  Test parameter from the environment variable PFTB_<NAME> (set e.g. by peakfinder_regression.py),
+  converted to the type of <default>. Returns <default> if the variable is not set.
+  """
+  value = os.environ.get( "PFTB_" + name.upper() )
+  if value is None:
+    return default
+  if isinstance( default, bool ):
+    return value.lower() in ["1", "true", "yes"]
+  if default is None:
+    return value
+  return type(default)( value )
+
 def read_binary( file_object, chunk_size ):
   """
   Function generator to read a file piece by piece.
@@ -64,141 +416,496 @@ def read_binary( file_object, chunk_size ):
     yield data
 
 def write_pulses( filename, pulses, waveforms = []):
-  if not filename.endswith(".csv"):
-    filename += ".csv"
-  with open( filename , 'w') as f:
-    for pulse in pulses:
-      f.write( str(pulse.orbit) + ",")
-      f.write( str(pulse.bx) + ",")
-      f.write( str(pulse.amplitude) + ",")
-      f.write( str(pulse.position) + ",")
-      f.write( str(pulse.tot) + ",")
-      f.write("\n")
-    for waveform in waveforms:
-      f.write(str(waveform.orbit) + ",")
-      f.write(str(waveform.bx) + ",")
-      f.write(str(waveform.type) + ",")
-      f.write(str(waveform.waveform) + ",")
-      f.write("\n")
-
-## Make some common no_tp function?
-## Some general histogramming function?
+  """
+  Bulk CSV export: one orbit,bx,amplitude,position,tot row per pulse (tot NO_TOT if not measured).
+  Waveforms go to <filename>_waveforms.csv, one orbit,bx,type,samples... row per waveform.
+  """
+  if filename.endswith(".csv"):
+    filename = filename[:-4]
+  if not isinstance( pulses, PulseStore ):
+    pulses = PulseStore( pulses )
+  with open( filename + ".csv", 'w') as f:
+    np.savetxt( f, np.column_stack([pulses.array[name] for name in PULSE_DTYPE.names]), fmt="%d", delimiter=",", newline=",\n" )
+  if not isinstance( waveforms, WaveformStore ):
+    store = WaveformStore()
+    store.extend( waveforms )
+    waveforms = store
+  if len(waveforms) > 0:
+    with open( filename + "_waveforms.csv", 'w') as f:
+      for wf_type, store in waveforms.stores.items():
+        data = store.array
+        if len(data) > 0:
+          fmt = "%d,%d," + wf_type + "," + ",".join( ["%d"] * waveforms.width )
+          np.savetxt( f, np.column_stack([data["orbit"], data["bx"], data["waveform"]]), fmt=fmt )
+
+# Parsed results files: absolute path -> (mtime, PulseStore)
+_pulse_cache = {}
+
+def _parse_pulses_csv( filename ):
+  """
+  Parse a pulse csv file (see write_pulses) in bulk, with a row by row
+  fallback for old files (tot "None", waveforms in the same file).
+  """
+  try:
+    data = np.loadtxt( filename, delimiter=",", usecols=range(5), dtype=np.int64, ndmin=2 )
+    return PulseStore.from_columns( orbit=data[:, 0], bx=data[:, 1], amplitude=data[:, 2], position=data[:, 3], tot=data[:, 4] )
+  except ValueError:
+    pulses = PulseStore()
+    with open( filename ) as f:
+      for row in csv.reader( f ):
+        if not row[2].isdigit():
+          continue
+        pulses.add( orbit=int(row[0]), bx=int(row[1]), amplitude=int(row[2]), position=int(row[3]), tot=int(row[4]) if row[4].lstrip("-").isdigit() else None )
+    return pulses
+
+def load_pulses( filename ):
+  """
+  Pulses of a results file (.h5 or pulse csv), parsed once and cached by path and modification time.
+  The returned store is shared, do not modify it.
+  """
+  path = os.path.abspath( filename )
+  mtime = os.path.getmtime( path )
+  if path not in _pulse_cache or _pulse_cache[path][0] != mtime:
+    if path.endswith(".h5"):
+      pulses = pfio.read_results( path )[0]
+    else:
+      pulses = _parse_pulses_csv( path )
+    _pulse_cache[path] = ( mtime, pulses )
+  return _pulse_cache[path][1]
+
+def tp_mask( bx, no_tp=False, tp_start=248, tp_stop=260 ):
+  """
+  Mask of the pulses to histogram: all, or (no_tp) the ones outside the test pulse window.
+  """
+  if not no_tp:
+    return np.ones( len(bx), dtype=bool )
+  return (bx < tp_start) | (bx > tp_stop)
+
+def histograms( filename, nbit=12, NSAMP=30, orb_size=3564, no_tp=False, tp_start=248 ,tp_stop=260 ):
+  """
+  Occupancy per bx, amplitude, position and ToT histograms of a results file, computed together.
+  Returns a dict with "occ" (orb_size), "amp" (2**nbit), "pos" (NSAMP) and "tot" (NSAMP+1) NumPy arrays.
+  Pulses without ToT are not counted in "tot", amplitudes out of range not in "amp".
+  """
+  data = load_pulses( filename ).array
+  data = data[ tp_mask(data["bx"], no_tp, tp_start, tp_stop) ]
+  amp = data["amplitude"][ (data["amplitude"] >= 0) & (data["amplitude"] < 2**int(nbit)) ]
+  tot = data["tot"][ data["tot"] != NO_TOT ]
+  return {
+    "occ": np.bincount( data["bx"], minlength=orb_size )[:orb_size],
+    "amp": np.bincount( amp, minlength=2**int(nbit) ),
+    "pos": np.bincount( data["position"], minlength=NSAMP )[:NSAMP],
+    "tot": np.bincount( np.minimum(tot, NSAMP), minlength=NSAMP + 1 ),
+  }
+
+def bx_amp_hist( filename, nbit=12, amp_bins=64, orb_size=3564, no_tp=False, tp_start=248 ,tp_stop=260 ):
+  """
+  2-D histogram bx x amplitude (orb_size x amp_bins, 2**nbit amplitudes merged into amp_bins bins).
+  """
+  data = load_pulses( filename ).array
+  data = data[ tp_mask(data["bx"], no_tp, tp_start, tp_stop) & (data["amplitude"] >= 0) & (data["amplitude"] < 2**int(nbit)) ]
+  amp_bin = (data["amplitude"].astype(np.int64) * amp_bins) >> int(nbit)
+  return np.bincount( data["bx"] * amp_bins + amp_bin, minlength=orb_size * amp_bins )[:orb_size * amp_bins].reshape( orb_size, amp_bins )
+
+def bx_bin_hist( filename, lut=None, NSAMP=30, NBINS=6, orb_size=3564, no_tp=False, tp_start=248 ,tp_stop=260 ):
+  """
+  2-D histogram bx x sub-bx bin (orb_size x NBINS), pulse positions mapped to bins
+  with the bin LUT (peaks_bins), equally sized bins by default (pfb.bin_lut).
+  As in peaks_bins, a bin counts once per bx and orbit (see pfb.BinOccupancy).
+  """
+  # imported here, peakfinder_bins imports this module
+  import peakfinder_bins as pfb
+  data = load_pulses( filename ).array
+  occupancy = pfb.BinOccupancy( NBINS, orb_size, lut, NSAMP )
+  occupancy.fill_pulses( data[ tp_mask(data["bx"], no_tp, tp_start, tp_stop) ] )
+  return occupancy.counts
 
 def occ_hist( filename, no_tp=False, tp_start=248 ,tp_stop=260 ):
-  occ_histogram = [0] * 3564
-  with open( filename ) as f:
-    for row in csv.reader( f ):
-      if no_tp == True:
-        if int(row[1]) < tp_start or int(row[1]) > tp_stop:
-          occ_histogram[ int(row[1]) ] += 1
-      else:
-        occ_histogram[ int(row[1]) ] += 1
-  return occ_histogram
+  return histograms( filename, no_tp=no_tp, tp_start=tp_start, tp_stop=tp_stop )["occ"]
 
 def amp_hist( filename, nbit, no_tp=False, tp_start=248 ,tp_stop=260 ):
-  amp_histogram = [0] * (2**int(nbit))
-  with open( filename ) as f:
-    for row in csv.reader( f ):
-      if no_tp == True:
-        if int(row[1]) < tp_start or int(row[1]) > tp_stop:
-          amp_histogram[ int(row[2]) ] += 1
-      else:
-        amp_histogram[ int(row[2]) ] += 1
-  return amp_histogram
+  return histograms( filename, nbit=nbit, no_tp=no_tp, tp_start=tp_start, tp_stop=tp_stop )["amp"]
 
 def pos_hist( filename, NSAMP=30, no_tp=False, tp_start=248 ,tp_stop=260 ):
-  pos_histogram = [0] * NSAMP
-  with open( filename ) as f:
-    for row in csv.reader( f ):
-      if no_tp == True:
-        if int(row[1]) < tp_start or int(row[1]) > tp_stop:
-          pos_histogram[ int(row[3]) ] += 1
-      else:
-        pos_histogram[ int(row[3]) ] += 1
-  return pos_histogram
+  return histograms( filename, NSAMP=NSAMP, no_tp=no_tp, tp_start=tp_start, tp_stop=tp_stop )["pos"]
 
 def read_pulses( filename, no_tp=False, tp_start=248 ,tp_stop=260 ):
   """
-  filename: pulse object csv file
-  """
-  pulses = []
-  with open( filename ) as f:
-    for row in csv.reader( f ):
-      if no_tp == True:
-        if int(row[1]) < tp_start or int(row[1]) > tp_stop:
-          pos_histogram[ int(row[3]) ] += 1
-      else:
-        pls = pulse( orbit=int(row[0]), bx=int(row[1]), amplitude=int(row[2]), position=int(row[3]), tot=0 )
-        pls.tot = int( row[4] ) if isinstance(row[4], int) else 0
-        pulses.append( pls )
-  return pulses
-  
-def recon( filename, pulses, raw_orb_size=((3564*30)) ): #-3672
+  filename: results file (.h5 or pulse csv)
+  no_tp: drop the pulses in the test pulse window tp_start..tp_stop
+  """
+  data = load_pulses( filename ).array
+  return PulseStore( data[ tp_mask(data["bx"], no_tp, tp_start, tp_stop) ] )
+
+def active_bx( data, NSAMP=30, baseline=None, band=3 ):
+  """
+  Pre-scan of an orbit: a bx is active if any of its samples is outside baseline +- band.
+  baseline: median of the orbit by default
   """
+  rows = np.asarray( data ).reshape( -1, NSAMP )
+  if baseline is None:
+    baseline = np.median( rows )
+  return ( np.abs(rows - float(baseline)) > band ).any( axis=1 )
+
+def bx_windows( active, pre=1, post=13, carry=0 ):
+  """
+  Windows around active bx: from <pre> bx before to <post> bx after every active bx
+  (derivative window and pipeline latency), overlapping windows merged.
+  Windows are clipped at the orbit end, the <post> bx beyond it (see bx_overflow) are passed
+  as <carry> of the next orbit, which then starts with the window (0, carry).
+  Returns a list of (start_bx, stop_bx), stop exclusive.
+  """
+  idx = np.nonzero( active )[0]
+  starts = np.maximum( idx - pre, 0 )
+  stops = np.minimum( idx + post + 1, len(active) )
+  if carry > 0:
+    starts = np.append( 0, starts )
+    stops = np.append( min(carry, len(active)), stops )
+  if len(starts) == 0:
+    return []
+  stops = np.maximum.accumulate( stops )
+  new = np.ones( len(starts), dtype=bool )
+  new[1:] = starts[1:] > stops[:-1]
+  first = np.nonzero( new )[0]
+  last = np.append( first[1:] - 1, len(starts) - 1 )
+  return list( zip(starts[first].tolist(), stops[last].tolist()) )
+
+def bx_overflow( active, post=13 ):
+  """
+  Number of bx of the next orbit still inside the <post> window of the last active bx (see bx_windows).
+  """
+  idx = np.nonzero( active )[0]
+  if len(idx) == 0:
+    return 0
+  return max( int(idx[-1]) + post + 1 - len(active), 0 )
+
+def minmax_decimate( data, width=2000 ):
+  """
+  Min/max downsampling of a trace to <width> bins for plotting: returns x, y with the minimum
+  and maximum of every bin (in sample order), so spikes and the envelope are kept.
+  Traces shorter than 2 * width are returned as they are.
+  """
+  data = np.asarray( data )
+  n = len( data )
+  if n <= 2 * width:
+    return np.arange( n ), data
+  step = int( np.ceil(n / float(width)) )
+  n_bins = int( np.ceil(n / float(step)) )
+  # pad the last bin with its last sample
+  bins = np.concatenate( [data, np.repeat(data[-1:], n_bins * step - n)] ).reshape( n_bins, step )
+  base = np.arange( n_bins ) * step
+  imin = bins.argmin( axis=1 )
+  imax = bins.argmax( axis=1 )
+  x = np.empty( 2 * n_bins, dtype=np.int64 )
+  x[0::2] = base + np.minimum( imin, imax )
+  x[1::2] = base + np.maximum( imin, imax )
+  x = np.minimum( x, n - 1 )
+  return x, data[x]
+
+def recon_orbit( fig, data, orbit_pulses, zoom_bx=None, zoom_width=2, width=2000, NSAMP=30, pos_offset=-120, title=None ):
+  """
+  Draw one orbit into fig: the min/max decimated raw trace with the pulses (position, amplitude) on top,
+  and below one full resolution panel of +-zoom_width bx around every bx in zoom_bx.
+  orbit_pulses: PULSE_DTYPE array of the pulses of the orbit (see OrbitIndex)
+  pos_offset: sample offset of the pulse positions (latency of the peak finder)
+  """
+  zoom_bx = list( zoom_bx or [] )
+  positions = orbit_pulses["bx"] * NSAMP + orbit_pulses["position"] + pos_offset
+  amplitudes = orbit_pulses["amplitude"]
+  ax = fig.add_subplot( 1 + len(zoom_bx), 1, 1 )
+  x, y = minmax_decimate( data, width )
+  ax.plot( x, y, linewidth=0.5 )
+  ax.plot( positions, amplitudes, 'o' )
+  if title is not None:
+    ax.set_title( title )
+  for i, bx in enumerate( zoom_bx ):
+    ax = fig.add_subplot( 1 + len(zoom_bx), 1, i + 2 )
+    lo = max( 0, (bx - zoom_width) * NSAMP )
+    hi = min( len(data), (bx + zoom_width + 1) * NSAMP )
+    window = (positions >= lo) & (positions < hi)
+    ax.plot( np.arange(lo, hi), data[lo:hi] )
+    ax.plot( positions[window], amplitudes[window], 'o' )
+    ax.set_title( "bx " + str(bx) )
+  return fig
+
+def _recon_task( args ):
+  filename, raw_orb_size, orbit, orbit_pulses, path, kwargs = args
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  data = pfio.RawOrbitFile( filename, raw_orb_size, orb_excess=0 )[orbit - 1]
+  fig = Figure( figsize=(16, 4 * (1 + len(kwargs.get("zoom_bx") or []))) )
+  FigureCanvasAgg( fig )
+  recon_orbit( fig, data, orbit_pulses, title="orbit " + str(orbit), **kwargs )
+  fig.savefig( path )
+  return path
+
+def recon( filename, pulses, raw_orb_size=((3564*30)), orbits=None, out_dir=None, processes=None, fmt="png", **kwargs ): #-3672
+  """
+  Raw data with the detected pulses on top, orbit by orbit (see recon_orbit for the plot options).
   filename: raw data file
-  pulses: pulses list
-  """
-  orb_cnt = 0
-  with open( filename, "rb") as f:
-    for byte_list in read_binary( f, raw_orb_size ):
-      orb_cnt += 1
-      data = [ struct.unpack( 'B', byte_list[i] )[0] for i in range(raw_orb_size) ]
-      plt.plot( data )
-      indices = [ i for i, pulse in enumerate(pulses) if pulse.orbit == orb_cnt ]
-      positions = [ (pulses[i].bx * 30)-120 + pulses[i].position for i in indices ]
-      # positions = [ (pulses[i].bx * 30) for i in indices ]
-      amplitudes = [ pulses[i].amplitude for i in indices ]
-      plt.plot( positions, amplitudes, 'o' )
+  pulses: PulseStore or pulses list
+  orbits: orbit numbers to show (all orbits of the file by default)
+  Without out_dir every orbit is shown in a window, which needs an interactive backend (MPLBACKEND,
+  see pyplot), ValueError otherwise. With out_dir the orbits are rendered headless
+  to <out_dir>/orbit_<n>.<fmt> by a pool of <processes> workers (inline for processes=1),
+  returns the file names.
+  """
+  if out_dir is None and not interactive_backend():
+    raise ValueError( "recon without out_dir needs an interactive backend (e.g. MPLBACKEND=Qt5Agg), the backend is " + pyplot().get_backend() )
+  index = OrbitIndex( pulses )
+  if orbits is None:
+    orbits = range( 1, len(pfio.RawOrbitFile(filename, raw_orb_size, orb_excess=0)) + 1 )
+  if out_dir is None:
+    raw = pfio.RawOrbitFile( filename, raw_orb_size, orb_excess=0 )
+    plt = pyplot()
+    for orbit in orbits:
+      fig = plt.figure()
+      recon_orbit( fig, raw[orbit - 1], index[orbit], title="orbit " + str(orbit), **kwargs )
       plt.show()
+      plt.close( fig )
+    return []
+  if not os.path.isdir( out_dir ):
+    os.makedirs( out_dir )
+  tasks = [ (filename, raw_orb_size, orbit, index[orbit], os.path.join(out_dir, "orbit_%d.%s" % (orbit, fmt)), kwargs) for orbit in orbits ]
+  if processes == 1:
+    return [ _recon_task(task) for task in tasks ]
+  import multiprocessing
+  pool = multiprocessing.Pool( processes )
+  try:
+    return pool.map( _recon_task, tasks )
+  finally:
+    pool.close()
+    pool.join()
+
+# Smooth noise-robust differentiator coefficients c_k (k = 1..wing) for each window size,
+# snrd[x] = sum_k c_k * ( in[x+k] - in[x-k] ) / 4
+SNRD_COEFFS = {
+  5: (2, 1),
+  7: (5, 4, 1),
+  9: (14, 14, 6, 1),
+}
 
-def snrd( in_data, win_size=7 ):
-  if win_size not in [5, 7, 9]:
+def snrd( in_data, win_size=7, fixed_point=False, nbits=12 ):
+  """
+  Smooth noise-robust derivative of one orbit (1-D) or of a batch of orbits (2-D, orbits x samples).
+  The derivative is taken along the last axis in one vectorized pass, the first and last
+  (win_size-1)/2 samples of every orbit are zero padded.
+  in_data: samples (list or NumPy array)
+  win_size: one of [5,7,9]
+  fixed_point: emulate the diff_m7 firmware block: integer arithmetic, arithmetic shift right by 2
+               and wrap-around to a signed <nbits> wide result
+  Integer input is divided by 4 with floor rounding, float input with true division.
+  Returns a NumPy array with the shape of in_data.
+  """
+  if win_size not in SNRD_COEFFS:
     raise ValueError("win_size wrong, has to be one of [5,7,9]")
-  if len(in_data) < win_size:
+  data = np.asarray( in_data )
+  if data.ndim not in [1, 2]:
+    raise ValueError("in_data has to be one orbit (1-D) or orbits x samples (2-D)")
+  len_data = data.shape[-1]
+  if len_data < win_size:
     raise ValueError("Not enough input samples for that win_size")
-  wing = (win_size - 1) / 2
-  len_data = len( in_data )
-  deriv = [0] * wing
-  for x in range( wing, len_data - wing ):
-    if win_size == 5:
-      snrd = ( 2 * ( in_data[x+1] - in_data[x-1] ) + in_data[x+2] - in_data[x-2] ) / 4 #8
-    elif win_size == 7:
-      snrd = ( 5 * ( in_data[x+1] - in_data[x-1] ) + 4 * ( in_data[x+2] - in_data[x-2] ) + in_data[x+3] - in_data[x-3] ) / 4 #32
-    elif win_size == 9:
-      snrd = ( 14 * ( in_data[x+1] - in_data[x-1] ) + 14 * ( in_data[x+2] - in_data[x-2] ) + 6 * ( in_data[x+3] - in_data[x-3] ) + in_data[x+4] - in_data[x-4] ) / 4 #128
-    else:
-      raise ValueError("Unallowed win_size")
-    deriv.append( snrd )
-  deriv.extend( [0] * wing )
+  if fixed_point or data.dtype.kind in "biu":
+    data = data.astype( np.int64 )
+  else:
+    data = data.astype( np.float64 )
+  wing = (win_size - 1) // 2
+  deriv = np.zeros( data.shape, dtype=data.dtype )
+  acc = deriv[..., wing:len_data - wing]
+  for k, coeff in enumerate( SNRD_COEFFS[win_size], 1 ):
+    acc += coeff * ( data[..., wing + k:len_data - wing + k] - data[..., wing - k:len_data - wing - k] )
+  if data.dtype.kind == "f":
+    acc /= 4
+  else:
+    acc >>= 2
+  if fixed_point:
+    half = 1 << (nbits - 1)
+    acc += half
+    acc &= (1 << nbits) - 1
+    acc -= half
   return deriv
 
-class RingBuffer:
-  """ class that implements a not-yet-full buffer """
-  def __init__(self, size_max):
+class WaveformCapture( object ):
+  """
+  Reconstructs pulse waveforms from the driven stimulus instead of sampling DUT signals on every clock.
+  The testbench registers every fed clock sequence (segment) with the clock index of its first bx;
+  a detection seen on clock clk belongs to the bx fed <latency> clocks earlier. Its samples are taken
+  from the orbit array, its derivative is the diff_m7 derivative (snrd fixed point) of that orbit.
+  Only the last <depth> segments are kept.
+  """
+  def __init__( self, NSAMP=30, latency=12, nbits=12, depth=4 ):
+    self.NSAMP = NSAMP
+    self.latency = latency
+    self.nbits = nbits
+    self.segments = collections.deque( maxlen=depth )
+
+  def add_segment( self, clk_start, orbit, data, bx_seq ):
+    """
+    Clocks clk_start.. fed bx_seq of orbit data (data None for baseline clocks).
+    """
+    self.segments.append( [clk_start, orbit, data, np.asarray(bx_seq), None] )
+
+  def capture( self, clk ):
+    """
+    (orbit, bx, samples, derivative) of the bx fed <latency> clocks before clk,
+    None if that clock was not fed from orbit data.
+    """
+    src = clk - self.latency
+    for segment in reversed( self.segments ):
+      clk_start, orbit, data, bx_seq, deriv = segment
+      if clk_start <= src < clk_start + len(bx_seq):
+        if data is None:
+          return None
+        if deriv is None:
+          deriv = segment[4] = snrd( data, 7, fixed_point=True, nbits=self.nbits )
+        bx = int( bx_seq[src - clk_start] )
+        window = slice( bx * self.NSAMP, (bx + 1) * self.NSAMP )
+        return orbit, bx, np.asarray( data[window] ), deriv[window]
+    return None
+
+class RingBuffer( object ):
+  """
+  Preallocated ring buffer of numbers or of fixed-width numeric rows (e.g. NSAMP samples per bx).
+  Every row is stored twice (at i and i + size_max), so the content from oldest to newest
+  is always one contiguous slice and can be handed out as a view without allocation.
+  """
+  def __init__( self, size_max, width=None, dtype=np.int64 ):
     self.max = size_max
-    self.data = []
+    shape = (2 * size_max,) if width is None else (2 * size_max, width)
+    self.data = np.zeros( shape, dtype=dtype )
+    self.cur = 0
+    self.count = 0
+
+  def append( self, x ):
+    """ Append an element (row), overwriting the oldest one when full. O(1). """
+    self.data[self.cur] = x
+    self.data[self.cur + self.max] = x
+    self.cur = (self.cur + 1) % self.max
+    self.count = min( self.count + 1, self.max )
+
+  def extend( self, rows ):
+    """ Append many elements (rows) at once, only the last size_max are kept. """
+    rows = np.asarray( rows )[-self.max:]
+    idx = (self.cur + np.arange(len(rows))) % self.max
+    self.data[idx] = rows
+    self.data[idx + self.max] = rows
+    self.cur = (self.cur + len(rows)) % self.max
+    self.count = min( self.count + len(rows), self.max )
+
+  def last( self, k, out=None ):
+    """
+    The last k elements from oldest to newest: a view into the buffer,
+    or (out given) copied into the caller supplied array.
+    """
+    k = min( k, self.count )
+    view = self.data[self.cur + self.max - k:self.cur + self.max]
+    if out is None:
+      return view
+    out[:k] = view
+    return out
+
+  def get( self, out=None ):
+    """ Return the elements from the oldest to the newest (view, see last()). """
+    return self.last( self.count, out )
+
+  def snapshot( self, k ):
+    """ Copy of the last k elements, e.g. as a waveform matrix. """
+    return self.last( k ).copy()
+
+  def __len__( self ):
+    return self.count
+
+class StageProfiler( object ):
+  """
+  Lightweight instrumentation of a testbench run: wall-clock time per stage and event counters.
+    with prof.stage("drive"): ...    (time spent in the block, also across yields of a coroutine)
+    token = prof.start("drive"); ...; prof.stop(token)
+    prof.count("bx", n)
+  Every block is timed with its own token, nothing is shared between coroutines: stages may overlap
+  (e.g. producers run while an ipbus transaction waits for the clock), and a stage running in several
+  coroutines at once is accounted once per coroutine.
+  Counters ending in "_est" are estimates of the caller (e.g. VPI accesses from the signals an operation touches), not measured.
+  Stages listed in profile_stages additionally run under cProfile.
+  """
+  def __init__( self, profile_stages=() ):
+    self.t_start = time.time()
+    # name -> [wall time, calls]
+    self.stages = collections.OrderedDict()
+    self.counters = collections.OrderedDict()
+    self.profile_stages = set( profile_stages )
+    self.profile = None
+    self._profiling = 0
+
+  def start( self, name ):
+    """
+    Start timing a block of stage <name>, returns the token for stop().
+    """
+    if name in self.profile_stages:
+      self._profile_enable()
+    return ( name, time.time() )
+
+  def stop( self, token ):
+    name, t_start = token
+    entry = self.stages.setdefault( name, [0., 0] )
+    entry[0] += time.time() - t_start
+    entry[1] += 1
+    if name in self.profile_stages:
+      self._profile_disable()
 
-  class __Full:
-    """ class that implements a full buffer """
-    def append(self, x):
-      """ Append an element overwriting the oldest one. """
-      self.data[self.cur] = x
-      self.cur = (self.cur + 1) % self.max
+  @contextlib.contextmanager
+  def stage( self, name ):
+    token = self.start( name )
+    try:
+      yield
+    finally:
+      self.stop( token )
 
-    def get(self):
-      """ return list of elements in correct order """
-      return self.data[self.cur:] + self.data[:self.cur]
+  def count( self, name, n=1 ):
+    self.counters[name] = self.counters.get( name, 0 ) + n
 
-  def append(self, x):
-    """append an element at the end of the buffer"""
-    self.data.append(x)
-    if len(self.data) == self.max:
-      self.cur = 0
-      # Permanently change self's class from non-full to full
-      self.__class__ = self.__Full
+  def _profile_enable( self ):
+    if self._profiling == 0:
+      if self.profile is None:
+        import cProfile
+        self.profile = cProfile.Profile()
+      self.profile.enable()
+    self._profiling += 1
 
-  def get(self):
-    """ Return a list of elements from the oldest to the newest. """
-    return self.data
+  def _profile_disable( self ):
+    self._profiling -= 1
+    if self._profiling == 0:
+      self.profile.disable()
 
+  def report( self, sim_time_ns=None, top=20 ):
+    """
+    Profile as a dict: wall time, stages (time, calls, fraction of the wall time), counters,
+    rates (counter per second of wall time), simulated time and sim/wall ratio,
+    and the <top> functions by own time if cProfile was used.
+    """
+    wall = time.time() - self.t_start
+    report = collections.OrderedDict()
+    report["wall_time"] = wall
+    report["stages"] = collections.OrderedDict( (name, {"time": t, "calls": calls, "fraction": t / wall if wall > 0 else 0.}) for name, (t, calls) in self.stages.items() )
+    report["counters"] = dict( self.counters )
+    report["rates"] = dict( (name + "/s", n / wall if wall > 0 else 0.) for name, n in self.counters.items() )
+    if sim_time_ns is not None:
+      report["sim_time_ns"] = sim_time_ns
+      report["sim_wall_ratio"] = sim_time_ns * 1e-9 / wall if wall > 0 else 0.
+    if self.profile is not None:
+      import pstats
+      stats = pstats.Stats( self.profile ).stats
+      functions = sorted( stats.items(), key=lambda item: -item[1][2] )[:top]
+      report["profile"] = [ {"function": "%s:%d(%s)" % key, "calls": value[1], "time": value[2], "cumtime": value[3]} for key, value in functions ]
+    return report
 
+  def save( self, filename, report=None ):
+    """
+    Write the report as JSON, and the cProfile statistics to <filename>.prof (for pstats/snakeviz) if used.
+    """
+    if report is None:
+      report = self.report()
+    with open( filename, "w" ) as f:
+      json.dump( report, f, indent=2 )
+    if self.profile is not None:
+      self.profile.dump_stats( filename + ".prof" )
+    return report